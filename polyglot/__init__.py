@@ -7,8 +7,11 @@ third-party Node Servers.
 # pylint: disable=no-name-in-module,import-error
 # flake8: noqa
 
-from . import utils
-from . import nodeserver_api
+# Submodules are not imported here: every node server process imports this
+# package, and should only load the modules it uses.
 import os
 
 SOURCE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Python path of node servers (the pyz archive is added when Polyglot
+# imports from it)
+PYTHON_PATH = [SOURCE_DIR]
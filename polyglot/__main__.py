@@ -2,12 +2,30 @@
 """ Polyglot loader """
 
 import argparse
+import hashlib
 import logging
 import os
 import shutil
 import sys
 import tempfile
+import time
 import zipfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# start up clock, until polyglot.utils.monotonic can be imported
+_clock = getattr(time, 'monotonic', time.time)
+
+# packages extracted from the pyz archive: Polyglot itself (node servers and
+# the frontend must be real files), and any with native extensions
+PYZ_EXTRACT = ('polyglot',)
+NATIVE_EXTENSIONS = ('.so', '.pyd', '.dylib')
+# seconds after which an unfinished extraction to the pyz cache is removed
+PYZ_PARTIAL_AGE = 3600
+# descriptors of the pyz cache directories in use, locked while Polyglot runs
+_CACHE_LOCKS = []
 
 
 def parse_arguments():
@@ -25,6 +43,21 @@ def parse_arguments():
     parser.add_argument('-vv', dest='verbose', default=0,
                         action="store_const", const=2,
                         help="Enable very verbose logging")
+    parser.add_argument('--store', dest='config_store', default=None,
+                        choices=('json', 'sqlite'),
+                        help='Configuration store (default: sqlite if '
+                        'configuration.db exists, else json)')
+    parser.add_argument('--export-config', dest='export_config', type=str,
+                        default=None, metavar='FILE',
+                        help='Export the configuration to a JSON file and exit')
+    parser.add_argument('--pyz-extract', dest='pyz_extract', default=False,
+                        action='store_true',
+                        help='Extract the whole pyz archive to a temporary '
+                        'directory on start')
+    parser.add_argument('--profile-startup', dest='profile_startup',
+                        nargs='?', const='', default=None, metavar='FILE',
+                        help='Write a cProfile of the startup to FILE '
+                        '(default: startup.prof in the configuration directory)')
     args = parser.parse_args()
     return args
 
@@ -49,11 +82,15 @@ def setup_config(config_dir):
     return config_dir
 
 
-def setup_env():
+def setup_env(config_dir, extract=False):
     """ Setup Polyglot environment """
-    if in_pyz():
-        # Polyglot running from pyz file
+    if in_pyz() and extract:
+        # Polyglot running from pyz file, extracted to a temporary directory
         source_dir = extract_pyz()
+    elif in_pyz():
+        # Polyglot running from pyz file: import from the archive, with the
+        # parts that must be files in a cache directory
+        source_dir = cache_pyz(os.path.join(config_dir, 'pyz_cache'))
     else:
         # Polyglot running from regular directory
         source_dir = os.path.abspath(
@@ -84,6 +121,100 @@ def extract_pyz():
     return source_dir
 
 
+def cache_pyz(cache_dir):
+    """
+    Extract the packages that must be files (PYZ_EXTRACT and any with native
+    extensions) from the PYZ to cache_dir/<archive hash>, unless they already
+    are, and return that directory. Everything else is imported from the
+    archive, which is on the Python path already.
+    """
+    pyz_file = os.path.abspath(os.path.dirname(__file__))
+    pyz_archive = zipfile.ZipFile(pyz_file, mode='r')
+    try:
+        # content hash from the member CRCs in the archive directory
+        digest = hashlib.sha1()
+        for info in sorted(pyz_archive.infolist(), key=lambda i: i.filename):
+            digest.update('{} {} {}\n'.format(info.filename, info.CRC,
+                                              info.file_size).encode('utf-8'))
+        source_dir = os.path.join(cache_dir, digest.hexdigest()[:16])
+        if lock_cache(source_dir):
+            return source_dir
+
+        names = pyz_archive.namelist()
+        native = set(name.split('/')[0] for name in names
+                     if name.endswith(NATIVE_EXTENSIONS))
+        extract = [name for name in names
+                   if name.split('/')[0] in native.union(PYZ_EXTRACT)]
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        partial = tempfile.mkdtemp(prefix='partial_', dir=cache_dir)
+        pyz_archive.extractall(path=partial, members=extract)
+        for name in extract:
+            # keep executable bits (node servers) from the archive
+            mode = pyz_archive.getinfo(name).external_attr >> 16
+            if mode and not name.endswith('/'):
+                os.chmod(os.path.join(partial, name), mode & 0o777)
+    finally:
+        pyz_archive.close()
+
+    try:
+        os.rename(partial, source_dir)
+    except OSError:
+        # another Polyglot extracted it first
+        shutil.rmtree(partial, ignore_errors=True)
+        if not os.path.isdir(source_dir):
+            raise
+    lock_cache(source_dir)
+    # remove the caches of other archive versions that no Polyglot is using,
+    # and extractions abandoned part way
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if path == source_dir:
+            continue
+        if name.startswith('partial_'):
+            if time.time() - os.path.getmtime(path) > PYZ_PARTIAL_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        if lock_cache(path, exclusive=True):
+            shutil.rmtree(path, ignore_errors=True)
+            unlock_cache(path)
+    return source_dir
+
+
+def lock_cache(path, exclusive=False):
+    """
+    Lock a pyz cache directory: shared while Polyglot uses it, or exclusive
+    to remove it. Returns False if it does not exist or, for an exclusive
+    lock, is in use (or cannot be locked on this platform).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive
+                        else fcntl.LOCK_SH)
+        elif exclusive:
+            raise IOError('no file locks')
+    except (IOError, OSError):
+        os.close(fd)
+        return False
+    if not os.path.isdir(path):
+        # removed while we waited for the lock
+        os.close(fd)
+        return False
+    _CACHE_LOCKS.append((path, fd))
+    return True
+
+
+def unlock_cache(path):
+    """ Release the locks taken on a pyz cache directory. """
+    for entry in [entry for entry in _CACHE_LOCKS if entry[0] == path]:
+        _CACHE_LOCKS.remove(entry)
+        os.close(entry[1])
+
+
 def setup_logging(config_dir, verbose):
     """ Setup the Polyglot logs """
     # pylint: disable=global-statement
@@ -112,9 +243,9 @@ def setup_logging(config_dir, verbose):
         logging.getLogger('urllib3').setLevel(logging.WARNING)
         logging.getLogger('requests').setLevel(logging.WARNING)
 
-def cleanup(source_dir):
+def cleanup(source_dir, extract=False):
     """ Cleanup Polyglot environment """
-    if in_pyz():
+    if in_pyz() and extract:
         shutil.rmtree(source_dir)
 
 
@@ -123,32 +254,67 @@ def main():
     # read arguments
     # [future] PID File
     # [future] daemonize
+    start = _clock()
     args = parse_arguments()
+    profile = None
+    if args.profile_startup is not None:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
 
     # setup config directory
     config_dir = setup_config(args.config_dir)
 
     # create environment, add to Python Path
-    source_dir = setup_env()
+    env_start, env_cpu = _clock(), os.times()
+    source_dir = setup_env(config_dir, args.pyz_extract)
+    env_wall = _clock() - env_start
+    env_cpu = sum(os.times()[:2]) - sum(env_cpu[:2])
 
     # setup log
     setup_logging(config_dir, args.verbose)
+    from polyglot.utils import Timeline, monotonic
+    # move the times so far onto the clock of the timeline
+    offset = monotonic() - _clock()
+    startup = Timeline(start + offset, logging.WARNING
+                       if args.profile_startup is not None else logging.INFO)
+    startup.add('setup_env', env_start + offset, env_wall, env_cpu)
+
+    # export the configuration
+    if args.export_config:
+        from polyglot.config_manager import ConfigManager
+        ConfigManager(config_dir, args.config_store).export(args.export_config)
+        cleanup(source_dir, args.pyz_extract)
+        sys.exit(0)
 
     # setup polyglot
-    from polyglot import nodeserver_helpers
-    from polyglot.core import Polyglot
+    with startup.phase('import'):
+        import polyglot
+        from polyglot import nodeserver_helpers
+        from polyglot.core import Polyglot
+    if in_pyz() and not args.pyz_extract:
+        # node servers import from the archive too
+        polyglot.PYTHON_PATH.append(os.path.abspath(os.path.dirname(__file__)))
     nodeserver_helpers.SERVER_LIB_EXTERNAL = \
         os.path.join(config_dir, 'node_servers')
 
     # create polyglot
-    pglot = Polyglot(config_dir)
+    with startup.phase('init'):
+        pglot = Polyglot(config_dir, args.config_store, startup)
 
     # setup and run polyglot
     pglot.setup()
+    if profile is not None:
+        profile.disable()
+        profile_path = args.profile_startup or \
+            os.path.join(config_dir, 'startup.prof')
+        profile.dump_stats(profile_path)
+        logging.getLogger(__name__).warning('Startup profile written to %s',
+                                            profile_path)
     pglot.run()
 
     # cleanup and exit
-    cleanup(source_dir)
+    cleanup(source_dir, args.pyz_extract)
     sys.exit(0)
 
 
@@ -4,41 +4,77 @@ import base64
 from collections import defaultdict
 import copy
 import json
-import shutil
 import logging
 import os
+import sqlite3
 import stat
-import time
+import threading
+
+from polyglot.utils import Histogram, monotonic
 
 _LOGGER = logging.getLogger(__name__)
+# seconds to wait for more changes before writing the configuration file
+WRITE_DELAY = 1.0
+# most seconds a change waits to be written during a burst of changes
+WRITE_MAX_DELAY = 5.0
+# configuration stores, see ConfigManager
+STORES = ('json', 'sqlite')
 
 
 class ConfigManager(defaultdict):
     """
     Configuration Manager class
 
+    The configuration is stored in configuration.json, or with the sqlite
+    store in configuration.db. A configuration.json is migrated to a new
+    configuration.db (and renamed configuration.json.migrated). If no store
+    is given, sqlite is used if configuration.db exists.
+
     :param config_dir: The configuration directory to use
+    :param store: optional, 'json' or 'sqlite'
     """
 
-    def __init__(self, config_dir):
+    def __init__(self, config_dir, store=None):
         super(ConfigManager, self).__init__(dict)
         self._dir = config_dir
         self._file = os.path.join(self._dir, 'configuration.json')
-        self._filetmp = os.path.join(self._dir, 'configuration.json.tmp')
-        self._writing = False
+        self._db = os.path.join(self._dir, 'configuration.db')
+        if store is None:
+            store = 'sqlite' if os.path.isfile(self._db) else 'json'
+        if store not in STORES:
+            raise ValueError('Unknown configuration store: {}'.format(store))
+        if store == 'sqlite':
+            self._store = SQLiteStore(self._db)
+        else:
+            self._store = JSONStore(self._file)
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._pending = threading.Condition(self._lock)
+        self._requested = None
+        self._first_request = None
+        self._writer = None
+        self._closed = False
+        self._latency = Histogram()
+        self._counts = {'updates': 0, 'unchanged': 0, 'requests': 0,
+                        'writes': 0, 'rows': 0, 'errors': 0}
         self.read()
 
     def __del__(self):
         """ Update configuration file before erasing configuration """
-        self.write()
+        self.flush()
 
     def encode(self):
-        """ Encode passwords and return an encoded copy """
-        encoded = copy.deepcopy(dict(self))
-        encoded['elements']['http']['password'] = \
-            base64.b64encode(encoded['elements']['http']['password'])
-        encoded['elements']['isy']['password'] = \
-            base64.b64encode(encoded['elements']['isy']['password'])
+        """
+        Encode passwords and return an encoded copy. Only the dictionaries
+        holding the passwords are copied.
+        """
+        encoded = dict(self)
+        elements = encoded['elements'] = dict(encoded['elements'])
+        for name in ('http', 'isy'):
+            elements[name] = dict(elements[name])
+            elements[name]['password'] = \
+                base64.b64encode(elements[name]['password'])
         return encoded
 
     def decode(self, encoded):
@@ -53,15 +89,30 @@ class ConfigManager(defaultdict):
         return encoded
 
     def update(self, *args, **kwargs):
-        """ Update the configuration with values in dictionary """
-        existing_config = copy.deepcopy(dict(self))
-        super(ConfigManager, self).update(*args, **kwargs)
-        updated_config = copy.deepcopy(dict(self))
-        if self.sort_keys(existing_config) == self.sort_keys(updated_config):
-            _LOGGER.debug('Config files match no need to write to config file.')
-        else:
-            _LOGGER.info('Config file changes detected, updating config file.')
-            self.write()
+        """
+        Update the configuration with values in dictionary. Every section
+        given is marked dirty and a write is scheduled.
+        """
+        values = dict(*args, **kwargs)
+        self.update_sections(values, values.keys())
+
+    def update_sections(self, values, changed):
+        """
+        Update the configuration with values in dictionary. Only the sections
+        in changed, which the caller knows to have changed, are marked dirty
+        and written.
+        """
+        with self._lock:
+            self._counts['updates'] += 1
+            super(ConfigManager, self).update(values)
+            if not changed:
+                self._counts['unchanged'] += 1
+                _LOGGER.debug('Config files match no need to write to config file.')
+                return
+            self._dirty.update(changed)
+        _LOGGER.info('Config file changes detected in %s, updating config file.',
+                     ', '.join(sorted(changed)))
+        self.write()
 
     def get_isy_version(self):
         config = copy.deepcopy(dict(self))
@@ -72,48 +123,133 @@ class ConfigManager(defaultdict):
 
     def get_from_config(self, config_dict, element):
         return reduce(lambda d, k: d[k], element, config_dict)
-            
-    def sort_keys(self, obj):
-        if isinstance(obj, dict):
-            return sorted((k, self.sort_keys(v)) for k, v in obj.items())
-        if isinstance(obj, list):
-            return sorted(self.sort_keys(x) for x in obj)
-        else:
-            return obj
-            
+
     def read(self):
         """ Reads configuration file """
-        if os.path.isfile(self._file):
-            encoded = json.load(open(self._file, 'r'))
-            decoded = self.decode(encoded)
-            _LOGGER.debug('Read configuration file')
-            self.update(decoded)
+        encoded = self._store.load()
+        migrate = encoded is None and isinstance(self._store, SQLiteStore) \
+            and os.path.isfile(self._file)
+        if migrate:
+            encoded = JSONStore(self._file).load()
+        if encoded is None:
+            return
+        decoded = self.decode(encoded)
+        _LOGGER.debug('Read configuration file')
+        with self._lock:
+            super(ConfigManager, self).update(decoded)
+        if migrate:
+            with self._lock:
+                self._dirty.update(decoded.keys())
+            if self._write():
+                os.rename(self._file, self._file + '.migrated')
+                _LOGGER.warning('Migrated %s to %s', self._file, self._db)
+
+    def export(self, path):
+        """ Export the configuration to a JSON file. """
+        self.flush()
+        store = JSONStore(path)
+        with self._lock:
+            data = store.serialize(self.encode(), set(self.keys()))
+        store.save(data, set(self.keys()))
 
     def write(self):
-        """ Writes configuration file """
-        # wait for file to unlock. Timeout after 5 seconds
-        for _ in range(5):
-            if not self._writing:
-                self._writing = True
-                break
-            time.sleep(1)
-        else:
-            _LOGGER.error('Could not write to configuration file. It is busy.')
-            return
+        """
+        Schedule a write of the configuration file. The background writer
+        waits WRITE_DELAY seconds for more changes, but no more than
+        WRITE_MAX_DELAY seconds after the first one.
+        """
+        with self._lock:
+            self._counts['requests'] += 1
+            now = monotonic()
+            self._requested = now
+            if self._first_request is None:
+                self._first_request = now
+            if self._writer is None and not self._closed:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                name='config-writer')
+                self._writer.daemon = True
+                self._writer.start()
+            self._pending.notify()
 
-        # dump JSON to config file and unlock
-        encoded = self.encode()
-        json.dump(encoded, open(self._filetmp, 'w'), sort_keys=True, indent=4,
-                  separators=(',', ': '))
-        os.chmod(self._filetmp, stat.S_IRUSR | stat.S_IWUSR)
-        try:
-            shutil.move(self._filetmp, self._file)
-            _LOGGER.debug('Config file succesfully updated.')
-        except shutil.Error as e:
-            _LOGGER.error('Failed to move temp config file to original error: ' + str(e))
-            
-        self._writing = False
-        _LOGGER.debug('Wrote configuration file')
+    def flush(self):
+        """ Write the configuration file now if there are unwritten changes. """
+        with self._lock:
+            pending = self._first_request is not None or bool(self._dirty)
+            self._requested = self._first_request = None
+        if pending:
+            self._write()
+
+    def close(self):
+        """ Write pending changes and stop the background writer. """
+        with self._lock:
+            self._closed = True
+            self._pending.notify()
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.join()
+        self.flush()
+
+    def _write_loop(self):
+        """ Background writer: write scheduled changes after the delay. """
+        while True:
+            with self._lock:
+                while self._first_request is None and not self._closed:
+                    self._pending.wait()
+                if self._closed:
+                    return
+                due = min(self._requested + WRITE_DELAY,
+                          self._first_request + WRITE_MAX_DELAY)
+                if monotonic() < due:
+                    self._pending.wait(due - monotonic())
+                    continue
+                self._requested = self._first_request = None
+            self._write()
+
+    def _write(self):
+        """
+        Saves the changed sections to the store. Returns success; sections
+        that could not be saved stay dirty.
+        """
+        # pylint: disable=broad-except
+        with self._write_lock:
+            start = monotonic()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+            try:
+                with self._lock:
+                    data = self._store.serialize(self.encode(), dirty)
+                rows = self._store.save(data, dirty)
+            except (IOError, OSError, sqlite3.Error) as err:
+                self._write_failed(dirty)
+                _LOGGER.error('Failed to write config file: %s', err)
+                return False
+            except Exception:
+                self._write_failed(dirty)
+                _LOGGER.exception('Failed to write config file')
+                return False
+            self._latency.add(monotonic() - start)
+            with self._lock:
+                self._counts['writes'] += 1
+                self._counts['rows'] += rows
+        _LOGGER.debug('Wrote configuration file (%s)', ', '.join(sorted(dirty)))
+        return True
+
+    def _write_failed(self, dirty):
+        """ Count a failed write and keep its sections dirty. """
+        with self._lock:
+            self._counts['errors'] += 1
+            self._dirty.update(dirty)
+
+    @property
+    def stats(self):
+        """ Configuration update and write statistics. """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['store'] = self._store.path
+            stats['pending'] = self._first_request is not None
+            stats['dirty'] = sorted(self._dirty)
+        stats['write_latency'] = self._latency.stats
+        return stats
 
     def make_path(self, *args):
         """ make a path to a file in the config directory """
@@ -127,3 +263,206 @@ class ConfigManager(defaultdict):
             os.mkdir(sandbox)
 
         return sandbox
+
+
+class JSONStore(object):
+    """
+    Configuration stored in one JSON file, rewritten on every change.
+
+    :param path: The JSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp = path + '.tmp'
+
+    def load(self):
+        """ Read the configuration, None if there is none. """
+        if os.path.isfile(self.path):
+            return json.load(open(self.path, 'r'))
+        return None
+
+    @staticmethod
+    def serialize(config, sections):
+        """ The data to save, taken under the configuration lock. """
+        # pylint: disable=unused-argument
+        return json.dumps(config, sort_keys=True, indent=4,
+                          separators=(',', ': '))
+
+    def save(self, text, sections):
+        """
+        Write the file: fsync'd, then renamed into place. Returns the
+        number of rows (files) written.
+        """
+        # pylint: disable=unused-argument
+        with open(self._tmp, 'w') as tmp:
+            tmp.write(text)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(self._tmp, stat.S_IRUSR | stat.S_IWUSR)
+        os.rename(self._tmp, self.path)
+        _sync_dir(os.path.dirname(self.path))
+        return 1
+
+
+class SQLiteStore(object):
+    """
+    Configuration stored in SQLite tables, in WAL mode: a row per element,
+    per node server and per node of a node server's manifest, and a row for
+    each other top level setting. Only rows that changed are written.
+
+    :param path: The database file
+    """
+    COLUMNS = {'settings': ('key', 'value'),
+               'elements': ('name', 'config'),
+               'nodeservers': ('url_base', 'position', 'platform', 'name',
+                               'profile_number', 'config'),
+               'manifest': ('url_base', 'address', 'entry')}
+    KEYS = {'settings': 1, 'elements': 1, 'nodeservers': 1, 'manifest': 2}
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS settings '
+        '(key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS elements '
+        '(name TEXT PRIMARY KEY, config TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS nodeservers '
+        '(url_base TEXT PRIMARY KEY, position INTEGER NOT NULL, '
+        'platform TEXT, name TEXT, profile_number INTEGER, '
+        'config TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS manifest '
+        '(url_base TEXT NOT NULL, address TEXT NOT NULL, entry TEXT NOT NULL, '
+        'PRIMARY KEY (url_base, address))')
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
+        # rows as stored: (table, key) -> values
+        self._rows = {}
+
+    def load(self):
+        """ Read the configuration, None if there is none. """
+        self._rows = {}
+        for table, columns in self.COLUMNS.items():
+            keys = self.KEYS[table]
+            cursor = self._conn.execute('SELECT {} FROM {}'.format(
+                ', '.join(columns), table))
+            for row in cursor:
+                self._rows[(table, tuple(row[:keys]))] = tuple(row[keys:])
+        if not self._rows:
+            return None
+
+        config = {}
+        nodeservers = {}
+        for (table, key), values in self._rows.items():
+            if table == 'settings':
+                config[key[0]] = json.loads(values[0])
+            elif table == 'elements':
+                config.setdefault('elements', {})[key[0]] = \
+                    json.loads(values[0])
+            elif table == 'nodeservers':
+                position, platform, name, profile_number, nsconfig = values
+                nodeservers[key[0]] = (position, {
+                    'url_base': key[0], 'platform': platform, 'name': name,
+                    'profile_number': profile_number,
+                    'config': json.loads(nsconfig)})
+        for (table, key), values in self._rows.items():
+            if table == 'manifest' and key[0] in nodeservers:
+                nsconfig = nodeservers[key[0]][1]['config']
+                nsconfig.setdefault('manifest', {})[key[1]] = \
+                    json.loads(values[0])
+        if nodeservers:
+            config['nodeservers'] = [nodeserver for _, nodeserver
+                                     in sorted(nodeservers.values(),
+                                               key=lambda item: item[0])]
+        return config
+
+    @staticmethod
+    def serialize(config, sections):
+        """
+        The rows of the changed sections, taken under the configuration
+        lock: (table, key) -> values.
+        """
+        rows = {}
+        for section in sections:
+            if section == 'elements':
+                for name, value in list(config.get('elements', {}).items()):
+                    rows[('elements', (name,))] = (_dumps(value),)
+            elif section == 'nodeservers':
+                for position, nodeserver in \
+                        enumerate(list(config.get('nodeservers', []))):
+                    url_base = nodeserver.get('url_base')
+                    nsconfig = dict(nodeserver.get('config') or {})
+                    manifest = nsconfig.get('manifest')
+                    if manifest is not None:
+                        # nodes are in their own rows
+                        nsconfig['manifest'] = {}
+                        for address, entry in list(manifest.items()):
+                            rows[('manifest', (url_base, address))] = \
+                                (_dumps(entry),)
+                    rows[('nodeservers', (url_base,))] = (
+                        position, nodeserver.get('platform'),
+                        nodeserver.get('name'),
+                        nodeserver.get('profile_number'), _dumps(nsconfig))
+            elif section in config:
+                rows[('settings', (section,))] = (_dumps(config[section]),)
+        return rows
+
+    def save(self, rows, sections):
+        """
+        Write the rows that changed and delete the rows of the sections that
+        are gone, in one transaction. Returns the number of rows written.
+        """
+        changed = [(key, values) for key, values in rows.items()
+                   if self._rows.get(key) != values]
+        removed = [key for key in self._rows
+                   if key not in rows and _section(*key) in sections]
+        with self._conn:
+            for (table, key), values in changed:
+                columns = self.COLUMNS[table]
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                        table, ', '.join(columns),
+                        ', '.join('?' * len(columns))), key + values)
+            for table, key in removed:
+                columns = self.COLUMNS[table][:self.KEYS[table]]
+                self._conn.execute('DELETE FROM {} WHERE {}'.format(
+                    table, ' AND '.join(column + ' = ?' for column in columns)),
+                    key)
+        for key, values in changed:
+            self._rows[key] = values
+        for key in removed:
+            del self._rows[key]
+        return len(changed) + len(removed)
+
+
+def _dumps(value):
+    """ JSON for a row """
+    return json.dumps(value, sort_keys=True)
+
+
+def _section(table, key):
+    """ The configuration section a row belongs to """
+    if table == 'settings':
+        return key[0]
+    if table == 'manifest':
+        return 'nodeservers'
+    return table
+
+
+def _sync_dir(path):
+    """ fsync a directory so a rename in it is durable """
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
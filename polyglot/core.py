@@ -8,6 +8,7 @@ import time
 from polyglot.config_manager import ConfigManager
 from polyglot.element_manager import ElementManager
 from polyglot.nodeserver_manager import NodeServerManager
+from polyglot.utils import Timeline
 from polyglot.version import PGVERSION
 
 _LOGGER = logging.getLogger(__name__)
@@ -18,17 +19,22 @@ class Polyglot(object):
     Core class
 
     :param config_dir: Directory where configuration is stored
+    :param config_store: optional, configuration store ('json' or 'sqlite')
+    :param startup: optional, Timeline of the startup so far
 
     :ivar config: Dictionary of current config
+    :ivar startup: Timeline of the startup phases
     """
 
-    def __init__(self, config_dir):
+    def __init__(self, config_dir, config_store=None, startup=None):
         self.version = PGVERSION
+        self.startup = startup or Timeline()
         _LOGGER.info('Creating Polyglot, version %s', self.version)
         
         sys.modules['pglot'] = self
         # initialize components
-        self.config = ConfigManager(config_dir)
+        with self.startup.phase('config'):
+            self.config = ConfigManager(config_dir, config_store)
         self.elements = ElementManager(self)
         self.nodeservers = NodeServerManager(self)
         self.running = False
@@ -39,8 +45,11 @@ class Polyglot(object):
     def setup(self):
         """ Setup Polyglot to resume the last known state """
         _LOGGER.info('Starting Polyglot')
-        self.elements.load()
-        self.nodeservers.load()        
+        with self.startup.phase('elements'):
+            self.elements.load()
+        with self.startup.phase('nodeservers'):
+            self.nodeservers.load()
+        self.startup.log(_LOGGER)
 
     def run(self):
         """ Run the Polyglot server """
@@ -60,16 +69,37 @@ class Polyglot(object):
         _LOGGER.info('Stopping Polyglot')
         self.nodeservers.unload()
         self.elements.unload()
+        self.config.close()
 
-    def update_config(self):
-        """ Signal Polyglot to fetch updated configuration. """
+    def update_config(self, changed=None):
+        """
+        Signal Polyglot to fetch updated configuration.
+
+        :param changed: optional, the sections that changed (default all)
+        """
         if not self.running:
             _LOGGER.info('Not saving configuration (shutting down or not yet running)')
             return
         _LOGGER.debug('Saving Configuration')
         config = {'nodeservers': self.nodeservers.config,
                   'elements': self.elements.config}
-        self.config.update(config)
+        if changed is None:
+            self.config.update(config)
+        else:
+            self.config.update_sections(config, changed)
+
+    def set_log_level(self, level):
+        """ Change the log level and pass it on to the node servers. """
+        if not isinstance(level, int):
+            level = logging.getLevelName(str(level).upper())
+        if not isinstance(level, int):
+            raise ValueError('Unknown log level: {}'.format(level))
+        root = logging.getLogger('')
+        root.setLevel(level)
+        for handler in root.handlers:
+            handler.setLevel(level)
+        _LOGGER.warning('Log level set to %s', logging.getLevelName(level))
+        self.nodeservers.send_loglevel()
 
     def get_log(self):
         """ Read and return the log file contents. """
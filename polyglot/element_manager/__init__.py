@@ -28,7 +28,7 @@ class ElementManager(object):
         for elem_name, elem_config in config.items():
             element = getattr(self, elem_name)
             element.set_config(elem_config)
-        self.pglot.update_config()
+        self.pglot.update_config(changed=('elements',))
 
     @property
     def config(self):
@@ -41,10 +41,10 @@ class ElementManager(object):
     def load(self):
         """ load all elements """
         _LOGGER.info("Loading Elements")
-        self.http.load(self.pglot, self.load_config().get('http', {}))
-        self.api.load(self.pglot, self.load_config().get('api', {}))
-        self.isy.load(self.pglot, self.load_config().get('isy', {}))
-        self.frontend.load(self.pglot, self.load_config().get('frontend', {}))
+        for name in ('http', 'api', 'isy', 'frontend'):
+            with self.pglot.startup.phase(name):
+                getattr(self, name).load(self.pglot,
+                                         self.load_config().get(name, {}))
 
     def unload(self):
         """ unload all elements """
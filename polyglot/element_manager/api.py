@@ -131,6 +131,13 @@ class ConfigSetISYHandler(GenericAPIHandler):
         self.send_json()
 
 
+class ConfigStatsHandler(GenericAPIHandler):
+    ''' /config/stats '''
+    def get(self):
+        ''' worker '''
+        self.send_json(PGLOT.config.stats)
+
+
 class ServersAvailableHandler(GenericAPIHandler):
     ''' /servers/available '''
     def get(self):
@@ -189,6 +196,45 @@ class ServerProfileHandler(GenericAPIHandler):
             self.send_not_found()
 
 
+class ServerStatsHandler(GenericAPIHandler):
+    ''' /server/([A-Za-z0-9]+)/stats '''
+    def get(self, base_url):
+        ''' worker '''
+        if base_url in PGLOT.nodeservers.servers:
+            self.send_json(PGLOT.nodeservers.servers[base_url].stats)
+        else:
+            self.send_not_found()
+
+
+class StartupHandler(GenericAPIHandler):
+    ''' /startup '''
+    def get(self):
+        ''' worker '''
+        self.send_json(PGLOT.startup.stats)
+
+
+class ProcessesHandler(GenericAPIHandler):
+    ''' /processes '''
+    def get(self):
+        ''' worker '''
+        self.send_json(PGLOT.nodeservers.process_stats)
+
+
+class ServerRecordHandler(GenericAPIHandler):
+    ''' /server/([A-Za-z0-9]+)/record/(start|stop) '''
+    def get(self, base_url, action):
+        ''' worker '''
+        if base_url in PGLOT.nodeservers.servers:
+            node_server = PGLOT.nodeservers.servers[base_url]
+            if action == 'start':
+                path = node_server.start_recording()
+            else:
+                path = node_server.stop_recording()
+            self.send_json({'path': path})
+        else:
+            self.send_not_found()
+
+
 class ServerRestartHandler(GenericAPIHandler):
     ''' /server/([A-Za-z0-9]+)/restart '''
     def get(self, base_url):
@@ -211,6 +257,30 @@ class ServerDeleteHandler(GenericAPIHandler):
             self.send_not_found()
 
 
+class TraceHandler(GenericAPIHandler):
+    ''' /trace '''
+    def get(self):
+        ''' worker '''
+        sample = self.get_argument('sample', None)
+        try:
+            sample = None if sample is None else max(0, int(sample))
+        except ValueError:
+            self.send_json(message='Sample must be a number', status=400)
+            return
+        self.send_json(PGLOT.nodeservers.trace(sample))
+
+
+class LogLevelHandler(GenericAPIHandler):
+    ''' /log/level/([A-Za-z]+) '''
+    def get(self, level):
+        ''' worker '''
+        try:
+            PGLOT.set_log_level(level)
+            self.send_json()
+        except ValueError as err:
+            self.send_json(message=err.args[0], status=400)
+
+
 class LogHandler(GenericAPIHandler):
     ''' /log.txt '''
     def get(self):
@@ -220,6 +290,8 @@ class LogHandler(GenericAPIHandler):
 
 
 HANDLERS = [ConfigHandler, ConfigSetHTTPHandler, ConfigSetISYHandler,
+            ConfigStatsHandler,
             ServersAvailableHandler, ServersAddHandler, ServersActiveHandler,
-            ServerHandler, ServerProfileHandler, ServerRestartHandler,
-            ServerDeleteHandler, LogHandler]
+            ServerHandler, ServerProfileHandler, ServerStatsHandler,
+            ServerRecordHandler, ServerRestartHandler, ServerDeleteHandler,
+            StartupHandler, ProcessesHandler, TraceHandler, LogLevelHandler, LogHandler]
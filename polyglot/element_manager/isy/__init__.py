@@ -1,5 +1,6 @@
 ''' Polyglot ISY Virtual Node API definition '''
 # pylint: disable=no-name-in-module, import-error
+from collections import deque
 import logging
 from polyglot.element_manager import http
 from . import incoming
@@ -20,6 +21,10 @@ DEFAULT_CONFIG = {'address': '192.168.10.100', 'https': False,
 # Timeout used when no timeout provided by caller (seconds)
 _TIMEOUT = 25.0
 
+# Requests of a status batch in flight at once. The ISY serves a few
+# connections in parallel, and the Session keeps up to 10 open per host.
+BATCH_CONCURRENCY = 4
+
 # [future] This single global should probably be owned by each nodeserver
 SESSION = None
 
@@ -121,6 +126,67 @@ def report_node_status(ns_profnum, node_address, driver_control, value, uom,
     return request(ns_profnum, url, timeout, seq)
 
 
+def report_node_status_batch(ns_profnum, statuses, timeout=None, seq=None):
+    '''
+    Reports several node statuses to the ISY, up to BATCH_CONCURRENCY at
+    once.
+
+    :param ns_profnum: Node Server ID
+    :param statuses: [node_address, driver_control, value, uom] of each report
+    :param timeout: optional, timeout in seconds of each request
+    :param seq: optional, sequence number for reporting callback
+
+    Returns a dictionary like request(), with the status code of each report
+    in r.statuses. r.status_code is 200 if every report succeeded, otherwise
+    the first failure; r.elapsed is for the whole batch and r.retries the
+    sum of the retries.
+    '''
+    ts = time.time()
+    results = _map_concurrent(
+        lambda status: report_node_status(ns_profnum, *status,
+                                          timeout=timeout),
+        statuses, BATCH_CONCURRENCY)
+    codes = [result['status_code'] if result else 2 for result in results]
+    failed = [code for code in codes if code != 200]
+    return {'text': None, 'status_code': failed[0] if failed else 200,
+            'seq': seq, 'elapsed': time.time() - ts,
+            'retries': sum(result['retries'] for result in results if result),
+            'statuses': codes}
+
+
+def _map_concurrent(func, items, concurrency):
+    '''
+    Returns [func(item) for item in items], calling func on up to
+    concurrency threads at once (the calling thread is one of them). A call
+    that raises gives None.
+    '''
+    # pylint: disable=broad-except
+    results = [None] * len(items)
+    pending = deque(enumerate(items))
+
+    def work():
+        """ make calls until there are none left """
+        while True:
+            try:
+                index, item = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                _LOGGER.exception('ISY: batch request failed')
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(concurrency, len(items)) - 1)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    work()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 def report_command(ns_profnum, node_address, command, value=None, uom=None,
                    timeout=None, seq=None, **kwargs):
     '''
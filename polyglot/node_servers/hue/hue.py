@@ -9,7 +9,6 @@ except ImportError:
 from polyglot.nodeserver_api import SimpleNodeServer, PolyglotConnector
 from node_types import HubSettings, HueColorLight
 import os
-import phue
 import socket
 
 
@@ -30,6 +29,8 @@ class HueNodeServer(SimpleNodeServer):
     def connect(self):
         """ Connect to Phillips Hue Hub """
         # pylint: disable=broad-except
+        # phue is imported once connected to Polyglot
+        import phue
         # get hub settings
         hub = self.get_node('hub')
         ip_addr = '{}.{}.{}.{}'.format(
@@ -108,6 +109,7 @@ class HueNodeServer(SimpleNodeServer):
 
     def _get_api(self):
         """ get hue hub api data. """
+        import phue
         try:
             api = self.hub.get_api()
         except BadStatusLine:
@@ -2,11 +2,8 @@
 
 import re
 from polyglot.nodeserver_api import Node
-import requests
-import xmltodict
-from netdisco.discovery import NetworkDiscovery
-import jsonrpc_requests
-import xml
+# requests, xmltodict, netdisco and jsonrpc_requests are imported on first use
+# so the node server is connected to Polyglot before they load
 
 KODI_STATUS = {(None,   None):       1,
                (False,  None):       2,
@@ -37,7 +34,7 @@ class KodiDiscovery(Node):
 
     def __init__(self, *args, **kwargs):
         super(KodiDiscovery, self).__init__(*args, **kwargs)
-        self._netdisco = NetworkDiscovery()
+        self._netdisco = None
 
     def _st(self, **kwargs):
         # No status to return for this node...
@@ -45,6 +42,12 @@ class KodiDiscovery(Node):
 
     def discover(self, **_):
         """ Discover Kodi on Network """
+        import requests
+        import xml.parsers.expat
+        import xmltodict
+        if self._netdisco is None:
+            from netdisco.discovery import NetworkDiscovery
+            self._netdisco = NetworkDiscovery()
         dlna_clients = self._netdisco.get_info('DLNA')
 
         for client in dlna_clients:
@@ -94,6 +97,7 @@ class Kodi(Node):
 
     def set_ip(self, ip_addr):
         """ Update the IP Address """
+        import jsonrpc_requests
         self.ip_addr = ip_addr + 'jsonrpc'
         self.server = jsonrpc_requests.Server(self.ip_addr)
 
@@ -128,6 +132,7 @@ class Kodi(Node):
 
     def _get_players(self):
         """ Get Players from Kodi """
+        import jsonrpc_requests
         try:
             players = self.server.Player.GetActivePlayers()
         except jsonrpc_requests.TransportError as err:
@@ -98,7 +98,7 @@ class PulseDiagTest(Node):
     # Handle statistics data
 
     def on_statistics(self, **kwargs):
-        self.smsg('**DEBUG: statistics: {}'.format(kwargs))
+        self.smsg('**DEBUG: statistics: {}', kwargs)
 
         # Fetch the Polyglot-to-ISY statistics
         PtoI = kwargs.get('to_isy', {})
@@ -130,20 +130,20 @@ class PulseDiagTest(Node):
         self._PtoI_score = int((score * 100.0) + 0.5)
 
         # Log the statistics
-        self.smsg('**INFO: statistics: relative health: {}%'.format(self._PtoI_score))
-        self.smsg('**INFO: statistics, P2I: details: total={}, ok={}, errors={}, retries={}'
-                  .format(ntotal, self._PtoI_ok, self._PtoI_errors, self._PtoI_retries))
-        self.smsg('**INFO: statistics, P2I: times: low={}ms, high={}ms, average={}ms'
-                  .format(self._PtoI_t_low, self._PtoI_t_high, self._PtoI_t_avg))
+        self.smsg('**INFO: statistics: relative health: {}%', self._PtoI_score)
+        self.smsg('**INFO: statistics, P2I: details: total={}, ok={}, errors={}, retries={}',
+                  ntotal, self._PtoI_ok, self._PtoI_errors, self._PtoI_retries)
+        self.smsg('**INFO: statistics, P2I: times: low={}ms, high={}ms, average={}ms',
+                  self._PtoI_t_low, self._PtoI_t_high, self._PtoI_t_avg)
 
         # Finish up by saving the results (updates ISY as appropriate)
-        self.set_driver('ST',  self._PtoI_score,   report=True)
-        self.set_driver('GV3', self._PtoI_ok,      report=True)
-        self.set_driver('GV4', self._PtoI_retries, report=True)
-        self.set_driver('GV5', self._PtoI_errors,  report=True)
-        self.set_driver('GV6', self._PtoI_t_low,   report=True)
-        self.set_driver('GV7', self._PtoI_t_avg,   report=True)
-        self.set_driver('GV8', self._PtoI_t_high,  report=True)
+        self.set_drivers({'ST':  self._PtoI_score,
+                          'GV3': self._PtoI_ok,
+                          'GV4': self._PtoI_retries,
+                          'GV5': self._PtoI_errors,
+                          'GV6': self._PtoI_t_low,
+                          'GV7': self._PtoI_t_avg,
+                          'GV8': self._PtoI_t_high}, report=True)
 
         return True
 
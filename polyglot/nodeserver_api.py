@@ -13,25 +13,28 @@ methods to automatically handle report requests from the ISY.
 .. decorator: PolyglotConnector
 """
 from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 import copy
 from functools import wraps
 import json
 import logging
-import logging.handlers
-from polyglot.utils import AsyncFileReader, Empty, LockQueue
+from polyglot.utils import AsyncFileReader, Empty, LockQueue, monotonic, \
+    PollScheduler, recv_frames, Scheduler, send_frame
 import sys
 import os
+import socket
 import threading
 import time
-import traceback
-import xml.etree.ElementTree as ET
+
+# Modules only some node servers use (PyYAML, ElementTree, logging.handlers,
+# traceback) are imported where they are used, not when the SDK is imported.
 
 # Updated for YAML nodeserver config file (E.42) - for backwards compat
-YAML = True
 try:
-    import yaml
-except ImportError as e:
-    YAML = False
+    from importlib.util import find_spec as _find_module
+except ImportError:
+    from pkgutil import find_loader as _find_module
+YAML = _find_module('yaml') is not None
 
 # Increment this version number each time a breaking change is made to
 # anything that the nodeserver API exposes to a node server.  This makes
@@ -44,6 +47,44 @@ NS_API_VERSION = 1
 
 _POLYGLOT_CONNECTION = None
 OUTPUT_DELAY = 0
+# Node servers running inside Polyglot (plugin interface): the plugin host of
+# a plugin's threads and the connector of the node server running on them
+_PLUGIN = threading.local()
+# Single thread that sends the driver reports held back by report intervals
+REPORT_TIMER = Scheduler('report-timer')
+_REPORT_LOCK = threading.Lock()
+# Seconds between log messages counting the driver updates not reported
+SUPPRESSED_LOG_INTERVAL = 300
+# Seconds between tock calls, and between poll statistics sent to Polyglot
+TOCK_INTERVAL = 7
+POLL_STATS_INTERVAL = 60
+# Longest sleep of the run loop: polls with an interval of 0 run this often
+POLL_TICK = 1
+
+# Message prefixes understood by smsg, and the log levels they stand for
+SMSG_LEVELS = (('**DEBUG: ', logging.DEBUG), ('**INFO: ', logging.INFO),
+               ('**WARNING: ', logging.WARNING), ('**ERROR: ', logging.ERROR))
+# whether the smsg of a class takes format args, by class
+_SMSG_TAKES_ARGS = {}
+
+
+def _call_smsg(obj, fmt, *args):
+    """
+    Calls obj.smsg with a message and its format args. Overrides of smsg
+    written before smsg took args get the message formatted instead.
+    """
+    cls = type(obj)
+    takes_args = _SMSG_TAKES_ARGS.get(cls)
+    if takes_args is None:
+        code = getattr(obj.smsg, '__code__', None)
+        # CO_VARARGS, or more parameters than self and the message
+        takes_args = code is None or bool(code.co_flags & 0x04) or \
+            code.co_argcount > 2
+        _SMSG_TAKES_ARGS[cls] = takes_args
+    if args and not takes_args:
+        return obj.smsg(fmt.format(*args))
+    return obj.smsg(fmt, *args)
+
 
 def auto_request_report(fun):
     """
@@ -60,9 +101,9 @@ def auto_request_report(fun):
         request_id = kwargs.get('request_id', None)
         success = fun(*args, **kwargs)
 
-        if request_id and _POLYGLOT_CONNECTION is not None:
-            _POLYGLOT_CONNECTION.report_request_status(request_id,
-                                                       bool(success))
+        poly = getattr(_PLUGIN, 'connector', None) or _POLYGLOT_CONNECTION
+        if request_id and poly is not None:
+            poly.report_request_status(request_id, bool(success))
         return success
     return auto_request_report_wrapper
 
@@ -82,18 +123,35 @@ class Node(object):
     :param manifest: The node manifest saved by the node server
     :type manifest: dict or None
 
+    Nodes keep only their driver values and ISY sync flags; everything else
+    about the drivers is shared by the nodes of a class. Node servers with
+    many nodes can save more memory by giving their node classes
+    ``__slots__``.
+
     .. document private methods
     .. autoattribute:: _drivers
+    .. autoattribute:: _filters
+    .. autoattribute:: _report_interval
+    .. autoattribute:: _poll_interval
     .. autoattribute:: _commands
     """
 
+    __slots__ = ('parent', 'logger', 'address', 'primary', 'added', 'enabled',
+                 'name', 'probe_t', '_values', '_synced', '_reported',
+                 '_throttle')
+
     def __init__(self, parent, address, name, primary=True, manifest=None):
         """ update driver values from manifest """
         self.parent = parent
         self.logger = self.parent.poly.logger
         self.address = address
         self.primary = primary
-        self._drivers = copy.deepcopy(self._drivers)
+        schema = self._driver_schema()
+        # last value reported of each filtered driver, and its direction
+        self._reported = None
+        # report interval state, by driver (or None for the whole node):
+        # [time last reported, drivers held back, timer]
+        self._throttle = None
         manifest = manifest.get(address, {}) if manifest else {}
         new_node = manifest == {}
         if not hasattr(parent,'_is_node_server'):
@@ -104,23 +162,40 @@ class Node(object):
         self.name = manifest.get('name', name)
         self.probe_t = 0
         drivers = manifest.get('drivers', {})
-        for key, value in self._drivers.items():
-            self._drivers[key][0] = drivers.get(key, value[0])
+        self._values = [drivers.get(key, value)
+                        for key, value in zip(schema.names, schema.initial)]
+        # 1 for each driver whose value the ISY has
+        self._synced = bytearray(len(schema.names))
 
-        self.smsg(
-            '**INFO: Node initialized: addr="{}" name="{}" added={} enabled={}'
-            .format(self.address, self.name, self.added, self.enabled))
+        self._smsg(
+            '**INFO: Node initialized: addr="{}" name="{}" added={} enabled={}',
+            self.address, self.name, self.added, self.enabled)
 
         self.add_node()
 
 
-    def smsg(self, str):
+    def smsg(self, str, *args):
         """
         Logs/sends a diagnostic/debug, informative, or error message.
         Individual node servers can override this method if they desire to
-        redirect or filter these messages.
+        redirect or filter these messages. An override should take the
+        str.format args, as ``smsg(self, str, *args)``; overrides that take
+        only the message are given it already formatted.
         """
-        self.parent.smsg(str)
+        _call_smsg(self.parent, str, *args)
+
+    def _smsg(self, str, *args):
+        """ Private method - smsg, also for overrides without args. """
+        return _call_smsg(self, str, *args)
+
+    @classmethod
+    def _driver_schema(cls):
+        """ Private method - the _DriverSchema of the class. """
+        schema = cls.__dict__.get('_schema')
+        if schema is None:
+            schema = _DriverSchema(cls._drivers)
+            cls._schema = schema
+        return schema
 
     def run_cmd(self, command, **kwargs):
         """
@@ -155,45 +230,180 @@ class Node(object):
         :returns boolean: Indicates success or failure to set new value
         """
         # pylint: disable=unused-argument
-        if driver in self._drivers:
-            clean_value = self._drivers[driver][2](value)
-            changed = (clean_value != self._drivers[driver][0])
-            in_sync = self._isy_synced.get(driver, False)
-            if changed or not in_sync:
-                self._drivers[driver][0] = clean_value
-                if report:
-                    self._isy_synced[driver] = True
-                    self.report_driver(driver)
-                else:
-                    self._isy_synced[driver] = False
-            return True
-        self.smsg('**ERROR: node "{}": set_driver(): invalid driver "{}"'
-                  .format(self.name, driver))
+        if driver not in self._schema.index:
+            self._smsg('**ERROR: node "{}": set_driver(): invalid driver "{}"',
+                       self.name, driver)
+            return False
+        if self._update_driver(driver, value, report):
+            self._report_changes([driver])
+        return True
+
+    def set_drivers(self, drivers, report=True):
+        """
+        Updates the values of several of the node's drivers, like set_driver.
+        The drivers that need reporting are reported to the ISY together, in
+        one message to Polyglot.
+
+        :param dict drivers: The new values, by driver name
+        :param boolean report: Indicates if the value changes should be
+                               reported to the ISY. If False, the values are
+                               changed silently.
+        :returns boolean: Indicates success or failure to set all new values
+        """
+        success = True
+        changed = []
+        for driver, value in drivers.items():
+            if driver not in self._schema.index:
+                self._smsg(
+                    '**ERROR: node "{}": set_drivers(): invalid driver "{}"',
+                    self.name, driver)
+                success = False
+            elif self._update_driver(driver, value, report):
+                changed.append(driver)
+        if changed:
+            self._report_changes(changed)
+        return success
+
+    def _update_driver(self, driver, value, report):
+        """
+        Private method - stores a driver's new value. Returns True if it
+        should be reported to the ISY.
+        """
+        # pylint: disable=protected-access
+        num = self._schema.index[driver]
+        clean_value = self._schema.formatters[num](value)
+        changed = (clean_value != self._values[num])
+        in_sync = self._synced[num]
+        if changed or not in_sync:
+            self._values[num] = clean_value
+            if report and in_sync and self._in_band(driver, clean_value):
+                # the ISY keeps the reported value, close enough to this one
+                self.parent._suppressed_update('filtered')
+                return False
+            self._synced[num] = 1 if report else 0
+            return report
         return False
 
+    def _report_changes(self, drivers):
+        """
+        Private method - reports changed drivers now, or holds them back
+        until the end of their report interval (see _report_interval) and
+        then reports their latest values.
+        """
+        # pylint: disable=protected-access
+        if not self._report_interval and not self._filters:
+            self.report_driver(drivers)
+            return
+        now = monotonic()
+        due = []
+        groups = {}
+        for driver in drivers:
+            spec = self._filters.get(driver) or {}
+            if 'interval' in spec:
+                key, interval = driver, spec['interval']
+            else:
+                key, interval = None, self._report_interval
+            if interval:
+                groups.setdefault(key, (interval, []))[1].append(driver)
+            else:
+                due.append(driver)
+        replaced = 0
+        with _REPORT_LOCK:
+            if groups and self._throttle is None:
+                self._throttle = {}
+            for key, (interval, group) in groups.items():
+                state = self._throttle.setdefault(key, [None, [], None])
+                last, held, timer = state
+                if timer is None and (last is None or now - last >= interval):
+                    state[0] = now
+                    due.extend(group)
+                    continue
+                for driver in group:
+                    if driver in held:
+                        replaced += 1
+                    else:
+                        held.append(driver)
+                if timer is None:
+                    state[2] = REPORT_TIMER.call_later(
+                        last + interval - now, self._flush_reports, key)
+        if replaced:
+            self.parent._suppressed_update('replaced', replaced)
+        if due:
+            self.report_driver(due)
+
+    def _flush_reports(self, key):
+        """
+        Private method - reports the drivers held back at the end of a
+        report interval. (Runs on the REPORT_TIMER thread)
+        """
+        with _REPORT_LOCK:
+            state = self._throttle[key]
+            drivers, state[1], state[2] = state[1], [], None
+            state[0] = monotonic()
+        if drivers:
+            self.report_driver(drivers)
+
+    def _in_band(self, driver, value):
+        """
+        Private method - indicates if a new value of a driver is within the
+        band of its filter (see _filters) around the value last reported.
+        """
+        spec = self._filters.get(driver)
+        if not spec or not self._reported or driver not in self._reported:
+            return False
+        last, direction = self._reported[driver]
+        try:
+            delta = value - last
+            if abs(delta) < spec.get('deadband', 0):
+                return True
+            if abs(delta) < abs(last) * spec.get('percent', 0) / 100.0:
+                return True
+            # a change of direction must be larger than the hysteresis
+            return direction * delta < 0 and \
+                abs(delta) < spec.get('hysteresis', 0)
+        except TypeError:
+            return False
+
+    def _note_reported(self, drivers):
+        """
+        Private method - remembers the values reported of filtered drivers.
+        """
+        if self._reported is None:
+            self._reported = {}
+        for driver in drivers:
+            if driver in self._filters:
+                value = self._values[self._schema.index[driver]]
+                last, direction = self._reported.get(driver, (value, 0))
+                try:
+                    if value != last:
+                        direction = 1 if value > last else -1
+                except TypeError:
+                    direction = 0
+                self._reported[driver] = (value, direction)
+
     def report_driver(self, driver=None):
         """
-        Reports a driver's current value to ISY
+        Reports drivers' current values to ISY. Several drivers are reported
+        in one message.
 
-        :param driver: The name of the driver to report. If None, all drivers
-                       are reported.
-        :type driver: str or None
+        :param driver: The name of the driver to report, or a list of names.
+                       If None, all drivers are reported.
+        :type driver: str, list or None
         :returns boolean: Indicates success or failure to report driver value
         """
         if not self.enabled or not self.added:
             return True
 
         if driver is None:
-            drivers = self._drivers.keys()
+            drivers = list(self._schema.names)
+        elif isinstance(driver, (list, tuple)):
+            drivers = list(driver)
         else:
             drivers = [driver]
 
-        for driver in drivers:
-            self.parent.report_status(
-                self.address, driver, self._drivers[driver][0],
-                self._drivers[driver][1], self._report_driver_cb,
-                None, driver=driver)
-        return True
+        if self._filters:
+            self._note_reported(drivers)
+        return self.parent.report_drivers(self, drivers)
 
     def _report_driver_cb(self, driver, status_code, **kwargs):
         """
@@ -201,21 +411,22 @@ class Node(object):
         the success/fail of the status update API call to the ISY.
         """
 
-        if driver not in self._drivers:
-            self.smsg(
-                '**ERROR: node "{}": driver "{}": no longer exists.'
-                .format(self.name, driver))
+        num = self._schema.index.get(driver)
+        if num is None:
+            self._smsg(
+                '**ERROR: node "{}": driver "{}": no longer exists.',
+                self.name, driver)
             return False
         if int(status_code) == 200:
-            self._isy_synced[driver] = True
-            self.smsg(
-                '**DEBUG: node "{}": driver "{}": status sent to ISY ok.'
-                .format(self.name, driver))
+            self._synced[num] = 1
+            self._smsg(
+                '**DEBUG: node "{}": driver "{}": status sent to ISY ok.',
+                self.name, driver)
         else:
-            self._isy_synced[driver] = False
-            self.smsg(
-                '**ERROR: node "{}": driver "{}": unable to report status to ISY: {}'
-                .format(self.name, driver, status_code))
+            self._synced[num] = 0
+            self._smsg(
+                '**ERROR: node "{}": driver "{}": unable to report status to ISY: {}',
+                self.name, driver, status_code)
         return True
 
     def get_driver(self, driver=None):
@@ -224,12 +435,16 @@ class Node(object):
 
         :param driver: The driver to return the value for
         :type driver: str or None
-        :returns: The current value of the driver
+        :returns: The driver's entry in _drivers with its current value
+                  first (a copy), or a dictionary of the entries of all the
+                  drivers if driver is None
         """
+        schema = self._schema
         if driver is not None:
-            return self._drivers[driver]
-        else:
-            return self._drivers
+            num = schema.index[driver]
+            return [self._values[num]] + list(schema.tails[num])
+        return dict((key, [value] + list(tail)) for key, value, tail
+                    in zip(schema.names, self._values, schema.tails))
 
     def query(self):
         """
@@ -241,6 +456,17 @@ class Node(object):
         self.report_driver()
         return True
 
+    def poll(self):
+        """
+        Called every _poll_interval seconds by the node server's run loop,
+        for nodes that have one. Nodes that poll on their own schedule should
+        overwrite this method.
+
+        :returns boolean: Indicates success or failure of the poll
+        """
+        # pylint: disable=no-self-use
+        return True
+
     def add_node(self):
         """
         Adds node to the ISY
@@ -248,10 +474,10 @@ class Node(object):
         :returns boolean: Indicates success or failure of node addition
         """
         if (int(len(self.address)) > 14):
-            self.smsg(
-                '**ERROR: name too long (>14), will fail when adding on ISY): "{}"'
-                .format(self.address))
-        self.smsg('**DEBUG: node "%s": parent="%s"' % (self.name,self.parent))
+            self._smsg(
+                '**ERROR: name too long (>14), will fail when adding on ISY): "{}"',
+                self.address)
+        self._smsg('**DEBUG: node "{}": parent="{}"', self.name, self.parent)
         self.parent.add_node(self)
         self.report_driver()
         return True
@@ -280,9 +506,9 @@ class Node(object):
         """
         # Test for a valid defined command
         if isycommand not in self._sends:
-            self.smsg(
-                '**ERROR: node "{}": report_isycmd(): unknown ISY command "{}"'
-                .format(self.name, isycommand))
+            self._smsg(
+                '**ERROR: node "{}": report_isycmd(): unknown ISY command "{}"',
+                self.name, isycommand)
             return False
         if value is None:
             v = None
@@ -324,19 +550,14 @@ class Node(object):
                     'node_def_id': self.node_def_id,
                     'drivers': {}}
 
-        for key, val in self._drivers.items():
-            if len(val) < 4 or val[3] is True:
-                manifest['drivers'][key] = val[0]
+        schema = self._schema
+        for key, value, keep in zip(schema.names, self._values,
+                                    schema.in_manifest):
+            if keep:
+                manifest['drivers'][key] = value
 
         return manifest
 
-
-    _isy_synced = {}
-    """
-    Internal dictionary containing the synchronization status of this
-    driver with the ISY.  Used to eliminate unnecessary status updates.
-    """
-
     _drivers = {}
     """
     The drivers controlled by this node. This is a dictionary of lists. The
@@ -367,6 +588,53 @@ class Node(object):
 
     """
 
+    _filters = {}
+    """
+    Optional filters of the updates of the drivers, to avoid reporting every
+    small change of noisy values. The keys are driver names, the values are
+    dictionaries with any of:
+
+    * *deadband*: changes smaller than this are not reported
+    * *percent*: changes smaller than this percentage of the value last
+      reported are not reported
+    * *hysteresis*: a change in the opposite direction of the last reported
+      change is only reported if it is at least this large
+    * *interval*: the minimum seconds between reports of the driver, in
+      place of the node's _report_interval
+
+    A filtered update is still stored, so get_driver, the manifest and query
+    have the latest value, but the ISY keeps the value last reported. Only
+    set_driver and set_drivers with report=True are filtered; report_driver
+    and query report the latest value.
+
+    *Power Meter Example:*
+
+    .. code-block:: python
+
+        _filters = {
+            'CLITEMP': {'deadband': 0.5, 'hysteresis': 1.0},
+            'CPW': {'percent': 2, 'interval': 5},
+        }
+
+    """
+
+    _report_interval = 0
+    """
+    The minimum seconds between reports of the node's changed drivers by
+    set_driver and set_drivers. Changes within the interval are held back,
+    and once it ends the latest values of the drivers that changed are
+    reported together, so the ISY always ends up with the final state. 0
+    reports every change at once. report_driver and query are not held back.
+    """
+
+    _poll_interval = 0
+    """
+    The seconds between calls of the node's poll method, on a schedule of
+    its own in the node server's run loop (see NodeServer.add_poll). Nodes
+    of a SimpleNodeServer are scheduled when they are added. 0 leaves
+    polling the node to the node server's poll.
+    """
+
     _sends = {}
     """
     A dictionary of the commands that this node sends to the ISY. The
@@ -398,6 +666,336 @@ class Node(object):
     """ The node's definition ID defined in the node server's profile """
 
 
+class _DriverSchema(object):
+    """
+    The drivers of a node class (its _drivers), shared by all of its nodes:
+    their names, the index of each in the nodes' values, their initial
+    values, formatters and whether each is kept in the manifest.
+    """
+    __slots__ = ('names', 'index', 'initial', 'tails', 'formatters',
+                 'in_manifest')
+
+    def __init__(self, drivers):
+        self.names = tuple(drivers)
+        self.index = dict((name, num) for num, name in enumerate(self.names))
+        specs = [drivers[name] for name in self.names]
+        self.initial = tuple(spec[0] for spec in specs)
+        # the rest of each _drivers entry, for get_driver
+        self.tails = tuple(tuple(spec[1:]) for spec in specs)
+        self.formatters = tuple(spec[2] for spec in specs)
+        self.in_manifest = tuple(len(spec) < 4 or spec[3] is True
+                                 for spec in specs)
+
+
+class NodeTable(object):
+    """
+    Columnar storage of the drivers of many nodes of one node class, for
+    node servers that read all of their nodes at once (the circuits of a
+    power monitor, the zones of an alarm panel). The values of each driver
+    of all the nodes are kept in one array: a NumPy array when NumPy can be
+    imported, otherwise an ``array.array`` (or a list, for drivers whose
+    formatter is not int or float). update() takes a whole column of new
+    readings per driver, finds the changed values column by column and
+    reports only those, in one status batch.
+
+    The nodes keep working as before: their get_driver, set_driver, query
+    and manifest read and write the table. The deadband and percent
+    _filters of the node class apply to the numeric drivers updated by
+    update(); hysteresis and report intervals do not. The values last
+    reported, which the filters compare against, are kept in the table too
+    and shared with the nodes' own set_driver.
+
+    :param nodes: The nodes of the table, in the order of the values given
+                  to update()
+    :type nodes: list of polyglot.nodeserver_api.Node, all of one class
+    :param use_numpy: Store the columns in NumPy arrays. If None, NumPy is
+                      used when it is installed.
+    :type use_numpy: boolean or None
+
+    .. code-block:: python
+
+        self.circuits = NodeTable(self.get_node('circuit%d' % num)
+                                  for num in range(1, 49))
+        ...
+        self.circuits.update({'CPW': watts, 'CC': amps})
+    """
+
+    def __init__(self, nodes, use_numpy=None):
+        # pylint: disable=protected-access
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError('NodeTable needs at least one node')
+        node_class = type(self.nodes[0])
+        if any(type(node) is not node_class for node in self.nodes):
+            raise ValueError('NodeTable nodes must all be of one class')
+        self.parent = self.nodes[0].parent
+        self._schema = node_class._driver_schema()
+        self._np = None
+        if use_numpy is not False:
+            try:
+                import numpy
+                self._np = numpy
+            except ImportError:
+                if use_numpy:
+                    raise
+        schema = self._schema
+        count = len(schema.names)
+        # the kind of each column: int, float or None (any value)
+        self._kinds = [fmt if fmt in (int, float) else None
+                       for fmt in schema.formatters]
+        self._columns = [
+            self._new_column(num, [schema.formatters[num](node._values[num])
+                                   for node in self.nodes])
+            for num in range(count)]
+        self._synced = [self._new_synced([node._synced[num]
+                                          for node in self.nodes])
+                        for num in range(count)]
+        # deadband and percent of the filtered numeric drivers, and the
+        # values last reported of each
+        self._bands = {}
+        self._reported = {}
+        for driver, spec in node_class._filters.items():
+            num = schema.index.get(driver)
+            if num is not None and self._kinds[num] and \
+                    (spec.get('deadband') or spec.get('percent')):
+                self._bands[num] = (spec.get('deadband', 0),
+                                    spec.get('percent', 0) / 100.0)
+                fmt = schema.formatters[num]
+                self._reported[num] = self._new_column(num, [
+                    fmt(node._reported[driver][0])
+                    if node._reported and driver in node._reported
+                    else node._values[num] for node in self.nodes])
+        for row, node in enumerate(self.nodes):
+            node._values = _TableRow(self._columns, row)
+            node._synced = _TableRow(self._synced, row)
+            if self._bands:
+                node._reported = _TableReported(self, row, node._reported)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _new_column(self, num, values):
+        """ Private method - a column of driver num holding values. """
+        kind = self._kinds[num]
+        if self._np is not None:
+            dtype = {int: self._np.int64, float: self._np.float64}.get(
+                kind, object)
+            column = self._np.empty(len(values), dtype=dtype)
+            column[:] = values
+            return column
+        if kind is None:
+            return list(values)
+        from array import array
+        return array('l' if kind is int else 'd', values)
+
+    def _new_synced(self, flags):
+        """ Private method - a column of ISY sync flags. """
+        if self._np is not None:
+            return self._np.array(flags, dtype=bool)
+        return bytearray(flags)
+
+    def get_column(self, driver):
+        """
+        Gets the values of a driver of all the nodes, in the table's order.
+
+        :param str driver: The name of the driver
+        :returns: A copy of the driver's column, a NumPy array if the table
+                  uses NumPy, otherwise an array.array or a list
+        """
+        column = self._columns[self._schema.index[driver]]
+        if self._np is not None:
+            return column.copy()
+        return column[:]
+
+    def update(self, columns, report=True):
+        """
+        Updates drivers of all the nodes of the table at once, and reports
+        the values that changed (or that the ISY does not have) to the ISY,
+        in one message to Polyglot.
+
+        :param dict columns: The new values of each driver updated, by
+                             driver name: a sequence (or NumPy array) with
+                             one value per node, in the table's order
+        :param boolean report: Indicates if the value changes should be
+                               reported to the ISY. If False, the values are
+                               changed silently.
+        :returns int: The number of values reported: those that changed or
+                      that the ISY did not have, less the changes within
+                      a filter band, which are stored but not reported.
+                      With report False, the number of values that
+                      changed or that the ISY did not have.
+        """
+        cells = []
+        for driver, values in columns.items():
+            num = self._schema.index.get(driver)
+            if num is None:
+                self.parent._smsg(
+                    '**ERROR: NodeTable.update(): invalid driver "{}"',
+                    driver)
+                continue
+            if len(values) != len(self.nodes):
+                raise ValueError('NodeTable.update(): {} values of "{}" for '
+                                 '{} nodes'.format(len(values), driver,
+                                                   len(self.nodes)))
+            if self._np is not None:
+                rows = self._update_array(num, values, report)
+            else:
+                rows = self._update_list(num, values, report)
+            cells.extend((row, num) for row in rows)
+        if report and cells:
+            self._report(cells)
+        return len(cells)
+
+    def _update_array(self, num, values, report):
+        """
+        Private method - stores a NumPy column of new values of driver num.
+        Returns the rows to report.
+        """
+        np = self._np
+        kind = self._kinds[num]
+        if kind is None:
+            fmt = self._schema.formatters[num]
+            new = np.empty(len(values), dtype=object)
+            new[:] = [fmt(value) for value in values]
+        else:
+            new = np.asarray(values).astype(self._columns[num].dtype,
+                                             copy=False)
+        column, synced = self._columns[num], self._synced[num]
+        send = (new != column) | ~synced
+        column[send] = new[send]
+        if report and num in self._bands:
+            reported = self._reported[num]
+            deadband, percent = self._bands[num]
+            delta = np.abs(new - reported)
+            quiet = send & synced & ((delta < deadband) |
+                                     (delta < np.abs(reported) * percent))
+            if quiet.any():
+                self.parent._suppressed_update('filtered',
+                                               int(quiet.sum()))
+                send &= ~quiet
+            reported[send] = new[send]
+        synced[send] = report
+        return np.flatnonzero(send).tolist()
+
+    def _update_list(self, num, values, report):
+        """
+        Private method - stores new values of driver num in an array.array
+        or list column. Returns the rows to report.
+        """
+        fmt = self._schema.formatters[num]
+        column, synced = self._columns[num], self._synced[num]
+        band = self._bands.get(num) if report else None
+        reported = self._reported.get(num)
+        rows = []
+        quiet = 0
+        for row, value in enumerate(values):
+            value = fmt(value)
+            if value == column[row] and synced[row]:
+                continue
+            column[row] = value
+            if band and synced[row]:
+                delta = abs(value - reported[row])
+                if delta < band[0] or delta < abs(reported[row]) * band[1]:
+                    quiet += 1
+                    continue
+            if band:
+                reported[row] = value
+            synced[row] = report
+            rows.append(row)
+        if quiet:
+            self.parent._suppressed_update('filtered', quiet)
+        return rows
+
+    def _report(self, cells):
+        """
+        Private method - reports (row, driver number) cells of the nodes
+        that the ISY has, in one status batch.
+        """
+        names = self._schema.names
+        with self.parent.batch_reports():
+            for row, num in sorted(cells):
+                node = self.nodes[row]
+                if node.enabled and node.added:
+                    self.parent.report_drivers(node, [names[num]])
+
+
+class _TableRow(object):
+    """
+    A node's driver values, or ISY sync flags, in the columns of a
+    NodeTable. It stands in for the node's own list.
+    """
+    __slots__ = ('columns', 'row')
+
+    def __init__(self, columns, row):
+        self.columns = columns
+        self.row = row
+
+    def __getitem__(self, num):
+        value = self.columns[num][self.row]
+        # NumPy scalars become Python values, for the manifest and reports
+        return value.item() if hasattr(value, 'item') else value
+
+    def __setitem__(self, num, value):
+        self.columns[num][self.row] = value
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        return (self[num] for num in range(len(self.columns)))
+
+
+class _TableReported(object):
+    """
+    A node's values last reported of its filtered drivers, and their
+    direction, with the values of the drivers a NodeTable filters kept in the
+    table's columns. It stands in for the node's own dictionary, so the node
+    and the table filter against the same values.
+    """
+    __slots__ = ('table', 'row', 'others')
+
+    def __init__(self, table, row, reported=None):
+        self.table = table
+        self.row = row
+        # (value, direction) of the other drivers, and the direction of the
+        # table's
+        self.others = dict(reported or {})
+
+    def _num(self, driver):
+        """ The table's column of driver, None if it does not filter it. """
+        # pylint: disable=protected-access
+        num = self.table._schema.index.get(driver)
+        return num if num in self.table._reported else None
+
+    def __contains__(self, driver):
+        return self._num(driver) is not None or driver in self.others
+
+    def __getitem__(self, driver):
+        num = self._num(driver)
+        if num is None:
+            return self.others[driver]
+        # pylint: disable=protected-access
+        value = self.table._reported[num][self.row]
+        value = value.item() if hasattr(value, 'item') else value
+        return value, self.others.get(driver, (value, 0))[1]
+
+    def __setitem__(self, driver, reported):
+        num = self._num(driver)
+        if num is not None:
+            # pylint: disable=protected-access
+            self.table._reported[num][self.row] = reported[0]
+        self.others[driver] = reported
+
+    def __len__(self):
+        # pylint: disable=protected-access
+        return len(self.table._reported) + sum(
+            1 for driver in self.others if self._num(driver) is None)
+
+    def get(self, driver, default=None):
+        """ The value reported of driver and its direction, or default. """
+        return self[driver] if driver in self else default
+
+
 class NodeServer(object):
     """
     It is generally desireable to not be required to bind to each event. For
@@ -408,8 +1006,12 @@ class NodeServer(object):
 
     :param poly: The connected Polyglot connection
     :type poly: polyglot.nodeserver_api.PolyglotConnector
-    :param int optional shortpoll: The seconds between poll events
-    :param int optional longpoll: The second between longpoll events
+    :param float optional shortpoll: The seconds between poll events, which
+                                     may be less than one. 0 polls on every
+                                     tick of the run loop (each second) and
+                                     None turns them off.
+    :param float optional longpoll: The seconds between longpoll events, as
+                                    for shortpoll.
     """
     # pylint: disable=unused-argument
 
@@ -424,6 +1026,9 @@ class NodeServer(object):
         # create/store properties
         self.poly = poly
         self.config = {}
+        # configuration as Polyglot has it, to send only what changed
+        self._sent_config = {}
+        self._sent_manifest = {}
         self.running = False
         self.shortpoll = shortpoll
         self.longpoll = longpoll
@@ -432,6 +1037,14 @@ class NodeServer(object):
         self._seq = 1000
         self._seq_lock = threading.Lock()
         self._seq_cb = {}
+        # driver reports collected by batch_reports(), per thread
+        self._batching = threading.local()
+        # driver updates not reported since they were last logged
+        self._suppressed = {'filtered': 0, 'replaced': 0}
+        self._suppressed_logged = monotonic()
+        self._suppressed_timer = None
+        # poll, long_poll, tock and add_poll schedules, run by run()
+        self._polls = PollScheduler()
 
         # bind callbacks to events
         poly.listen('config', self.on_config)
@@ -457,13 +1070,19 @@ class NodeServer(object):
         """
         self.logger = self.poly.logger
         
-    def smsg(self, str):
+    def smsg(self, str, *args):
         """
         Logs/sends a diagnostic/debug, informative, or error message.
         Individual node servers can override this method if they desire to
-        redirect or filter these messages.
+        redirect or filter these messages. An override should take the
+        str.format args, as ``smsg(self, str, *args)``; overrides that take
+        only the message are given it already formatted.
         """
-        self.poly.send_error(str)
+        _call_smsg(self.poly, str, *args)
+
+    def _smsg(self, str, *args):
+        """ Private method - smsg, also for overrides without args. """
+        return _call_smsg(self, str, *args)
 
     def on_config(self, **data):
         """
@@ -473,6 +1092,9 @@ class NodeServer(object):
         :returns bool: True on success
         """
         self.config = data
+        self._sent_manifest = copy.deepcopy(dict(data.get('manifest', {})))
+        self._sent_config = copy.deepcopy(dict(
+            (key, value) for key, value in data.items() if key != 'manifest'))
         return True
 
     def on_install(self, profile_number):
@@ -610,12 +1232,15 @@ class NodeServer(object):
         """
         Handles a result message, which contains the result from a REST API
         call to the ISY.  The result message is uniquely identified by the
-        seq id, and will always contain at least the numeric status.
+        seq id, and will always contain at least the numeric status. Any
+        other fields of the result (such as the statuses of a status batch)
+        are passed on to the callback.
         """
         if seq not in self._seq_cb:
-            self.smsg('**ERROR: on_result: missing callback for seq={}'.format(seq))
+            self._smsg('**ERROR: on_result: missing callback for seq={}', seq)
             return False
         func, args = self._seq_cb.pop(seq)
+        args = dict(kwargs, **args)
         return func(seq=seq, status_code=status_code, elapsed=elapsed,
                     text=text, retries=retries, **args)
 
@@ -663,6 +1288,122 @@ class NodeServer(object):
                                 timeout, seq)
         return True
 
+    def report_status_batch(self, statuses, callback=None, timeout=None,
+                            **kwargs):
+        """
+        Report several node statuses to the ISY in one message. The callback
+        is called once, with the status code of each report in *statuses*.
+
+        :param list statuses: (node_address, driver_control, value, uom)
+                              of each report
+        :returns bool: True on success
+        """
+        seq = None
+        if callback:
+            seq = self.register_result_cb(callback, **kwargs)
+        self.poly.report_status_batch(statuses, timeout, seq)
+        return True
+
+    def report_drivers(self, node, drivers):
+        """
+        Report drivers of a node to the ISY, in one message, or with the
+        reports of other nodes when called within batch_reports().
+
+        :returns bool: True on success
+        """
+        pending = getattr(self._batching, 'reports', None)
+        if pending is not None:
+            for driver in drivers:
+                pending[(node.address, driver)] = node
+            return True
+        return self._send_reports([(node, driver) for driver in drivers])
+
+    @contextmanager
+    def batch_reports(self):
+        """
+        Context manager that collects the driver reports of all nodes made on
+        this thread and sends them in one message when it exits. A driver
+        reported more than once is sent once, with its latest value.
+
+        .. code-block:: python
+
+            with self.batch_reports():
+                for node in self.nodes.values():
+                    node.set_driver('ST', readings[node.address])
+        """
+        if getattr(self._batching, 'reports', None) is not None:
+            # nested: the outermost batch sends
+            yield
+            return
+        self._batching.reports = OrderedDict()
+        try:
+            yield
+        finally:
+            pending, self._batching.reports = self._batching.reports, None
+            if pending:
+                self._send_reports([(node, driver) for (_, driver), node
+                                    in pending.items()])
+
+    def _send_reports(self, reports):
+        """
+        Send (node, driver) reports with the drivers' current values, as a
+        status batch when there are several and Polyglot takes batches.
+        """
+        # pylint: disable=protected-access
+        if len(reports) > 1 and self.poly.status_batches:
+            statuses = [[node.address, driver] + node.get_driver(driver)[:2]
+                        for node, driver in reports]
+            return self.report_status_batch(statuses, self._report_batch_cb,
+                                            None, reports=reports)
+        for node, driver in reports:
+            value, uom = node.get_driver(driver)[:2]
+            self.report_status(node.address, driver, value, uom,
+                               node._report_driver_cb, None, driver=driver)
+        return True
+
+    def _suppressed_update(self, reason, count=1):
+        """
+        Private method - counts driver updates that were not reported to the
+        ISY, 'filtered' by a node's _filters or 'replaced' by a later value
+        within a report interval. The counts are logged from the REPORT_TIMER
+        SUPPRESSED_LOG_INTERVAL seconds after the first one, even if no
+        update follows.
+        """
+        with _REPORT_LOCK:
+            self._suppressed[reason] += count
+            if self._suppressed_timer is None:
+                self._suppressed_timer = REPORT_TIMER.call_later(
+                    SUPPRESSED_LOG_INTERVAL, self._log_suppressed)
+
+    def _log_suppressed(self):
+        """
+        Private method - logs the driver updates not reported since they were
+        last logged. (Runs on the REPORT_TIMER thread)
+        """
+        now = monotonic()
+        with _REPORT_LOCK:
+            counts = self._suppressed
+            self._suppressed = {'filtered': 0, 'replaced': 0}
+            self._suppressed_timer = None
+            elapsed = now - self._suppressed_logged
+            self._suppressed_logged = now
+        self._smsg('**INFO: driver updates not reported in the last {:.0f} s: '
+                   '{} within filter bands, {} replaced within report '
+                   'intervals', elapsed, counts['filtered'], counts['replaced'])
+
+    def _report_batch_cb(self, reports, status_code, statuses=None,
+                         **kwargs):
+        """
+        Private method - hands the result of each report of a status batch
+        to its node. A batch refused as a whole has no statuses.
+        """
+        # pylint: disable=protected-access, unused-argument
+        if statuses is None or len(statuses) != len(reports):
+            statuses = [status_code] * len(reports)
+        for (node, driver), code in zip(reports, statuses):
+            node._report_driver_cb(driver, code)
+        return True
+
     def restcall(self, api, callback=None, timeout=None, **kwargs):
         """
         Sends an asynchronous REST API call to the ISY.
@@ -688,35 +1429,82 @@ class NodeServer(object):
         """ Called every longpoll seconds for less important polling. """
         # pylint: disable=no-self-use
         pass
-        
+
+    def add_poll(self, name, interval, func, group=None):
+        """
+        Calls func() every interval seconds from run(), along with poll and
+        long_poll, for example to poll some nodes more often than others.
+
+        :param str name: The name of the schedule. Adding a schedule with the
+                         name of another one replaces it.
+        :param float interval: The seconds between calls
+        :param func: The function to call
+        :param str group: The group of schedules whose poll lag is counted
+                          together in poll_stats, by default the name
+        """
+        self._polls.add(name, interval, func, group)
+
+    def remove_poll(self, name):
+        """ Stops calling a schedule added with add_poll. """
+        self._polls.remove(name)
+
+    @property
+    def poll_stats(self):
+        """
+        Statistics of the poll schedules: the calls made, the ticks skipped
+        because a call overran its interval and how late the calls ran (the
+        poll lag), by group. run() sends them to Polyglot every
+        POLL_STATS_INTERVAL seconds.
+        """
+        return self._polls.stats
+
+    def _send_poll_stats(self):
+        """ Private method - sends poll_stats to Polyglot. """
+        self.poly.send_poll_stats(self.poll_stats)
+
+    def _update_polls(self):
+        """
+        Private method - schedules poll and long_poll at the current
+        shortpoll and longpoll intervals. None turns a poll off, and 0 (or
+        less) polls on every tick, as the run loop always did.
+        """
+        for name, interval, func in (('poll', self.shortpoll, self.poll),
+                                     ('long_poll', self.longpoll,
+                                      self.long_poll)):
+            if interval is None:
+                self._polls.remove(name)
+                continue
+            if interval <= 0:
+                interval = POLL_TICK
+            if self._polls.interval(name) != interval:
+                self._polls.add(name, interval, func)
+
     def run(self):
         """
         Run the Node Server. Exit when triggered. Generally, this method should
         not be overwritten.
+
+        poll, long_poll, tock and the add_poll schedules are called on this
+        thread at fixed deadlines, so the time they take does not delay the
+        next call. The first call of each comes at a random point within its
+        interval, different for every node server. A call that overruns its
+        interval skips the ticks it missed instead of running them late. The
+        driver reports of the calls made together are sent in one batch.
+        The loop also ends when Polyglot detaches a stopped plugin.
         """
         self.running = True
         self.poly.connect()
-        scounter = 0
-        lcounter = 0
-        tcounter = 0
+        self._polls.add('tock', TOCK_INTERVAL, self.tock)
+        self._polls.add('poll_stats', POLL_STATS_INTERVAL,
+                        self._send_poll_stats)
         try:
-            while self.running:
-                time.sleep(1)
-                scounter += 1
-                lcounter += 1
-                tcounter += 1
-
-                if scounter >= self.shortpoll:
-                    self.poll()
-                    scounter = 0
-
-                if lcounter >= self.longpoll:
-                    self.long_poll()
-                    lcounter = 0
-
-                if tcounter >= 7:
-                    self.tock()
-                    tcounter = 0
+            while self.running and self.poly.attached:
+                # shortpoll and longpoll may be changed while running
+                self._update_polls()
+                with self.batch_reports():
+                    delay = self._polls.run_due()
+                time.sleep(POLL_TICK if delay is None
+                           else min(delay, POLL_TICK))
 
         except KeyboardInterrupt:
             self.on_exit()
@@ -756,9 +1544,13 @@ class SimpleNodeServer(NodeServer):
         :type node: polyglot.nodeserver_api.Node
         :returns boolean: Indicates success or failure of node addition
         """
+        # pylint: disable=protected-access
         na = node.address
         if na not in self.nodes:
             self.nodes[na] = node
+            if node._poll_interval:
+                self.add_poll('node ' + na, node._poll_interval, node.poll,
+                              group='nodes')
         if not self.nodes[na].added:
             # By default the primary_address is its own address...
             primary_addr = na
@@ -770,8 +1562,8 @@ class SimpleNodeServer(NodeServer):
                     raise RuntimeError('Error: node "%s", primary "%s" is not primary.'
                                        % (node.name, node.primary.name))
                 primary_addr = node.primary.address
-            self.smsg('**DEBUG: add_node: na="{}", id="{}", pa="{}", nm="{}"'
-                      .format(na, node.node_def_id, primary_addr, node.name))
+            self._smsg('**DEBUG: add_node: na="{}", id="{}", pa="{}", nm="{}"',
+                       na, node.node_def_id, primary_addr, node.name)
             super(SimpleNodeServer, self).add_node(na, node.node_def_id,
                                                    primary_addr, node.name,
                                                    self._add_node_cb, None,
@@ -797,27 +1589,27 @@ class SimpleNodeServer(NodeServer):
         pfx = str(self.poly.profile).zfill(3)
         full_addr = 'n{}_{}'.format(pfx, node_address)
         api = 'nodes/' + full_addr
-        self.smsg('**DEBUG: request_node_probe: na="{}" fa="{}" api="{}"'
-                  .format(node_address, full_addr, api))
+        self._smsg('**DEBUG: request_node_probe: na="{}" fa="{}" api="{}"',
+                   node_address, full_addr, api)
         return super(SimpleNodeServer, self).restcall(
             api, self.node_probe_response, timeout, na=node_address)
 
     def node_probe_response(self, status_code, text, na, **kwargs):
 
-        self.smsg('**DEBUG: probe: st={} na="{}" text: {}'
-                  .format(status_code, na, text))
+        self._smsg('**DEBUG: probe: st={} na="{}" text: {}',
+                   status_code, na, text)
 
         if na in self.nodes:
             node = self.nodes[na]
         else:
-            self.smsg('**ERROR: probe: node "{}" does not exist'.format(na))
+            self._smsg('**ERROR: probe: node "{}" does not exist', na)
             # No action practical for this problem
             return False
 
         if status_code != 200:
-            self.smsg('**WARNING: probe: status code: {}'.format(status_code))
+            self._smsg('**WARNING: probe: status code: {}', status_code)
             if status_code == 404 and node.added:
-                self.smsg('**WARNING: probe: na="{}": state mismatch'.format(na))
+                self._smsg('**WARNING: probe: na="{}": state mismatch', na)
                 self.smsg('**WARNING: probe: ISY does not think this node exists')
                 self.smsg('**WARNING: probe: Correcting local node state')
                 node.enabled = False
@@ -825,19 +1617,20 @@ class SimpleNodeServer(NodeServer):
             return True
 
         # Parse the XML response text from the ISY
+        import xml.etree.ElementTree as ET
         try:
             root = ET.fromstring(text)
         except ET.ParseError:
-            self.smsg('**ERROR: probe: Unable to parse ISY response: {}'
-                      .format(text))
+            self._smsg('**ERROR: probe: Unable to parse ISY response: {}',
+                       text)
             # No action practical for this problem
             return False
 
         # Find the root node element
         n = root.find('node')
         if n is None:
-            self.smsg('**ERROR: probe: missing node element in response: {}'
-                      .format(text))
+            self._smsg('**ERROR: probe: missing node element in response: {}',
+                       text)
             # No action practical for this problem
             return False
 
@@ -848,23 +1641,22 @@ class SimpleNodeServer(NodeServer):
         n_name = n.findtext('name')
         n_pnode = n.findtext('pnode')
         n_enabled = (n.findtext('enabled', 'false') == 'true')
-        self.smsg('**INFO: probe: fa={} pfa={} id={} fl={} en={} nm="{}"'
-                  .format(n_addr, n_pnode, n_def_id, n_flag,
-                          n_enabled, n_name))
+        self._smsg('**INFO: probe: fa={} pfa={} id={} fl={} en={} nm="{}"',
+                   n_addr, n_pnode, n_def_id, n_flag, n_enabled, n_name)
 
         # Check that the fields match our node
 
         pfx = str(self.poly.profile).zfill(3)
         full_addr = 'n{}_{}'.format(pfx, node.address)
         if full_addr != n_addr:
-            self.smsg('**ERROR: probe: expected na="{}", response is for na="{}"'
-                      .format(full_addr, n_addr))
+            self._smsg('**ERROR: probe: expected na="{}", response is for na="{}"',
+                       full_addr, n_addr)
             # No action practical for this problem
             return False
 
         if node.node_def_id != n_def_id:
-            self.smsg('**ERROR: probe: expected id="{}", response is for id="{}"'
-                      .format(node.node_def_id, n_def_id))
+            self._smsg('**ERROR: probe: expected id="{}", response is for id="{}"',
+                       node.node_def_id, n_def_id)
             self.smsg('**ERROR: probe: setting local node state to "not added"')
             node.enabled = False
             node.added = False
@@ -876,8 +1668,8 @@ class SimpleNodeServer(NodeServer):
             primary_addr = node.address
         full_paddr = 'n{}_{}'.format(pfx, primary_addr)
         if full_paddr != n_pnode:
-            self.smsg('**ERROR: probe: node parent mismatch, local: "{}" ISY: "{}"'
-                      .format(full_paddr, n_pnode))
+            self._smsg('**ERROR: probe: node parent mismatch, local: "{}" ISY: "{}"',
+                       full_paddr, n_pnode)
             self.smsg('**ERROR: probe: setting local node state to "not added"')
             node.enabled = False
             node.added = False
@@ -889,21 +1681,21 @@ class SimpleNodeServer(NodeServer):
             node.added = True
 
         if node.name != n_name:
-            self.smsg('**WARNING: probe: node name mismatch, local: "{}" ISY: "{}"'
-                      .format(node.name, n_name))
+            self._smsg('**WARNING: probe: node name mismatch, local: "{}" ISY: "{}"',
+                       node.name, n_name)
             self.smsg('**WARNING: probe: correcting local node name')
             node.name = n_name;
 
         if node.enabled != n_enabled:
-            self.smsg('**WARNING: probe: node enable mismatch, local:"{}" ISY:"{}"'
-                      .format(node.enabled, n_enabled))
+            self._smsg('**WARNING: probe: node enable mismatch, local:"{}" ISY:"{}"',
+                       node.enabled, n_enabled)
             self.smsg('**WARNING: probe: correcting local node state')
             node.enabled = n_enabled;
 
         return True
 
     def restcall(self, api, timeout=None):
-        self.smsg('**DEBUG: restcall: api="{}"'.format(api))
+        self._smsg('**DEBUG: restcall: api="{}"', api)
         return super(SimpleNodeServer, self).restcall(
             api, self._save_rest_response, timeout)
 
@@ -919,18 +1711,18 @@ class SimpleNodeServer(NodeServer):
         if int(status_code) == 200:
             if na in self.nodes:
                 self.nodes[na].added = True
-                self.smsg(
-                    '**INFO: node "{}": node successfully added on ISY'
-                    .format(na))
+                self._smsg(
+                    '**INFO: node "{}": node successfully added on ISY',
+                    na)
                 return True
             else:
-                self.smsg(
-                    '**ERROR: node "{}": node added on ISY, but no longer exists.'
-                    .format(na))
+                self._smsg(
+                    '**ERROR: node "{}": node added on ISY, but no longer exists.',
+                    na)
         else:
-            self.smsg(
-                '**ERROR: node "{}": node add REST call to ISY failed: {}'
-                .format(na, status_code))
+            self._smsg(
+                '**ERROR: node "{}": node add REST call to ISY failed: {}',
+                na, status_code)
         return False
 
     def _enable_node(self, address):
@@ -938,7 +1730,7 @@ class SimpleNodeServer(NodeServer):
         # then force the configuration file update to record same
         if not self.nodes[address].enabled:
             self.nodes[address].enabled = True
-            self.smsg('**INFO: node "{}" enabled'.format(address))
+            self._smsg('**INFO: node "{}" enabled', address)
             self.update_config()
             self.probe_t = 0
 
@@ -946,7 +1738,7 @@ class SimpleNodeServer(NodeServer):
         # Ensure the addressed node is disabled - as above
         if self.nodes[address].enabled:
             self.nodes[address].enabled = False
-            self.smsg('**INFO: node "{}" disabled'.format(address))
+            self._smsg('**INFO: node "{}" disabled', address)
             self.update_config()
             self.probe_t = 0
 
@@ -986,7 +1778,37 @@ class SimpleNodeServer(NodeServer):
         for node_addr, node in self.nodes.items():
             output[node.address] = node.manifest
         self.config['manifest'] = output
-        self.poly.send_config(self.config)
+        changed, removed = self._config_changes()
+        if changed or removed:
+            self.poly.send_config_patch(self.config, changed, removed)
+
+    def _config_changes(self):
+        """
+        The configuration paths changed and removed since the configuration
+        was last sent to Polyglot: a list of (path, value) pairs and a list
+        of paths. Nodes of the manifest are compared one by one.
+        """
+        changed = []
+        removed = []
+        manifest = self.config.get('manifest', {})
+        for key, value in self.config.items():
+            if key != 'manifest' and (key not in self._sent_config or
+                                      self._sent_config[key] != value):
+                changed.append(([key], value))
+                self._sent_config[key] = copy.deepcopy(value)
+        for key in list(self._sent_config):
+            if key not in self.config:
+                removed.append([key])
+                del self._sent_config[key]
+        for address, entry in manifest.items():
+            if self._sent_manifest.get(address) != entry:
+                changed.append((['manifest', address], entry))
+                self._sent_manifest[address] = copy.deepcopy(entry)
+        for address in list(self._sent_manifest):
+            if address not in manifest:
+                removed.append(['manifest', address])
+                del self._sent_manifest[address]
+        return changed, removed
 
     def on_enabled(self, node_address):
         """
@@ -1022,10 +1844,11 @@ class SimpleNodeServer(NodeServer):
             self._enable_node(node_address)
             return self.nodes[node_address].query()
         elif node_address == "0":
-            return all([node.query() for node in self.nodes.values()])
+            with self.batch_reports():
+                return all([node.query() for node in self.nodes.values()])
         else:
-            self.smsg('**ERROR: on_query: node "{}" does not exist'
-                      .format(node_address))
+            self._smsg('**ERROR: on_query: node "{}" does not exist',
+                       node_address)
         return False
 
     @auto_request_report
@@ -1042,10 +1865,12 @@ class SimpleNodeServer(NodeServer):
             self._enable_node(node_address)
             return self.nodes[node_address].report_driver()
         elif node_address == "0":
-            return all([node.report_driver() for node in self.nodes.values()])
+            with self.batch_reports():
+                return all([node.report_driver()
+                            for node in self.nodes.values()])
         else:
-            self.smsg('**ERROR: on_status: node "{}" does not exist'
-                      .format(node_address))
+            self._smsg('**ERROR: on_status: node "{}" does not exist',
+                       node_address)
         return False
 
     @auto_request_report
@@ -1078,8 +1903,8 @@ class SimpleNodeServer(NodeServer):
             self.nodes[node_address].enabled = True
             self.nodes[node_address].name = name
             return True
-        self.smsg('**ERROR: on_added: node "{}" does not exist'
-                  .format(node_address))
+        self._smsg('**ERROR: on_added: node "{}" does not exist',
+                   node_address)
         return False
 
     def on_removed(self, node_address):
@@ -1093,8 +1918,8 @@ class SimpleNodeServer(NodeServer):
             self.nodes[node_address].added = False
             self.nodes[node_address].enabled = False
             return True
-        self.smsg('**WARNING: on_removed: node "{}" does not exist'
-                  .format(node_address))
+        self._smsg('**WARNING: on_removed: node "{}" does not exist',
+                   node_address)
         return False
 
     def on_renamed(self, node_address, name):
@@ -1108,12 +1933,12 @@ class SimpleNodeServer(NodeServer):
         if node_address in self.nodes:
             orig_name = self.nodes[node_address].name
             self.nodes[node_address].name = name
-            self.smsg('**INFO: node "{}" renamed from "{}" to "{}"'
-                      .format(node_address, orig_name, name))
+            self._smsg('**INFO: node "{}" renamed from "{}" to "{}"',
+                       node_address, orig_name, name)
             self._enable_node(node_address)
             return True
-        self.smsg('**ERROR: on_renamed: node "{}" does not exist'
-                  .format(node_address))
+        self._smsg('**ERROR: on_renamed: node "{}" does not exist',
+                   node_address)
         return False
 
     @auto_request_report
@@ -1135,8 +1960,8 @@ class SimpleNodeServer(NodeServer):
             self._enable_node(node_address)
             return self.nodes[node_address].run_cmd(
                 command, value=value, cmd=command, uom=uom, **kwargs)
-        self.smsg('**ERROR: on_cmd: node "{}" does not exist for command "{}"'
-                  .format(node_address, command))
+        self._smsg('**ERROR: on_cmd: node "{}" does not exist for command "{}"',
+                   node_address, command)
         return False
 
     def on_exit(self, *args, **kwargs):
@@ -1167,7 +1992,7 @@ class PolyglotConnector(object):
 
     commands = ['config', 'install', 'query', 'status', 'add_all', 'added',
                 'removed', 'renamed', 'enabled', 'disabled', 'cmd', 'ping',
-                'exit', 'params', 'result', 'statistics']
+                'exit', 'params', 'result', 'statistics', 'loglevel']
     """ Commands that may be invoked by Polyglot """
     logger = None                
     """ 
@@ -1177,12 +2002,22 @@ class PolyglotConnector(object):
     Once wait_for_config is complete, you can call
     `poly.logger.info('This variable is set to %s', variable)`
     """
-       
+
+    # there is one connector per process, except for in-process connectors
+    _singleton = True
+
+    def __new__(cls, *args, **kwargs):
+        # a node server running as a plugin gets an in-process connector
+        if cls is PolyglotConnector and \
+                getattr(_PLUGIN, 'host', None) is not None:
+            cls = InProcessConnector
+        return super(PolyglotConnector, cls).__new__(cls)
+
     def __init__(self):
         # make singleton
         # pylint: disable=global-statement
         global _POLYGLOT_CONNECTION
-        if _POLYGLOT_CONNECTION is not None:
+        if _POLYGLOT_CONNECTION is not None and self._singleton:
             raise RuntimeError('PolyglotConnector may only be created once.')
 
         # setup properties
@@ -1201,11 +2036,28 @@ class PolyglotConnector(object):
         self.name = False
         self.apiver = False
         self.profile = None
+        self._last_config = None
+        # Polyglot's log level: messages below it are not sent. Everything is
+        # sent until Polyglot says otherwise.
+        self.loglevel = logging.DEBUG
+        self._log_frames = False
+        self._config_patches = False
+        # Polyglot API 4 and up takes status_batch messages
+        self.status_batches = False
+        self._poll_stats = False
+
+        # Socket interface: set by Polyglot when launching the node server,
+        # or by hand when starting a node server outside of Polyglot.
+        self._socket_path = os.environ.get('POLYGLOT_SOCKET')
+        self._sock = None
+        self._sock_lock = threading.Lock()
+        self._sock_ready = threading.Event()
 
         # listen for important events
         self.listen('ping', self.pong)
         self.listen('config', self._recv_config)
         self.listen('params', self.get_params)
+        self.listen('loglevel', self.set_loglevel)
 
         # setup logging - redirect warnings and errors to stderr
         fmt = '%(name)s: %(message)s'
@@ -1214,7 +2066,8 @@ class PolyglotConnector(object):
         handler.setFormatter(logging.Formatter(fmt))
 
         # store connection globally in module
-        _POLYGLOT_CONNECTION = self
+        if self._singleton:
+            _POLYGLOT_CONNECTION = self
 
     @property
     def uptime(self):
@@ -1245,14 +2098,29 @@ class PolyglotConnector(object):
         else:
             self.disconnect()
 
+    @property
+    def attached(self):
+        """
+        Indicates if Polyglot still runs this node server. Only a plugin can
+        be detached, when Polyglot stops or restarts it.
+
+        :type: boolean
+        """
+        return True
+
     def connect(self):
         """ Connects to Polyglot if not currently connected """
         if not self.connected:
             self._outq.locked = False
             self._errq.locked = False
             self._threads = {}
-            self._threads['stdin'] = AsyncFileReader(sys.stdin,
-                                                     self._parse_cmd)
+            if self._socket_path:
+                self._threads['socket'] = threading.Thread(
+                    target=self._socket_loop)
+                self._threads['socket'].daemon = True
+            else:
+                self._threads['stdin'] = AsyncFileReader(sys.stdin,
+                                                         self._parse_cmd)
             self._threads['stdout'] = threading.Thread(target=self._send_out)
             self._threads['stdout'].daemon = True
             self._threads['stderr'] = threading.Thread(target=self._send_err)
@@ -1282,24 +2150,28 @@ class PolyglotConnector(object):
         """ 
         Reads custom config file and presents it to node server as nodeserver_config 
         """
-        if YAML:
-            if self.configfile == None: 
-                self.smsg('**INFO: No custom "configfile" found in server.json. Trying the default of config.yaml.')
-                self.configfile = 'config.yaml'
-            else:
-                self.smsg('**INFO: Custom config file option found in server.json: {}'.format(self.configfile))
-            try:
-                with open(os.path.join(self.path, self.configfile), 'r') as cfg:
+        if self.configfile == None:
+            self.smsg('**INFO: No custom "configfile" found in server.json. Trying the default of config.yaml.')
+            self.configfile = 'config.yaml'
+        else:
+            self._smsg('**INFO: Custom config file option found in server.json: {}', self.configfile)
+        try:
+            with open(os.path.join(self.path, self.configfile), 'r') as cfg:
+                if not YAML:
+                    self.smsg('**ERROR: PyYAML module not installed... skipping custom config sections. "sudo pip install pyyaml" to use')
+                    return
+                # PyYAML is only loaded by node servers with a config file
+                import yaml
+                try:
                     self.nodeserver_config = yaml.safe_load(cfg)
-                    self.smsg('**INFO: {} - Config file loaded as dictionary to "poly.nodeserver_config"'.format(self.configfile))
-            except yaml.YAMLError, exc:
-                if hasattr(exc, 'problem_mark'):
-                    mark = exc.problem_mark
-                    self.smsg('**ERROR: Error in config file. Position: (Line: {}: Column: {})'.format(mark.line+1, mark.column+1))
-                    self.smsg('{} - '.format(exc))
-            except IOError as e:
-                self.smsg('**INFO: No config file found, or it is unreadable. This is normal if your nodeserver doesn\'t need a config file.')
-        else: self.smsg('**ERROR: PyYAML module not installed... skipping custom config sections. "sudo pip install pyyaml" to use')
+                    self._smsg('**INFO: {} - Config file loaded as dictionary to "poly.nodeserver_config"', self.configfile)
+                except yaml.YAMLError as exc:
+                    if hasattr(exc, 'problem_mark'):
+                        mark = exc.problem_mark
+                        self._smsg('**ERROR: Error in config file. Position: (Line: {}: Column: {})', mark.line+1, mark.column+1)
+                        self._smsg('{} - ', exc)
+        except IOError as e:
+            self.smsg('**INFO: No config file found, or it is unreadable. This is normal if your nodeserver doesn\'t need a config file.')
 
     def write_nodeserver_config(self, default_flow_style=False, indent=4):
         """
@@ -1314,6 +2186,7 @@ class PolyglotConnector(object):
         :param int indent: Override the default indent spaces for YAML. Default 4
         """
         if YAML:
+            import yaml
             try:
                 with open(os.path.join(self.path, self.configfile), 'r') as read:
                     existing = yaml.safe_load(read)
@@ -1356,9 +2229,36 @@ class PolyglotConnector(object):
             except Empty:
                 pass
             else:
-                sys.stdout.write('{}\n'.format(line))
+                self._write_out(line)
                 self._outq.task_done()
-                sys.stdout.flush()
+
+    def _write_out(self, line):
+        """
+        Write a line to Polyglot over the socket, waiting for a reconnect if
+        necessary, or to STDOUT.
+        """
+        if not self._socket_path:
+            sys.stdout.write('{}\n'.format(line))
+            sys.stdout.flush()
+            return
+        while True:
+            self._sock_ready.wait(5)
+            with self._sock_lock:
+                if self._sock_ready.is_set():
+                    try:
+                        send_frame(self._sock, line)
+                        return
+                    except socket.error:
+                        # the socket loop notices the close and reconnects
+                        self._sock_ready.clear()
+                        try:
+                            self._sock.shutdown(socket.SHUT_RDWR)
+                        except socket.error:
+                            # already reset by Polyglot
+                            pass
+            if self._outq.locked:
+                # shutting down and Polyglot is gone, drop the line
+                return
 
     def _send_err(self):
         """ Send error through pipe """
@@ -1368,9 +2268,53 @@ class PolyglotConnector(object):
             except Empty:
                 pass
             else:
-                sys.stderr.write('{}\n'.format(line))
+                try:
+                    sys.stderr.write('{}\n'.format(line))
+                    sys.stderr.flush()
+                except IOError:
+                    # Polyglot that started us is gone (socket interface)
+                    pass
                 self._errq.task_done()
-                sys.stderr.flush()
+
+    # manage socket connection
+    def _socket_loop(self):
+        """
+        Maintain the connection to the Polyglot socket. When the connection
+        drops it is re-established with backoff and the handshake repeated,
+        so Polyglot and the node server can restart independently.
+        """
+        delay = 0.5
+        while not self._outq.locked:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._socket_path)
+            except socket.error:
+                sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 10)
+                continue
+            delay = 0.5
+
+            # handshake, then resend our configuration if we are resuming
+            with self._sock_lock:
+                hello = {'pid': os.getpid(), 'resume': self._got_config}
+                try:
+                    send_frame(sock, json.dumps({'connected': hello}))
+                    if self._got_config and self._last_config is not None:
+                        send_frame(sock, json.dumps(
+                            {'config': self._last_config}))
+                except socket.error:
+                    sock.close()
+                    continue
+                self._sock = sock
+                self._sock_ready.set()
+
+            recv_frames(sock, self._parse_cmd)
+
+            with self._sock_lock:
+                self._sock_ready.clear()
+                self._sock = None
+            sock.close()
 
     # manage input
     def _parse_cmd(self, cmd):
@@ -1421,6 +2365,7 @@ class PolyglotConnector(object):
                 if '--debug' in sys.argv:
                     raise err
                 else:
+                    import traceback
                     err_msg = repr(err).replace('\n', '')
                     fun_name = fun.__name__
                     self.send_error('Error handling {} in function {}: {}'
@@ -1449,6 +2394,33 @@ class PolyglotConnector(object):
         self.profile = kwargs['profile']
         self.configfile = kwargs['configfile']
         self.path = kwargs['path']
+        # Polyglot API 2 and up takes log messages as structured messages
+        try:
+            self._log_frames = int(self.pgapiver) >= 2
+            self._config_patches = int(self.pgapiver) >= 3
+            self.status_batches = int(self.pgapiver) >= 4
+            self._poll_stats = int(self.pgapiver) >= 5
+        except (TypeError, ValueError):
+            self._log_frames = False
+            self._config_patches = False
+            self.status_batches = False
+            self._poll_stats = False
+        if 'loglevel' in kwargs:
+            self.set_loglevel(kwargs['loglevel'])
+        return True
+
+    def set_loglevel(self, level, **kwargs):
+        """
+        Set the level below which log messages are not sent to Polyglot.
+
+        :param level: Log level name (e.g. "WARNING") or number
+        """
+        # pylint: disable=unused-argument
+        if not isinstance(level, int):
+            level = logging.getLevelName(str(level).upper())
+        if not isinstance(level, int):
+            return False
+        self.loglevel = level
         return True
 
     def setup_log(self, sandbox, name):
@@ -1461,7 +2433,8 @@ class PolyglotConnector(object):
         logger.setLevel(log_level)
         # Make a handler that writes to a file,
         # making a new file at midnight, and keeping 30 backups
-        handler = logging.handlers.TimedRotatingFileHandler(
+        from logging.handlers import TimedRotatingFileHandler
+        handler = TimedRotatingFileHandler(
             self.log_filename, when="midnight", backupCount=30)
         # Format each log message like this
         formatter = logging.Formatter(
@@ -1489,15 +2462,57 @@ class PolyglotConnector(object):
 
         :param str err_str: Error text to be sent to Polyglot log
         """
-        self._errq.put(err_str.replace('\n', ''), True, 5)
-        
-    def smsg(self, str):
+        self.send_log(logging.ERROR, err_str)
+
+    def send_log(self, level, msg):
+        """
+        Enqueue a message for the Polyglot log, unless Polyglot does not log
+        messages of its level.
+
+        :param int level: Log level of the message
+        :param str msg: Message text
+        """
+        if level < self.loglevel:
+            return False
+        if self._log_frames:
+            self._mk_cmd('log', level=logging.getLevelName(level), msg=msg)
+        else:
+            # older Polyglot: level prefixed text on STDERR
+            for prefix, prefix_level in SMSG_LEVELS:
+                if prefix_level == level and level != logging.ERROR:
+                    msg = prefix + msg
+                    break
+            self._errq.put(msg.replace('\n', ''), True, 5)
+        return True
+
+    def smsg(self, str, *args):
         """
         Logs/sends a diagnostic/debug, informative, or error message.
         Individual node servers can override this method if they desire to
-        redirect or filter these messages.
-        """
-        self.send_error(str)
+        redirect or filter these messages. An override should take the
+        str.format args, as ``smsg(self, str, *args)``; overrides that take
+        only the message are given it already formatted.
+
+        The level is taken from a "**DEBUG: ", "**INFO: ", "**WARNING: " or
+        "**ERROR: " prefix (ERROR if there is none). Messages below Polyglot's
+        log level are dropped before any args are formatted into the message
+        with str.format.
+        """
+        level = logging.ERROR
+        for prefix, prefix_level in SMSG_LEVELS:
+            if str.startswith(prefix):
+                level = prefix_level
+                str = str[len(prefix):]
+                break
+        if level < self.loglevel:
+            return False
+        if args:
+            str = str.format(*args)
+        return self.send_log(level, str)
+
+    def _smsg(self, str, *args):
+        """ Private method - smsg, also for overrides without args. """
+        return _call_smsg(self, str, *args)
 
     def send_config(self, config_data):
         """
@@ -1507,10 +2522,30 @@ class PolyglotConnector(object):
         :raises: ValueError
         """
         if isinstance(config_data, dict):
+            self._last_config = config_data
             self._mk_cmd('config', **config_data)
             return True
         raise ValueError('send_config: config_data must be dictionary')
 
+    def send_config_patch(self, config_data, changed, removed):
+        """
+        Update parts of the configuration in Polyglot. Polyglot versions
+        before API 3 are sent the whole configuration instead.
+
+        :param dict config_data: Dictionary of the whole updated configuration
+        :param list changed: (path, value) pairs, a path being a list of keys
+        :param list removed: Paths removed from the configuration
+        :raises: ValueError
+        """
+        if not isinstance(config_data, dict):
+            raise ValueError('send_config_patch: config_data must be dictionary')
+        if not self._config_patches:
+            return self.send_config(config_data)
+        self._last_config = config_data
+        self._mk_cmd('config_patch', set=[[path, value] for path, value in changed],
+                     delete=list(removed))
+        return True
+
     def install(self, *args, **kwargs):
         """
         Abstract method to install the node server in the ISY. This has not
@@ -1544,6 +2579,25 @@ class PolyglotConnector(object):
                      driver_control=driver_control, value=value, uom=uom,
                      timeout=timeout, seq=seq)
 
+    def report_status_batch(self, statuses, timeout=None, seq=None):
+        """
+        Updates the ISY with the current values of several driver controls,
+        of one or more nodes. Polyglot sends the reports to the ISY together
+        and answers with one result, whose *statuses* are the status codes of
+        the reports, in order. Polyglot versions before API 4 do not take
+        batches (see status_batches).
+
+        :param list statuses: [node_address, driver_control, value, uom] of
+                              each report
+        :param timeout: (optional) timeout (seconds) for each REST call to ISY
+        :type timeout: str, float, or int
+        :param seq: (optional) set to unique id if result callback desired
+        :type seq: str or int
+        """
+        self._mk_cmd('status_batch',
+                     statuses=[list(status) for status in statuses],
+                     timeout=timeout, seq=seq)
+
     def report_command(self, node_address, command, value=None, uom=None,
                        timeout=None, seq=None, **kwargs):
         """
@@ -1694,6 +2748,20 @@ class PolyglotConnector(object):
         self._mk_cmd('statistics')
         return True
 
+    def send_poll_stats(self, stats):
+        """
+        Sends the statistics of the node server's poll scheduler to Polyglot,
+        which shows them in the node server's stats. Polyglot versions before
+        API 5 do not take them.
+
+        :param dict stats: The statistics, as from NodeServer.poll_stats
+        :returns bool: True if they were sent
+        """
+        if not self._poll_stats:
+            return False
+        self._mk_cmd('poll_stats', **stats)
+        return True
+
     def exit(self, *args, **kwargs):
         """
         Tells Polyglot that this Node Server is done.
@@ -1720,3 +2788,114 @@ class PolyglotConnector(object):
 
         self._handlers[event].append(handler)
         return True
+
+
+class InProcessConnector(PolyglotConnector):
+    """
+    Connector of a node server that Polyglot runs on its own threads (the
+    "plugin" interface in server.json). It is what ``PolyglotConnector()``
+    returns on a plugin thread. Messages are handed to Polyglot as
+    dictionaries, with no encoding, and messages from Polyglot are taken from
+    the plugin's request queue and handled on a dispatch thread.
+    """
+    _singleton = False
+
+    def __init__(self):
+        self._host = _PLUGIN.host
+        super(InProcessConnector, self).__init__()
+        self._connected = False
+        self._config_event = threading.Event()
+        # Polyglot is the same version as this SDK
+        self._log_frames = True
+        self._config_patches = True
+        self.status_batches = True
+        self._poll_stats = True
+        _PLUGIN.connector = self
+        self._host.attach(self)
+
+    @property
+    def connected(self):
+        """
+        Indicates if the object is connected to Polyglot.
+
+        :type: boolean
+        """
+        return self._connected
+
+    @connected.setter
+    def connected(self, val):
+        """ Setter that connects object to Polyglot """
+        if val:
+            self.connect()
+        else:
+            self.disconnect()
+
+    @property
+    def attached(self):
+        """
+        Indicates if Polyglot still runs this node server. Only a plugin can
+        be detached, when Polyglot stops or restarts it.
+
+        :type: boolean
+        """
+        return self._host.attached(self)
+
+    def connect(self):
+        """ Starts handling messages from Polyglot """
+        if not self._connected:
+            self._connected = True
+            self._threads = {'dispatch': threading.Thread(
+                target=self._dispatch, name='{}-dispatch'.format(
+                    self._host.name))}
+            self._threads['dispatch'].daemon = True
+            self._threads['dispatch'].start()
+
+    def disconnect(self):
+        """ Stops handling messages from Polyglot """
+        self._connected = False
+        self._threads = {}
+
+    def wait_for_config(self):
+        """ Blocks the thread until the configuration is received """
+        self._config_event.wait()
+        super(InProcessConnector, self).wait_for_config()
+
+    def _recv_config(self, *args, **kwargs):
+        """ note that the config has been received. """
+        self._config_event.set()
+        return super(InProcessConnector, self)._recv_config(*args, **kwargs)
+
+    def setup_log(self, sandbox, name):
+        # a restarted plugin gets the logger of its previous run, drop the
+        # handlers it left on it
+        logger = logging.getLogger(name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        # keep the node server log out of Polyglot's own
+        logger = super(InProcessConnector, self).setup_log(sandbox, name)
+        logger.propagate = False
+        return logger
+
+    def _dispatch(self):
+        """ Handle messages from Polyglot. (Runs in its own thread) """
+        _PLUGIN.connector = self
+        while self._connected and self._host.attached(self):
+            message = self._host.receive(self)
+            if message is None:
+                continue
+            cmd_code, args = list(message.items())[0]
+            if cmd_code not in self.commands:
+                self.send_error('Received invalid command: {}'
+                                .format(message))
+                continue
+            self._recv(cmd_code, args)
+
+    def _mk_cmd(self, cmd_code, **kwargs):
+        """
+        Hand a command to Polyglot.
+
+        :param cmd_code: Command code
+        :param args: arguments to send with command
+        """
+        self._host.deliver(self, {cmd_code: kwargs})
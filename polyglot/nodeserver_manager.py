@@ -1,15 +1,22 @@
 ''' The element management module for Polyglot '''
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 import copy
+import errno
 import json
 import logging
 import os
-from polyglot import SOURCE_DIR
-from polyglot.utils import AsyncFileReader, Queue, Empty, MyProcessLookupError
+from polyglot import PYTHON_PATH
+from polyglot.utils import AsyncFileReader, AsyncSocketReader, Queue, Empty, \
+    MyProcessLookupError, send_frame, Scheduler, Histogram, monotonic, \
+    ProcessSampler, TraceRing, Recorder, process_identity
 from polyglot.version import PGVERSION
+from polyglot.zygote import Zygote
 import polyglot.nodeserver_helpers as helpers
 import random
+import re
+import signal
+import socket
 import string
 import subprocess
 import sys
@@ -29,11 +36,83 @@ ELEMENT = 'core'
 SERVER_TYPES = {'python': [sys.executable],
                 'node': ['/usr/bin/node']}
 NS_QUIT_WAIT_TIME = 5
+# Seconds between pings; a node server that has not answered the previous
+# ping by the next one has stopped responding
+NS_PING_INTERVAL = 30
+# Seconds between checks for failed node servers
+NS_SUPERVISE_INTERVAL = 5
+# Longest wait between attempts when accepting socket connections fails
+NS_ACCEPT_BACKOFF_MAX = 5
+# Restart delay doubles from the minimum for each recent restart
+NS_RESTART_BACKOFF_MIN = 5
+NS_RESTART_BACKOFF_MAX = 300
+# This many restarts within the window is a crash loop; the node server is
+# then left stopped until it is restarted by hand
+NS_CRASH_LOOP_RESTARTS = 5
+NS_CRASH_LOOP_WINDOW = 600
+# Failures remembered for the stats
+NS_FAILURE_HISTORY = 20
+# Messages from the ISY held while a node server is down, replayed when it is
+# back (oldest are dropped beyond this)
+NS_HOLD_SIZE = 1000
+NS_HOLD_COMMANDS = ('query', 'status', 'add_all', 'added', 'removed',
+                    'renamed', 'enabled', 'disabled', 'cmd')
+# Seconds between samples of process CPU and memory use (configuration.json
+# "sample_interval", 0 to disable) and the number of samples kept
+NS_SAMPLE_INTERVAL = 10
+NS_SAMPLE_HISTORY = 60
+# What to do when a node server goes over its soft memory limit
+# (server.json "rss_limit" in MB and "rss_action")
+NS_RSS_ACTIONS = ('warn', 'restart')
+# Messages traced: one in every "trace_sample" (configuration.json, 0 for
+# none) of the messages to and from node servers is kept in a ring of this
+# size. Traced messages are also logged at debug level.
+NS_TRACE_SIZE = 2000
+NS_TRACE_SAMPLE = 0
+
+# Request queue capacity per node server, shared between its worker lanes
+NS_REQUEST_QUEUE_SIZE = 4096
+# Seconds over which request lane utilisation is measured
+NS_LANE_UTIL_WINDOW = 60.0
+# What to do with a message for a full request queue (server.json "overload")
+#   drop_oldest: discard the oldest queued status report to make room
+#   drop_newest: discard the incoming message
+#   coalesce:    replace a queued status report for the same node driver,
+#                otherwise drop_oldest
+#   reject:      refuse the incoming message with an error result
+NS_OVERLOAD_POLICIES = ('drop_oldest', 'drop_newest', 'coalesce', 'reject')
+NS_OVERLOAD_DEFAULT = 'coalesce'
+# Result status codes sent for messages that never reached the ISY.
+# (1-4 are the connection errors used by the ISY element)
+NS_OVERLOAD_STATUS = {'dropped': 5, 'coalesced': 5, 'rejected': 6}
+
+# Python node servers are forked from a preloaded zygote process when
+# configuration.json has "zygote" (true, or a list of modules to preload
+# besides the node server SDK)
+NS_ZYGOTE = False
 
 # Global manager diagnostics/performance data structures
 NSLOCK = threading.Lock()
 NSMGR = None
 NSSTATS = {}
+# MQTT connections shared by node servers, by broker (server, port)
+MQTT_LOCK = threading.Lock()
+MQTT_CONNECTIONS = {}
+# Polyglot's own status on the broker, and its will message: the one topic
+# MQTT node servers watch to learn that Polyglot was lost
+MQTT_STATUS_TOPIC = 'udi/polyglot/connection'
+# Messages published while a broker connection is down, at most
+MQTT_QUEUE_SIZE = 1000
+# The zygote, while it is running
+ZYGOTE = None
+# Single thread that runs the heartbeat of every node server
+HEARTBEAT = Scheduler('heartbeat')
+# Single thread that restarts failed node servers
+SUPERVISOR = Scheduler('supervisor')
+# Sampled trace of node server messages. Directions are "in" (from the node
+# server), "out" (to the node server) and "isy" (a request handled)
+TRACE = TraceRing(('server', 'direction', 'command', 'size', 'depth',
+                   'elapsed'), NS_TRACE_SIZE)
 
 # Increment this version number each time a breaking change is made or a
 # major new message (feature) is added to the API between the node server
@@ -42,7 +121,7 @@ NSSTATS = {}
 # installed version of Polyglot -- keep in mind that the client node server
 # is independent of Polyglot, and may not even be implemented in Python --
 # and thus has no other way to know about the Polyglot server itself.
-PGAPIVER = '1'
+PGAPIVER = '5'
 
 class NodeServerManager(object):
     """
@@ -58,6 +137,8 @@ class NodeServerManager(object):
 
     def __init__(self, pglot):
         self.pglot = pglot
+        self.process = ProcessSampler(NS_SAMPLE_HISTORY)
+        self._supervising = False
 
     def __getitem__(self, key):
         """ Get server by base name. """
@@ -83,6 +164,12 @@ class NodeServerManager(object):
         # find node server
         path = helpers.get_path(ns_platform)
         interface, mqtt_server, mqtt_port = (None,)*3
+        workers = 1
+        overload = NS_OVERLOAD_DEFAULT
+        rss_limit = None
+        rss_action = 'warn'
+        retain_state = False
+        zygote = True
         # read node server attributes
         try:
             def_file = os.path.join(path, 'server.json')
@@ -108,17 +195,46 @@ class NodeServerManager(object):
 
         try:
             interface = definition['interface'].lower()
-            if interface != 'mqtt': 
-                interface = 'Default'
-                _LOGGER.info('Using interface type ' + interface)
-            else:
+            if interface == 'mqtt':
                 mqtt_server = definition['mqtt_server']
                 mqtt_port = definition['mqtt_port']
                 _LOGGER.info('Using interface type ' + interface + ' at ' + mqtt_server+ ":" + mqtt_port)
+            elif interface in ('socket', 'plugin'):
+                _LOGGER.info('Using interface type ' + interface)
+            else:
+                interface = 'Default'
+                _LOGGER.info('Using interface type ' + interface)
         except (IOError, ValueError, KeyError):
             interface = 'Default'
             _LOGGER.info('Using interface type ' + interface)
 
+        try:
+            workers = max(1, int(definition.get('workers', 1)))
+        except (TypeError, ValueError):
+            _LOGGER.error('Bad workers option in server.json for %s', ns_platform)
+
+        if definition.get('overload', overload) in NS_OVERLOAD_POLICIES:
+            overload = definition.get('overload', overload)
+        else:
+            _LOGGER.error('Bad overload option in server.json for %s', ns_platform)
+
+        try:
+            if definition.get('rss_limit'):
+                rss_limit = int(float(definition['rss_limit']) * 1024 * 1024)
+        except (TypeError, ValueError):
+            _LOGGER.error('Bad rss_limit option in server.json for %s', ns_platform)
+
+        if definition.get('rss_action', rss_action) in NS_RSS_ACTIONS:
+            rss_action = definition.get('rss_action', rss_action)
+        else:
+            _LOGGER.error('Bad rss_action option in server.json for %s', ns_platform)
+
+        if interface == 'mqtt':
+            retain_state = bool(definition.get('retain_state', False))
+
+        if definition.get('zygote') is False:
+            zygote = False
+
         # get server base name
         while base in self.servers or base is None:
             base = random_string(5)
@@ -131,7 +247,9 @@ class NodeServerManager(object):
             server = NodeServer(self.pglot, ns_platform, profile_number,
                                 nstype, nsexe, nsname or ns_platform,
                                 config or {}, sandbox, configfile,
-                                interface, mqtt_server, mqtt_port)
+                                interface, mqtt_server, mqtt_port, workers,
+                                overload, rss_limit, rss_action,
+                                retain_state, zygote)
         except Exception:
             _LOGGER.exception('Node Server %s could not start', ns_platform)
             raise ValueError(
@@ -145,6 +263,7 @@ class NodeServerManager(object):
         """ Initial load of the active Node Servers """
         _LOGGER.info('Loading Node Servers')
 
+        self._start_zygote()
         nsconfigs = self.pglot.config.get("nodeservers", [])
         for count, nsconfig in enumerate(nsconfigs, 1):
             ns_platform = nsconfig.get("platform", None)
@@ -159,11 +278,190 @@ class NodeServerManager(object):
                     'Node Server %d', count)
             else:
                 try:
-                    self.start_server(
-                        ns_platform, profile_number, name, url_base, config)
+                    with self.pglot.startup.phase(name):
+                        self.start_server(ns_platform, profile_number, name,
+                                          url_base, config)
                 except ValueError as err:
                     _LOGGER.error(err.args[0])
 
+        TRACE.every = self.pglot.config.get('trace_sample', NS_TRACE_SAMPLE)
+
+        if not self._supervising:
+            self._supervising = True
+            SUPERVISOR.call_later(NS_SUPERVISE_INTERVAL, self._supervise)
+
+            interval = self.pglot.config.get('sample_interval',
+                                             NS_SAMPLE_INTERVAL)
+            if not interval:
+                _LOGGER.info('Process sampling is disabled')
+            elif not os.path.isdir('/proc'):
+                _LOGGER.info('Process sampling is not available (no /proc)')
+            else:
+                SUPERVISOR.call_later(0, self._sample, interval)
+
+    def _start_zygote(self):
+        """ Start the zygote, if it is enabled and not running. """
+        # pylint: disable=global-statement
+        global ZYGOTE
+        setting = self.pglot.config.get('zygote', NS_ZYGOTE)
+        if not setting or (ZYGOTE is not None and ZYGOTE.alive):
+            return
+        preload = setting if isinstance(setting, list) else ()
+        try:
+            with self.pglot.startup.phase('zygote'):
+                ZYGOTE = Zygote(SERVER_TYPES['python'][0], preload,
+                                {'PYTHONPATH': os.pathsep.join(PYTHON_PATH)})
+        except (OSError, RuntimeError) as err:
+            ZYGOTE = None
+            _LOGGER.error('Zygote could not start, Python Node Servers will ' +
+                          'be started directly: %s', err)
+        else:
+            _LOGGER.info('Started zygote (%d), preloaded %s', ZYGOTE.pid,
+                         ', '.join(ZYGOTE.preload))
+
+    @property
+    def process_stats(self):
+        """ CPU and memory use of Polyglot and its node servers. """
+        return {'polyglot': self.process.stats,
+                'zygote': ZYGOTE.stats if ZYGOTE is not None else None,
+                'servers': dict((base, {'name': node_server.name,
+                                        'process': node_server.process.stats})
+                                for base, node_server in self.servers.items())}
+
+    @staticmethod
+    def trace(sample=None):
+        """
+        Sampled trace of node server messages, oldest first.
+
+        :param sample: If given, trace one message in this many from now on
+                       (0 for none)
+        """
+        if sample is not None:
+            TRACE.every = sample
+        return {'sample': TRACE.every, 'records': TRACE.dump()}
+
+    def _sample(self, interval):
+        """
+        Sample the CPU and memory use of Polyglot and its node servers and
+        enforce their soft memory limits.
+        (Called from the supervisor scheduler)
+        """
+        if not self._supervising:
+            return
+        self.process.sample(os.getpid())
+        for node_server in list(self.servers.values()):
+            if node_server.pid is None:
+                continue
+            sample = node_server.process.sample(node_server.pid)
+            if sample is not None and node_server.rss_limit:
+                self._check_rss(node_server, sample['rss'])
+
+        SUPERVISOR.call_later(interval, self._sample, interval)
+
+    def _check_rss(self, node_server, rss):
+        """ Warn about, or restart, a node server over its memory limit. """
+        if rss <= node_server.rss_limit:
+            node_server.over_rss_limit = False
+            return
+        if not node_server.over_rss_limit:
+            node_server.over_rss_limit = True
+            _LOGGER.warning('Node Server %s is using %d MB, over its %d MB ' +
+                            'limit.', node_server.name, rss // 1048576,
+                            node_server.rss_limit // 1048576)
+        if node_server.rss_action == 'restart' and not node_server.stopped \
+                and not node_server.crash_loop \
+                and node_server.restart_due is None:
+            delay = self._schedule_restart(node_server, None, 'rss_limit')
+            if delay is None:
+                _LOGGER.error(
+                    'Node Server %s was restarted %d times in %d seconds. ' +
+                    'Not restarting it to free memory.', node_server.name,
+                    NS_CRASH_LOOP_RESTARTS, NS_CRASH_LOOP_WINDOW)
+            else:
+                _LOGGER.warning('Restarting Node Server %s in %d seconds to ' +
+                                'free memory.', node_server.name, delay)
+
+    def _schedule_restart(self, node_server, exit_code, reason):
+        """
+        Record a failure of a node server and schedule its restart, after a
+        delay that doubles with each recent restart. Returns the delay, or
+        None if the node server is in a crash loop and is left stopped.
+        """
+        now = monotonic()
+        recent = [when for when in node_server.restart_times
+                  if now - when < NS_CRASH_LOOP_WINDOW]
+        node_server.failures.append({'time': time.time(),
+                                     'exit_code': exit_code,
+                                     'reason': reason})
+        if len(recent) >= NS_CRASH_LOOP_RESTARTS:
+            node_server.crash_loop = True
+            return None
+        delay = min(NS_RESTART_BACKOFF_MAX,
+                    NS_RESTART_BACKOFF_MIN * 2 ** len(recent))
+        node_server.restart_due = now + delay
+        SUPERVISOR.call_later(delay, self._restart, node_server)
+        return delay
+
+    def _supervise(self):
+        """
+        Schedule restarts of node servers that have failed.
+        (Called from the supervisor scheduler)
+        """
+        if not self._supervising:
+            return
+        if ZYGOTE is not None and not ZYGOTE.alive:
+            _LOGGER.warning('Zygote has exited. Restarting it.')
+            self._start_zygote()
+        for node_server in list(self.servers.values()):
+            if node_server.stopped or node_server.crash_loop or \
+                    node_server.restarting or \
+                    node_server.restart_due is not None or node_server.alive:
+                continue
+
+            exit_code = node_server.exit_code
+            delay = self._schedule_restart(node_server, exit_code, 'exited')
+            if delay is None:
+                _LOGGER.error(
+                    'Node Server %s failed (exit code %s) %d times in %d ' +
+                    'seconds. Not restarting it.', node_server.name,
+                    exit_code, NS_CRASH_LOOP_RESTARTS + 1,
+                    NS_CRASH_LOOP_WINDOW)
+                continue
+            _LOGGER.warning(
+                'Node Server %s failed (exit code %s). Restarting in %d ' +
+                'seconds.', node_server.name, exit_code, delay)
+
+        SUPERVISOR.call_later(NS_SUPERVISE_INTERVAL, self._supervise)
+
+    def _restart(self, node_server):
+        """
+        Restart a failed node server, on a thread of its own as restarting
+        waits for the old process.
+        (Called from the supervisor scheduler)
+        """
+        if node_server.restart_due is None or \
+                node_server not in self.servers.values():
+            # restarted by hand or deleted in the meantime
+            return
+        node_server.restart_times.append(monotonic())
+        node_server.failures[-1]['restarted'] = time.time()
+        thread = threading.Thread(target=self._run_restart, args=(node_server,),
+                                  name='restart-{}'.format(node_server.name))
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _run_restart(node_server):
+        """ Restart a failed node server. (Runs in its own thread) """
+        try:
+            node_server.restart()
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Node Server %s could not restart',
+                              node_server.name)
+            # counts as another failure
+            node_server.stopped = False
+            node_server.restart_due = None
+
     def delete(self, base_url):
         """ Remove a server from Polyglot. """
         node_server = self.servers[base_url]
@@ -176,10 +474,20 @@ class NodeServerManager(object):
         else:
             node_server.kill()
 
+        node_server.release()
         del self.servers[base_url]
 
+    def send_loglevel(self):
+        """ Pass a change of the log level on to all node servers. """
+        for node_server in self.servers.values():
+            node_server.send_loglevel()
+
     def unload(self):
         """ Unload all node servers """
+        # pylint: disable=global-statement
+        global ZYGOTE
+        self._supervising = False
+
         # request node server shutdowns
         for node_server in self.servers.values():
             node_server.send_exit()
@@ -201,6 +509,11 @@ class NodeServerManager(object):
                 _LOGGER.warning(
                     'Timed out waiting for Node Server %s to quit. ' +
                     'Terminated Node Server.', node_server.name)
+            node_server.release()
+
+        if ZYGOTE is not None:
+            ZYGOTE.stop()
+            ZYGOTE = None
 
         _LOGGER.info('Unloaded Node Servers')
 
@@ -211,7 +524,9 @@ class NodeServer(object):
 
     def __init__(self, pglot, ns_platform, profile_number, nstype, nsexe,
                  nsname, config, sandbox, configfile=None, interface=None,
-                 mqtt_server=None, mqtt_port=None):
+                 mqtt_server=None, mqtt_port=None, workers=1,
+                 overload=NS_OVERLOAD_DEFAULT, rss_limit=None,
+                 rss_action='warn', retain_state=False, zygote=True):
         # build run command
         if nstype in SERVER_TYPES:
             cmd = copy.deepcopy(SERVER_TYPES[nstype])
@@ -219,6 +534,10 @@ class NodeServer(object):
             _LOGGER.error("Unrecognized server type %s for %s", nstype,
                           ns_platform)
             raise TypeError('bad server type')
+        if interface == 'plugin' and nstype != 'python':
+            _LOGGER.error('Only Python node servers can be plugins (%s)',
+                          ns_platform)
+            raise TypeError('bad server type')
         cmd.append(nsexe)
 
         self.pglot = pglot
@@ -236,6 +555,19 @@ class NodeServer(object):
         self.interface = interface
         self.mqtt_server = mqtt_server
         self.mqtt_port = mqtt_port
+        self.workers = workers
+        self.overload = overload
+        self.rss_limit = rss_limit
+        self.rss_action = rss_action
+        self.over_rss_limit = False
+        self.retain_state = retain_state
+        self.zygote = zygote and nstype == 'python'
+        self.process = ProcessSampler(NS_SAMPLE_HISTORY)
+        self.file_name = re.sub(r'[^A-Za-z0-9_.-]', '_', nsname)
+        self.socket_path = None
+        if self.interface == 'socket':
+            self.socket_path = os.path.join(self.sandbox,
+                                            self.file_name + '.sock')
         self.node_connected = False
         self.pgver =  PGVERSION
         self.pgapiver = PGAPIVER
@@ -249,17 +581,43 @@ class NodeServer(object):
                        'path': self.path,
                        'interface': self.interface,
                        'mqtt_server': self.mqtt_server,
-                       'mqtt_port': self.mqtt_port}
+                       'mqtt_port': self.mqtt_port,
+                       'socket': self.socket_path,
+                       'loglevel': node_log_level()}
         self._proc = None
+        self._pid = None
         self._inq = None
         self._rqq = None
         self._mqtt = None
+        self._socket = None
+        self._plugin = None
         self._lastping = None
         self._lastpong = None
+        self._responding = True
+        self._rtt = Histogram()
+        self._beat = None
+        self._generation = 0
+        self._overload_logged = 0
+        self._held = deque(maxlen=NS_HOLD_SIZE)
+        self._recorder = None
+        self._lock = threading.RLock()
+        self._started = None
+        self._first_message = None
+        self._boot = True
+        # the node server's poll scheduler statistics, as it last sent them
+        self._poll_stats = None
+        # supervision state (managed by NodeServerManager)
+        self.stopped = False
+        self.crash_loop = False
+        self.restart_due = None
+        self.restarting = False
+        self.restart_times = deque(maxlen=NS_CRASH_LOOP_RESTARTS)
+        self.failures = deque(maxlen=NS_FAILURE_HISTORY)
 
         # define handlers
         isy = self.pglot.elements.isy
         self._handlers = {'status': isy.report_node_status,
+                          'status_batch': isy.report_node_status_batch,
                           'command': isy.report_command,
                           'add': isy.node_add,
                           'change': isy.node_change,
@@ -271,32 +629,73 @@ class NodeServer(object):
 
     def start(self):
         """ start the node server """
-        # start process
-        proc = subprocess.Popen(
-            self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, bufsize=1, env={'PYTHONPATH': SOURCE_DIR},
-            cwd=self.sandbox)
-
-        self._proc = proc
         self._inq = Queue()
-        self._rqq = Queue(maxsize=4096)
+        self._rqq = RequestLanes(self.name, self._handle_request,
+                                 self.workers, NS_REQUEST_QUEUE_SIZE,
+                                 self.overload, self._discard_request,
+                                 self._batch_result)
         self._lastping = None
         self._lastpong = None
+        self._responding = True
+        self._started = monotonic()
+        self._first_message = None
 
         # Create threads dictionary
         self._threads = {}
-        # Add 'stdout' thread that attaches to STDOUT of nodeserver process with _recv_out
-        self._threads['stdout'] = AsyncFileReader(self._proc.stdout,
-                                                  self._recv_out)
-        # Add 'stderr' thread that attaches to STERR of nodeserver process with _recv_err
-        self._threads['stderr'] = AsyncFileReader(self._proc.stderr,
-                                                  self._recv_err)
-        # Add 'requests' thread that attaches to REST inbound commands and daemonize it
-        self._threads['requests'] = threading.Thread(target=self._request_handler)
-        self._threads['requests'].daemon = True
-        # Add 'stdin' thread that attaches to STDIN of nodeserver
-        self._threads['stdin'] = threading.Thread(target=self._send_in)
-        self._threads['stdin'].daemon = True
+
+        # Socket interface: listen before the node server is launched
+        if self.interface == 'socket':
+            if self._socket is None:
+                self._socket = socketSubsystem(self)
+            self._socket.start()
+        pid = self._socket.adoptable_pid() if self._socket else None
+
+        if self.interface == 'plugin':
+            # run on our own threads, with no process or pipes
+            self._proc = None
+            self._pid = None
+            self._plugin = pluginSubsystem(self)
+            self._plugin.start()
+        elif pid:
+            # A node server left running by a previous Polyglot process will
+            # reconnect to the socket by itself, so do not launch another.
+            self._proc = None
+            self._pid = pid
+            _LOGGER.info('Node Server %s: adopting running process %d',
+                         self.name, pid)
+        else:
+            # start process
+            env = {'PYTHONPATH': os.pathsep.join(PYTHON_PATH)}
+            if self.socket_path:
+                env['POLYGLOT_SOCKET'] = self.socket_path
+            proc = None
+            if self.zygote and ZYGOTE is not None:
+                try:
+                    proc = ZYGOTE.spawn(self.exe, self.sandbox, env)
+                except RuntimeError as err:
+                    _LOGGER.error('Node Server %s: %s. Starting it directly.',
+                                  self.name, err)
+            if proc is None:
+                proc = subprocess.Popen(
+                    self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, bufsize=1, env=env,
+                    cwd=self.sandbox)
+
+            self._proc = proc
+            self._pid = proc.pid
+
+            # Add 'stdout' thread that attaches to STDOUT of nodeserver process with _recv_out
+            self._threads['stdout'] = AsyncFileReader(self._proc.stdout,
+                                                      self._recv_out)
+            # Add 'stderr' thread that attaches to STERR of nodeserver process with _recv_err
+            self._threads['stderr'] = AsyncFileReader(self._proc.stderr,
+                                                      self._recv_err)
+        # Add 'stdin' thread that attaches to STDIN of nodeserver (plugins
+        # take their input from the queue themselves)
+        if self._plugin is None:
+            self._threads['stdin'] = threading.Thread(
+                target=self._send_in, args=(self._inq, self._proc))
+            self._threads['stdin'].daemon = True
         for _, thread in self._threads.items():
             thread.start()
 
@@ -315,29 +714,60 @@ class NodeServer(object):
                 self._mqtt = mqttSubsystem(self)
             self._mqtt.start()
 
-        # If we aren't using MQTT
-        if self._mqtt is None:
+        # Plugins are sent their parameters and configuration at once
+        if self._plugin is not None:
+            self.send_params()
+            self.send_config()
+        # If we aren't using MQTT or the socket (which handshakes on connect)
+        elif self._mqtt is None and self._socket is None:
             # wait, then send config
             time.sleep(1)
             self.send_params()        
             self.send_config()
 
+        # Replay messages from the ISY that arrived while it was down
+        if self._held:
+            _LOGGER.info('%8s replaying %d held messages', self.name,
+                         len(self._held))
+        while self._held:
+            self._inq.put(self._held.popleft())
+        self.stopped = False
+        self.restart_due = None
+
+        # Start the heartbeat, spread out so node servers are not all
+        # pinged at once
+        self._generation += 1
+        HEARTBEAT.cancel(self._beat)
+        self._beat = HEARTBEAT.call_later(random.uniform(1, 5),
+                                          self._heartbeat, self._generation)
+
         _LOGGER.info('Started Node Server: %s:%s (%s)',
-                     self.platform, self.name, self._proc.pid)
+                     self.platform, self.name, self._pid)
 
     def restart(self):
         """ restart the nodeserver """
-        self.send_exit()
-        if self._mqtt is not None:
-            self._mqtt.stop()
-
-        for _ in range(10):
-            if not self.alive:
-                break
-            time.sleep(0.5)
-        else:
-            self.kill()
-        self.start()
+        with self._lock:
+            self.restarting = True
+            try:
+                self.crash_loop = False
+                self.restart_due = None
+                self.send_exit()
+                if self._mqtt is not None:
+                    self._mqtt.stop()
+
+                for _ in range(10):
+                    if not self.alive:
+                        break
+                    time.sleep(0.5)
+                else:
+                    self.kill()
+                # keep what the old process was not sent, retire its writer
+                # and its request lanes
+                self._hold_input()
+                self._stop_requests()
+                self.start()
+            finally:
+                self.restarting = False
 
     @property
     def definition(self):
@@ -359,152 +789,378 @@ class NodeServer(object):
     @property
     def alive(self):
         """ Indicates if the Node Server is running. """
-        try:
-            os.kill(self._proc.pid, 0)
-        except MyProcessLookupError:
+        if self._plugin is not None:
+            if not self._plugin.alive:
+                return False
+        elif self._proc is not None:
+            if self._proc.poll() is not None:
+                return False
+        elif self._pid is None or not pid_alive(self._pid):
             return False
         return self._inq is not None
 
+    @property
+    def pid(self):
+        """ Process ID of the node server, None if not started. """
+        return self._pid
+
+    @property
+    def exit_code(self):
+        """ Exit code of the node server process, None if not known. """
+        if self._proc is not None:
+            return self._proc.poll()
+        return None
+
     @property
     def responding(self):
-        """ Indicates if the Node Server is responding. """
-        if self._lastping is None:
-            # node server has not been pinged
-            self.send_ping()
-            self._lastping = time.time()
-            return True
-        elif time.time() - self._lastping >= 30:
-            # If MQTT is not connected, assume we are trying to reconnect and don't send a ping
-            if self._mqtt is not None and (self._mqtt.connected == False or self.node_connected == False): return True
-            # last ping has expired (more than 30 seconds old)
-            if self._lastpong and self._lastpong > self._lastping:
-                # pong was received
-                self._lastping = time.time()
-                self.send_ping()
-                return True
+        """
+        Indicates if the Node Server is responding, as of its last heartbeat.
+        """
+        return self._responding
+
+    def _heartbeat(self, generation):
+        """
+        Check that the node server answered the last ping and send the next.
+        Gives up on the node server if it did not.
+        (Called from the heartbeat scheduler)
+        """
+        if generation != self._generation or self._inq is None:
+            # node server was stopped or restarted
+            return
+        now = monotonic()
+        pending = self._lastping is not None and \
+            (self._lastpong is None or self._lastpong < self._lastping)
+        if self._socket is not None and not self._socket.connected:
+            # the node server is reconnecting for as long as it is alive
+            self._responding = self.alive
+        elif self._mqtt is not None and \
+                (not self._mqtt.connected or not self.node_connected):
+            # assume we are trying to reconnect and don't send a ping
+            self._responding = True
+        elif pending and now - self._lastping >= NS_PING_INTERVAL:
+            # pong was not received
+            if self._lastpong is not None:
+                _LOGGER.warning('Node Server %s: time since last pong: %5.2f',
+                                self.name, (now - self._lastpong))
             else:
-                # pong was not received
-                if self._lastpong is not None:
-                    _LOGGER.warning('Node Server %s: time since last pong: %5.2f',
-                                self.name, (time.time() - self._lastpong))
-                else:
-                    _LOGGER.warning('Node Server %s: Never received a pong response.', self.name)
-                return False
+                _LOGGER.warning('Node Server %s: Never received a pong response.', self.name)
+            self._responding = False
         else:
-            # ping hasn't expired, we have to assume responding
-            time.sleep(1)
-            return True
+            self._responding = True
+            if not pending:
+                self.send_ping()
+
+        if self._responding:
+            self._beat = HEARTBEAT.call_later(NS_PING_INTERVAL,
+                                              self._heartbeat, generation)
+        else:
+            self._beat = None
+            self._unresponsive()
+
+    def _unresponsive(self):
+        """ Give up on a node server that has stopped responding. """
+        _LOGGER.error('Node Server %s has stopped responding.', self.name)
+        self.node_connected = False
+        self._hold_input()
+        self._stop_requests()
+        if self._mqtt is not None:
+            self._mqtt.stop()
+            self._mqtt = None
+        self.kill()
 
     # manage IO
-    def _send_in(self):
+    def _send_in(self, inq, proc):
         """
-        Write pending input to node server.
-        Kill process if unresponsive.
+        Write pending input to node server. A writer only serves the input
+        queue it was started with, and stops when a restart replaces it.
+        (Liveness is checked by the heartbeat)
         """
-        if self._mqtt is None:
-            while True and self._inq:
+        if self._socket is not None:
+            self._send_socket(inq)
+            return
+        # MQTT node servers also read STDIN until they are connected
+        while self._inq is inq:
+            try:
+                # try to get a line from the queue
+                line = inq.get(True, 5)
+            except Empty:
+                continue
+            if self._inq is not inq:
+                # restarted while we waited, the line is for the new process
+                self._hold([line])
+                break
+            try:
+                # found line, try to write it
+                proc.stdin.write('{}\n'.format(line))
+                proc.stdin.flush()
+            except IOError:
+                if self._inq is not inq:
+                    self._hold([line])
+                    break
+                # stdin pipe is broken. process is likely dead.
+                _LOGGER.error(
+                    'Node Server %s has exited unexpectedly.', self.name)
+                self._hold_input(line)
+                self._stop_requests()
+                self.kill()
+            else:
+                # line wrote successfully
+                inq.task_done()
+
+    def _hold_input(self, line=None):
+        """
+        Stop taking input for a node server that is down. Messages from the
+        ISY that were not delivered are held for when it is back.
+        """
+        inq, self._inq = self._inq, None
+        pending = [] if line is None else [line]
+        while inq is not None:
+            try:
+                pending.append(inq.get_nowait())
+            except Empty:
+                break
+        self._hold(pending)
+
+    def _hold(self, pending):
+        """ Hold the messages from the ISY among pending input. """
+        for msg in pending:
+            if msg is None:
+                # a stopped plugin's wake up
+                continue
+            message = msg if isinstance(msg, dict) else json.loads(msg)
+            if list(message.keys())[0] in NS_HOLD_COMMANDS:
+                self._held.append(msg)
+
+    def _send_socket(self, inq):
+        """
+        Write pending input to the node server socket. Lines stay queued, in
+        order, while the node server is reconnecting.
+        """
+        line = None
+        while self._inq is inq:
+            if line is None:
                 try:
-                    # try to get a line from the queue
-                    line = self._inq.get(True, 5)
+                    line = inq.get(True, 5)
                 except Empty:
-                    # no line in queue, check if the Node Server is responding
-                    if not self.responding:
-                        _LOGGER.error(
-                            'Node Server %s has stopped responding.', self.name)
-                        self._inq = None
-                        self._rqq = None
-                        self._proc.kill()
-                else:
-                    try:
-                        # found line, try to write it
-                        self._proc.stdin.write('{}\n'.format(line))
-                        self._proc.stdin.flush()
-                    except IOError:
-                        # stdin pipe is broken. process is likely dead.
-                        _LOGGER.error(
-                            'Node Server %s has exited unexpectedly.', self.name)
-                        self._inq = None
-                        self._rqq = None
-                        self._proc.kill()
-                    else:
-                        # line wrote successfully
-                        _LOGGER.debug('%s STDIN: %s', self.name, line)
-                        if self._inq:
-                            self._inq.task_done()
-        else:
-            if self.node_connected == True:
-                while True and self._mqtt:
-                    if not self.responding:
-                        _LOGGER.error(
-                            'Node Server %s has stopped responding.', self.name)
-                        self._rqq = None
-                        self._mqtt.stop()
-                        self._mqtt = None
-                        self._proc.kill()
-                    time.sleep(1)
-            else: 
-                time.sleep(1)
-                self._send_in()
-
-    def _request_handler(self):
-        """
-        Read and process network requests for a node server
-        """
-        while True and self._rqq:
-
-            msg = self._rqq.get(True)
-
-            # parse message
-            command = list(msg.keys())[0]
-            arguments = msg[command]
-
-            seq = arguments.get('seq', None)
-            ts = time.time()
-            _LOGGER.debug('%8s [%d] (%5.2f) _request_handler: command=%s seq=%s',
-                          self.name,
-                          (0 if self._rqq is None else self._rqq.qsize()),
-                          0.0, command, ('' if seq is None else seq))
+                    continue
+            if self._inq is not inq:
+                self._hold([line])
+                break
+            if self._socket.send(line):
+                inq.task_done()
+                line = None
+            else:
+                self._socket.wait(5)
 
-            fun = self._handlers.get(command)
-            if fun:
-                result = fun(self.profile_number, **arguments)
-                if seq and result:
-                    self._mk_cmd('result', **result)
+    def _socket_connected(self, pid=None, resume=False, **kwargs):
+        """
+        Handshake with a node server that has (re)connected to the socket.
+        Parameters, and the stored configuration unless the node server is
+        resuming with its own, are sent ahead of any queued input.
+        """
+        # pylint: disable=unused-argument
+        if pid is not None and pid != self._pid:
+            # node server was restarted outside of Polyglot
+            if self._proc is not None:
+                self._proc.poll()
+                self._proc = None
+            self._pid = pid
+        self._socket.write_pid(self._pid)
+        self.params['loglevel'] = node_log_level()
+        frames = [json.dumps({'params': self.params})]
+        if not resume:
+            frames.append(json.dumps({'config': self.config}))
+        self._lastping = None
+        self._lastpong = monotonic()
+        self.node_connected = True
+        self._socket.ready(frames)
+        _LOGGER.info('%8s connected on socket (pid %s, %s)', self.name,
+                     self._pid, 'resumed' if resume else 'new')
 
-            # Signal that this is handled
-            if self._rqq:
-                self._rqq.task_done()
+    def _handle_request(self, msg):
+        """
+        Process a network request for a node server
+        (Called from the request worker lanes)
+        """
+        # parse message
+        command = list(msg.keys())[0]
+        arguments = msg[command]
+
+        seq = arguments.get('seq', None)
+        start = monotonic() if TRACE.sampled() else None
+
+        mqtt_state = self._mqtt if self.retain_state else None
+        if command == 'status' and mqtt_state is not None and \
+                mqtt_state.redundant(**_status_args(arguments)):
+            # unchanged since before a restart, the ISY already has it
+            if seq:
+                self._mk_cmd('result', seq=seq, status_code=200, elapsed=0.0,
+                             text='', retries=0)
+            return
+
+        fun = self._handlers.get(command)
+        result = None
+        if command == 'status_batch' and mqtt_state is not None:
+            result = self._retained_status_batch(arguments, mqtt_state)
+        elif fun:
+            result = fun(self.profile_number, **arguments)
+            if seq and result:
+                self._mk_cmd('result', **result)
+            if mqtt_state is not None and \
+                    (not result or result.get('status_code') == 200):
+                if command == 'status':
+                    mqtt_state.report_state(**_status_args(arguments))
+                elif command == 'remove':
+                    mqtt_state.remove_state(arguments['node_address'])
+
+        if start is not None:
+            self._trace('isy', command, 0, self._rqq, start)
+        return result
+
+    def _retained_status_batch(self, arguments, mqtt_state):
+        """
+        Report a status batch with retain_state: reports that repeat their
+        retained value are answered without sending them to the ISY, and the
+        others are retained once the ISY has them.
+        """
+        statuses = arguments.get('statuses', [])
+        send = [index for index, status in enumerate(statuses)
+                if not mqtt_state.redundant(**_status_args(status))]
+        result = self._handlers['status_batch'](
+            self.profile_number, [statuses[index] for index in send],
+            arguments.get('timeout'), arguments.get('seq'))
+        codes = [200] * len(statuses)
+        for index, code in zip(send, result['statuses']):
+            codes[index] = code
+            if code == 200:
+                mqtt_state.report_state(**_status_args(statuses[index]))
+        result['statuses'] = codes
+        if arguments.get('seq'):
+            self._mk_cmd('result', **result)
+        return result
+
+    def _trace(self, direction, command, size, queue, start=None):
+        """ Record a traced message, and log it at debug level. """
+        depth = 0 if queue is None else queue.qsize()
+        elapsed = 0.0 if start is None else monotonic() - start
+        TRACE.record(self.name, direction, command, size, depth, elapsed)
+        _LOGGER.debug('%8s [%d] (%5.3f) %s: %s (%d bytes)', self.name, depth,
+                      elapsed, direction, command, size)
+
+    def _discard_request(self, msg, reason):
+        """
+        A request was refused or discarded by the full request queue. Report
+        a failed result for it so the node server can retry later. A message
+        sent without a seq expects no result, so the node server is not told;
+        such discards are only counted in the stats and logged.
+        """
+        command = list(msg.keys())[0]
+        seq = msg[command].get('seq', None)
+        if seq:
+            self._mk_cmd('result', seq=seq,
+                         status_code=NS_OVERLOAD_STATUS[reason], elapsed=0.0,
+                         text='Polyglot request queue full: {}'.format(reason),
+                         retries=0)
+        else:
+            _LOGGER.debug('%8s %s %s, no result expected', self.name, reason,
+                          command)
+        if time.time() - self._overload_logged >= 10:
+            self._overload_logged = time.time()
+            _LOGGER.warning('%8s request queue full (%s), %s %s',
+                            self.name, self.overload, reason, command)
+
+    def _batch_result(self, result):
+        """ The result of a status batch handled in parts on several lanes. """
+        if result.get('seq'):
+            self._mk_cmd('result', **result)
+
+    def _stop_requests(self):
+        """ Stop processing network requests for the node server. """
+        rqq, self._rqq = self._rqq, None
+        if rqq is not None:
+            rqq.stop()
 
-            _LOGGER.debug('%8s [%d] (%5.2f) _request_handler: completed.',
-                          self.name,
-                          (0 if self._rqq is None else self._rqq.qsize()),
-                          (time.time() - ts))
+    @property
+    def stats(self):
+        """ Node server diagnostics and performance data. """
+        rqq = self._rqq
+        return {'name': self.name,
+                'requests': rqq.stats if rqq is not None else None,
+                'heartbeat': {'responding': self._responding,
+                              'rtt': self._rtt.stats},
+                'supervisor': {'stopped': self.stopped,
+                               'crash_loop': self.crash_loop,
+                               'restarting': self.restarting,
+                               'restart_pending': self.restart_due is not None,
+                               'held': len(self._held),
+                               'failures': list(self.failures)},
+                'process': self.process.stats,
+                'first_message': self._first_message,
+                'poll': self._poll_stats,
+                'recording': self._recorder.path if self._recorder else None,
+                'mqtt': self._mqtt.stats if self._mqtt is not None else None,
+                'plugin': self._plugin.stats if self._plugin is not None
+                          else None}
+
+    def start_recording(self):
+        """
+        Record the node server's traffic to a file in its sandbox, for
+        replay with scripts/replay_recording. Returns the file path.
+        """
+        if self._recorder is None:
+            path = os.path.join(self.sandbox, '{}-{}.rec'.format(
+                self.file_name, time.strftime('%Y%m%d-%H%M%S')))
+            self._recorder = Recorder(path, self.name)
+            _LOGGER.info('%8s recording traffic to %s', self.name, path)
+        return self._recorder.path
+
+    def stop_recording(self):
+        """ Stop recording the node server's traffic. Returns the file path. """
+        recorder, self._recorder = self._recorder, None
+        if recorder is None:
+            return None
+        recorder.close()
+        _LOGGER.info('%8s recorded %d lines to %s', self.name, recorder.count,
+                     recorder.path)
+        return recorder.path
 
     def _recv_out(self, line):
         """ 
         Process the output of the nodeserver 
         (Called from STDOUT or from message receive in MQTT) 
         """
-        type = 'STDOUT'
-        if self._mqtt is not None: type = 'MQTT'
-        l = (line[:57] + '...') if len(line) > 60 else line
-        _LOGGER.debug('%8s [%d] (%5.2f) %s: %s', self.name,
-                      (0 if self._rqq is None else self._rqq.qsize()),
-                      0.0, type, l)
-        ts = time.time()
-        # parse message
-        message = json.loads(line)
+        self._recv_message(json.loads(line), line)
+
+    def _recv_message(self, message, line=None):
+        """
+        Process a message from the node server, as received (line) if it was
+        encoded. (Called by _recv_out, or directly by plugins)
+        """
+        start = monotonic() if TRACE.sampled() else None
+        if self._first_message is None:
+            self._first_message_received()
+        if self._recorder is not None:
+            self._recorder.record('o', line or json.dumps(message))
         command = list(message.keys())[0]
         arguments = message[command]
 
         # direct command
         if command == 'pong':
-            # store pong time
-            self._lastpong = time.time()
+            # store pong time and the round trip of the ping it answers
+            now = monotonic()
+            if self._lastping is not None and \
+                    (self._lastpong is None or self._lastpong < self._lastping):
+                self._rtt.add(now - self._lastping)
+            self._lastpong = now
         elif command == 'config':
-            # store new configuration in config file
-            self.config = arguments
-            self.pglot.update_config()
+            # store new configuration in config file, if it changed
+            if arguments != self.config:
+                self.config = arguments
+                self.pglot.update_config(changed=('nodeservers',))
+        elif command == 'config_patch':
+            # apply the changed parts of the configuration
+            self._patch_config(**arguments)
+            self.pglot.update_config(changed=('nodeservers',))
         elif command == 'install':
             # install node server on isy
             # [future] implement when documentation is available
@@ -540,17 +1196,32 @@ class NodeServer(object):
             if self.profile_number == NSMGR:
                 # TODO: may need to take NSLOCK here to avoid partial updates
                 result['ns'] = NSSTATS
+                result['polyglot'] = self.pglot.nodeservers.process.stats
+            result['server'] = self.stats
             self._mk_cmd('statistics', **result)
+        elif command == 'poll_stats':
+            # poll lag and skipped ticks, sent every minute by the node server
+            self._poll_stats = arguments
         elif command == 'exit':
             # node server is done. Kill it. Clean up is automatic.
+            self.stopped = True
             self.node_connected = False
-            self._proc.kill()
-            self._inq = None
-            self._rqq = None
+            self.kill()
+            self._hold_input()
+            self._stop_requests()
+        elif command == 'log':
+            # message for our log, already filtered by our log level
+            level = logging.getLevelName(arguments.get('level', 'ERROR'))
+            if not isinstance(level, int):
+                level = logging.ERROR
+            _LOGGER.log(level, '%s: %s', self.name, arguments.get('msg', ''))
         elif command == 'connected':
-            _LOGGER.info('%8s current status is connected to the broker.', self.name)
-            self.node_connected = True
-            self.send_ping()
+            if self._socket is not None:
+                self._socket_connected(**arguments)
+            else:
+                _LOGGER.info('%8s current status is connected to the broker.', self.name)
+                self.node_connected = True
+                self.send_ping()
         elif command == 'disconnected':
             _LOGGER.error('%8s current status is disconnected from the broker.', self.name)
             self.node_connected = False
@@ -558,18 +1229,72 @@ class NodeServer(object):
         else:
             fun = self._handlers.get(command)
             if fun and self._rqq:
-                self._rqq.put(message, True, 30)
+                self._rqq.put(message)
             else:
                 _LOGGER.error('Node Server %s delivered bad command %s',
                               self.name, command)
-        _LOGGER.debug('%8s [%d] (%5.2f)   Done: %s', self.name,
-                      (0 if self._rqq is None else self._rqq.qsize()),
-                      (time.time() - ts), l)
+        if start is not None:
+            self._trace('in', command, len(line) if line else 0, self._rqq,
+                        start)
+
+    def _patch_config(self, set=None, delete=None, **kwargs):
+        """
+        Apply a config_patch message to the configuration. The dictionaries
+        on the paths patched are copied, and the patched configuration
+        replaces the old one, which the configuration writer may be reading.
+
+        :param set: [path, value] pairs, a path being a list of keys
+        :param delete: Paths to remove
+        """
+        # pylint: disable=redefined-builtin, unused-argument
+        config = dict(self.config)
+        copied = {id(config)}
+
+        def child(parent, key):
+            """ The dictionary at key of parent, copied once per patch. """
+            value = parent.get(key)
+            if not isinstance(value, dict):
+                value = {}
+            elif id(value) not in copied:
+                value = dict(value)
+            copied.add(id(value))
+            parent[key] = value
+            return value
+
+        for path, value in set or []:
+            parent = config
+            for key in path[:-1]:
+                parent = child(parent, key)
+            parent[path[-1]] = value
+        for path in delete or []:
+            parent = config
+            for key in path[:-1]:
+                if not isinstance(parent.get(key), dict):
+                    break
+                parent = child(parent, key)
+            else:
+                parent.pop(path[-1], None)
+        self.config = config
+
+    def _first_message_received(self):
+        """ Note the time from starting the node server to its first message. """
+        self._first_message = monotonic() - self._started
+        _LOGGER.info('%8s first message %.3f s after start', self.name,
+                     self._first_message)
+        if self._boot:
+            self._boot = False
+            startup = getattr(self.pglot, 'startup', None)
+            if startup is not None:
+                startup.event('first_message', server=self.name,
+                              seconds=round(self._first_message, 6))
 
     def _recv_err(self, line):
         """
         Process STDERR from nodeserver
+        (Node servers for Polyglot API 1 send their log messages here)
         """
+        if self._recorder is not None:
+            self._recorder.record('e', line)
         if line.startswith('**INFO: '):
             _LOGGER.info('%s: %s', self.name, line)
         elif line.startswith('**DEBUG: '):
@@ -581,14 +1306,30 @@ class NodeServer(object):
 
     def _mk_cmd(self, cmd_code, **kwargs):
         """ Process Output TO the nodeserver (MQTT/STDIN) """
+        if self._plugin is not None:
+            # plugins take the message as it is
+            msg = {cmd_code: kwargs}
+            if TRACE.sampled():
+                self._trace('out', cmd_code, 0, self._inq)
+            if self._recorder is not None:
+                self._recorder.record('i', json.dumps(msg))
+            if self._inq:
+                self._inq.put(msg, True, 5)
+            return
         msg = json.dumps({cmd_code: kwargs})
+        if TRACE.sampled():
+            self._trace('out', cmd_code, len(msg), self._inq)
+        if self._recorder is not None:
+            self._recorder.record('i', msg)
         # If using mqtt, send the msg to the nodeserver over that mechanism if it is connected
-        if (self.node_connected):
-            self._mqtt._mqttc.publish(self._mqtt.topicOutput, str(msg), 0)
-            _LOGGER.debug('%s MQTT Publish: %s', self.name, str(msg))
+        if self._mqtt is not None and self.node_connected:
+            self._mqtt.publish(msg)
         # Else add the msg to the STDIN queue to send to the nodeserver processed by _send_in
         elif self._inq:
             self._inq.put(msg, True, 5)
+        # Else the node server is down, hold messages from the ISY for it
+        elif cmd_code in NS_HOLD_COMMANDS:
+            self._held.append(msg)
 
     def send_config(self):
         """ Send configuration to Node Server. """
@@ -596,15 +1337,21 @@ class NodeServer(object):
 
     def send_params(self):
         """ Send parameters to Node Server. """
+        self.params['loglevel'] = node_log_level()
         self._mk_cmd('params', **self.params)
 
+    def send_loglevel(self):
+        """ Send the level node server messages are logged at or above. """
+        self.params['loglevel'] = node_log_level()
+        self._mk_cmd('loglevel', level=self.params['loglevel'])
+
     def send_install(self, profile_number=None):
         """ Send install command to Node Server. """
         if not profile_number:
             profile_number = self.profile_number
         else:
             self.profile_number = profile_number
-            self.pglot.update_config()
+            self.pglot.update_config(changed=('nodeservers',))
         self._mk_cmd('install', profile_number=self.profile_number)
 
     def send_query(self, node_address, request_id=None):
@@ -651,145 +1398,1029 @@ class NodeServer(object):
 
     def send_ping(self):
         """ Send Ping request to the Node Server. """
+        self._lastping = monotonic()
         self._mk_cmd('ping')
 
     def send_exit(self):
         """ Send exit command to the Node Server. """
+        self.stopped = True
         self._mk_cmd('exit')
         self.node_connected = False
 
     def kill(self):
         """ Kill the node server process. """
         try:
-            self._proc.kill()
-
+            if self._plugin is not None:
+                self._plugin.stop()
+            elif self._proc is not None:
+                self._proc.kill()
+                self._proc.wait()
+            elif self._pid is not None:
+                os.kill(self._pid, signal.SIGKILL)
         except MyProcessLookupError:
             pass
 
-class mqttSubsystem:
-    """ 
-    mqttSubsystem class instantiated if interface is mqtt in server.json 
-    
+    def release(self):
+        """ Release the interfaces held by a node server being removed. """
+        self.stop_recording()
+        self._generation += 1
+        HEARTBEAT.cancel(self._beat)
+        if self._socket is not None:
+            self._socket.stop()
+        if self._mqtt is not None:
+            self._mqtt.stop()
+        if self._plugin is not None:
+            self._plugin.stop()
+
+def _status_args(arguments):
+    """ The driver arguments of a status message or status_batch report. """
+    if isinstance(arguments, (list, tuple)):
+        return dict(zip(('node_address', 'driver_control', 'value', 'uom'),
+                        arguments))
+    return {'node_address': arguments['node_address'],
+            'driver_control': arguments['driver_control'],
+            'value': arguments['value'], 'uom': arguments['uom']}
+
+
+def node_log_level():
+    """ Name of the level node server messages are logged at or above. """
+    return logging.getLevelName(_LOGGER.getEffectiveLevel())
+
+
+class RequestLanes(object):
+    """
+    Worker pool for a node server's requests to the ISY.
+
+    Messages are hashed by node address onto worker lanes, each with its own
+    queue and thread, so requests for one node are handled strictly in order
+    while different nodes proceed in parallel. Messages that must not
+    overtake others act as barriers: a request report waits for every lane,
+    and a node add also waits for the lane of the node's primary. A status
+    batch is split into a part per lane, and its result is sent once every
+    part has been handled or discarded.
+
+    Queuing never blocks. When a lane is full the overload policy decides
+    what is discarded (see NS_OVERLOAD_POLICIES). Barriers are always
+    admitted.
+
+    :param name: The node server name, for logging
+    :param handler: Called with each message on a worker thread
+    :param workers: The number of worker lanes
+    :param maxsize: The total number of queued messages allowed
+    :param policy: The overload policy
+    :param on_discard: Called with each discarded message and the reason
+    :param on_result: Called with the result of each status batch split
+                      across lanes
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=0,
+                 policy=NS_OVERLOAD_DEFAULT, on_discard=None, on_result=None):
+        self.name = name
+        self.policy = policy
+        self._handler = handler
+        self._on_discard = on_discard
+        self._on_result = on_result
+        # barriers must be queued on all their lanes in the same order
+        self._barrier_lock = threading.Lock()
+        self._lanes = [_RequestLane(self, num, maxsize // workers)
+                       for num in range(workers)]
+        for lane in self._lanes:
+            lane.start()
+
+    def _lane(self, key):
+        """ The lane for a routing key. """
+        return self._lanes[hash(key) % len(self._lanes)]
+
+    def _route(self, command, arguments):
+        """ The set of lanes a message must pass through. """
+        if command == 'request':
+            return self._lanes
+        address = arguments.get('node_address', arguments.get('api'))
+        lanes = [self._lane(address)]
+        if command == 'add':
+            primary = self._lane(arguments.get('primary', address))
+            if primary is not lanes[0]:
+                lanes.append(primary)
+        return lanes
+
+    def put(self, message):
+        """
+        Queue a message without blocking. Returns False if the message
+        itself was refused or discarded.
+        """
+        command = list(message.keys())[0]
+        if command == 'status_batch':
+            return self._put_batch(message)
+        lanes = self._route(command, message[command])
+        if len(lanes) > 1:
+            barrier = _Barrier(message, len(lanes))
+            with self._barrier_lock:
+                for lane in lanes:
+                    lane.offer(barrier)
+            return True
+        admitted, discarded, reason = lanes[0].offer(message, self.policy)
+        self._discarded(discarded, reason)
+        return admitted
+
+    def _put_batch(self, message):
+        """
+        Queue a status batch: whole if its nodes are all on one lane, or
+        else a part per lane, each queued under the overload policy.
+        """
+        arguments = message['status_batch']
+        parts = {}
+        for index, status in enumerate(arguments.get('statuses') or []):
+            parts.setdefault(self._lane(status[0]), []).append(index)
+        if len(parts) <= 1:
+            lane = list(parts)[0] if parts else self._lane(None)
+            admitted, discarded, reason = lane.offer(message, self.policy)
+            self._discarded(discarded, reason)
+            return admitted
+        batch = _SplitBatch(arguments, len(parts), self._on_result)
+        admitted = True
+        for lane, indices in parts.items():
+            part = _BatchPart(batch, indices)
+            added, discarded, reason = lane.offer(part, self.policy)
+            admitted = admitted and added
+            self._discarded(discarded, reason)
+        return admitted
+
+    def _discarded(self, item, reason):
+        """ An item discarded by the overload policy. """
+        if item is None:
+            return
+        if isinstance(item, _BatchPart):
+            item.discard(reason)
+            item = item.message
+        if self._on_discard is not None:
+            self._on_discard(item, reason)
+
+    def qsize(self):
+        """ The number of queued messages. """
+        return sum(len(lane) for lane in self._lanes)
+
+    def stop(self):
+        """
+        Stop the workers once they finish their current message. Lanes
+        waiting at a barrier are released.
+        """
+        for lane in self._lanes:
+            lane.stop()
+
+    @property
+    def stats(self):
+        """ Queue depth and utilisation of each lane. """
+        overload = dict((key, 0) for key in _RequestLane.OUTCOMES)
+        for lane in self._lanes:
+            for key, count in lane.outcomes.items():
+                overload[key] += count
+        return {'workers': len(self._lanes),
+                'depth': self.qsize(),
+                'policy': self.policy,
+                'overload': overload,
+                'lanes': [lane.stats for lane in self._lanes]}
+
+
+class _RequestLane(threading.Thread):
+    """ A worker lane: one queue drained in order by one thread. """
+
+    OUTCOMES = ('dropped_oldest', 'dropped_newest', 'coalesced', 'rejected')
+
+    def __init__(self, pool, num, maxsize):
+        threading.Thread.__init__(self, name='{}-lane{}'.format(pool.name, num))
+        self.daemon = True
+        self._pool = pool
+        self._maxsize = maxsize
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._running = True
+        self._current = None
+        self.processed = 0
+        self.outcomes = dict((key, 0) for key in self.OUTCOMES)
+        self.high_water = 0
+        self.busy = 0.0
+        self._win_start = time.time()
+        self._win_busy = 0.0
+        self._utilisation = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def offer(self, item, policy=None):
+        """
+        Add an item without blocking, applying the overload policy if the
+        lane is full. Returns (admitted, discarded item, reason).
+        """
+        discarded, reason = None, None
+        with self._cond:
+            if policy and 0 < self._maxsize <= len(self._queue):
+                if policy == 'coalesce':
+                    index = self._find_status(item)
+                    if index is not None:
+                        # the new value goes to the back, so it does not
+                        # overtake what was queued for the node after the old
+                        discarded = self._queue[index]
+                        del self._queue[index]
+                        self._queue.append(item)
+                        self.outcomes['coalesced'] += 1
+                        self._cond.notify()
+                        return True, discarded, 'coalesced'
+                if policy in ('drop_oldest', 'coalesce'):
+                    index = self._find_status()
+                    if index is not None:
+                        discarded = self._queue[index]
+                        del self._queue[index]
+                        self.outcomes['dropped_oldest'] += 1
+                        reason = 'dropped'
+                if discarded is None:
+                    if policy == 'reject':
+                        self.outcomes['rejected'] += 1
+                        return False, item, 'rejected'
+                    self.outcomes['dropped_newest'] += 1
+                    return False, item, 'dropped'
+            self._queue.append(item)
+            self.high_water = max(self.high_water, len(self._queue))
+            self._cond.notify()
+        return True, discarded, reason
+
+    def _find_status(self, like=None):
+        """
+        Index of the oldest queued status report or status batch (or part of
+        one), or of the status report for the same node driver as like.
+        """
+        key = None
+        if like is not None:
+            args = like.get('status') if isinstance(like, dict) else None
+            if args is None:
+                return None
+            key = (args.get('node_address'), args.get('driver_control'))
+        for index, queued in enumerate(self._queue):
+            if isinstance(queued, _BatchPart):
+                if key is None:
+                    return index
+                continue
+            if not isinstance(queued, dict):
+                continue
+            if key is None and 'status_batch' in queued:
+                return index
+            args = queued.get('status')
+            if args is None:
+                continue
+            if key is None or key == (args.get('node_address'),
+                                      args.get('driver_control')):
+                return index
+        return None
+
+    def stop(self):
+        """ Stop after the current item, or now if it waits at a barrier. """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            current = self._current
+        if isinstance(current, _Barrier):
+            current.abort()
+
+    def run(self):
+        """ Drain the lane. """
+        # pylint: disable=broad-except
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                item = self._queue.popleft()
+                self._current = item
+            start = time.time()
+            try:
+                if isinstance(item, _Barrier):
+                    item.arrive(self._pool._handler)
+                elif isinstance(item, _BatchPart):
+                    item.run(self._pool._handler)
+                else:
+                    self._pool._handler(item)
+            except Exception:
+                _LOGGER.exception('%8s request failed', self._pool.name)
+            with self._cond:
+                self._current = None
+            self._account(start, time.time())
+
+    def _account(self, start, end):
+        """ Record the time spent handling an item. """
+        self.processed += 1
+        self.busy += end - start
+        self._roll(end)
+        self._win_busy += end - start
+
+    def _roll(self, now):
+        """ Start a new utilisation window if the current one is over. """
+        elapsed = now - self._win_start
+        if elapsed >= NS_LANE_UTIL_WINDOW:
+            self._utilisation = min(1.0, self._win_busy / elapsed)
+            self._win_start = now
+            self._win_busy = 0.0
+
+    @property
+    def stats(self):
+        """ Depth and utilisation of the lane. """
+        now = time.time()
+        self._roll(now)
+        utilisation = self._utilisation
+        if utilisation is None:
+            # first window is still open
+            utilisation = self._win_busy / max(now - self._win_start, 1.0)
+        return {'depth': len(self._queue),
+                'high_water': self.high_water,
+                'processed': self.processed,
+                'busy': round(self.busy, 3),
+                'utilisation': round(min(1.0, utilisation), 3)}
+
+
+class _Barrier(object):
+    """
+    A message queued on several lanes. It runs once every lane has reached
+    it, and those lanes wait until it has been handled.
+    """
+
+    def __init__(self, message, count):
+        self.message = message
+        self._count = count
+        self._cond = threading.Condition()
+        self._done = False
+
+    def arrive(self, handler):
+        """ Called by each lane as it reaches the barrier. """
+        with self._cond:
+            self._count -= 1
+            if self._done:
+                # aborted
+                return
+            if self._count > 0:
+                while not self._done:
+                    self._cond.wait()
+                return
+        try:
+            handler(self.message)
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def abort(self):
+        """ Release the lanes waiting at the barrier, unhandled. """
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+
+class _SplitBatch(object):
+    """
+    A status batch split into parts on several lanes. Collects the status
+    codes of the parts and hands on the result of the whole batch, like
+    the ISY element's, once the last part is done.
+    """
+
+    def __init__(self, arguments, parts, on_result):
+        self.arguments = arguments
+        self._parts = parts
+        self._on_result = on_result
+        self._codes = [None] * len(arguments.get('statuses') or [])
+        self._elapsed = 0.0
+        self._retries = 0
+        self._lock = threading.Lock()
+
+    def done(self, indices, codes, elapsed=0.0, retries=0):
+        """ A part is done, with the status code of each of its reports. """
+        with self._lock:
+            for index, code in zip(indices, codes):
+                self._codes[index] = code
+            self._elapsed = max(self._elapsed, elapsed)
+            self._retries += retries
+            self._parts -= 1
+            if self._parts:
+                return
+        failed = [code for code in self._codes if code != 200]
+        if self._on_result is not None:
+            self._on_result({'text': None,
+                             'status_code': failed[0] if failed else 200,
+                             'seq': self.arguments.get('seq'),
+                             'elapsed': self._elapsed,
+                             'retries': self._retries,
+                             'statuses': self._codes})
+
+
+class _BatchPart(object):
+    """ The reports of a split status batch for the nodes of one lane. """
+
+    def __init__(self, batch, indices):
+        self.batch = batch
+        self.indices = indices
+        statuses = batch.arguments['statuses']
+        # a status batch of its own, with no seq: the batch answers
+        self.message = {'status_batch': {
+            'statuses': [statuses[index] for index in indices],
+            'timeout': batch.arguments.get('timeout')}}
+
+    def run(self, handler):
+        """ Report the part. A part whose handler fails counts as failed. """
+        result = None
+        try:
+            result = handler(self.message)
+        finally:
+            if result and len(result.get('statuses') or []) == \
+                    len(self.indices):
+                self.batch.done(self.indices, result['statuses'],
+                                result.get('elapsed', 0.0),
+                                result.get('retries', 0))
+            else:
+                self.batch.done(self.indices, [2] * len(self.indices))
+
+    def discard(self, reason):
+        """ The part was discarded by the overload policy. """
+        self.batch.done(self.indices,
+                        [NS_OVERLOAD_STATUS[reason]] * len(self.indices))
+
+
+class mqttSubsystem(object):
+    """
+    mqttSubsystem class instantiated if interface is mqtt in server.json.
+    The node server's topics are served by the MQTT connection that all node
+    servers using the same broker share.
+
+    With retain_state, the drivers of each node reported to the ISY are
+    published retained on udi/polyglot/<name>/state/<node address>. They are
+    read back when Polyglot or the node server restarts, and the first report
+    of a driver that still has its retained value is not sent to the ISY.
+
     :param parent: The NodeServer object that called this function
     :type parent: polyglot.nodeserver_manager.NodeServer
     """
-    # pylint: disable=too-many-instance-attributes
-    # pylint: disable=unused-argument
-    
+
     def __init__(self, parent):
         self.parent = parent
-        self.connected = False
         self.topicOutput = 'udi/polyglot/' + self.parent.name + "/node"
         self.topicInput = 'udi/polyglot/' + self.parent.name + "/poly"
-        self._mqttc = mqtt.Client(self.parent.name + "-poly", True)
-        self._mqttc.will_set(self.topicOutput,json.dumps({"disconnected": {}}), retain=True)
+        self.topicState = 'udi/polyglot/' + self.parent.name + "/state"
+        self._server = str(self.parent.mqtt_server)
+        self._port = int(self.parent.mqtt_port)
+        self._conn = None
+        self._state = {}
+        self._rehydrate = set()
+        self._state_lock = threading.Lock()
+        self._state_since = None
+        self._state_loaded = None
+        self.state_skipped = 0
+
+    @property
+    def connected(self):
+        """ Indicates if the shared connection to the broker is up. """
+        return self._conn is not None and self._conn.connected
+
+    def start(self):
+        """
+        Attach to the shared connection and publish the connected message,
+        which is sent once the broker has accepted the connection.
+        """
+        if self._conn is None:
+            self._conn = mqttConnection.get(self._server, self._port)
+            self._conn.subscribe(self.topicInput, self._message)
+            if self.parent.retain_state:
+                self._state_since = monotonic()
+                self._conn.subscribe(self.topicState + '/+',
+                                     self._state_message)
+        with self._state_lock:
+            # values reported before the restart have not been repeated yet
+            self._rehydrate = set((address, driver)
+                                  for address, drivers in self._state.items()
+                                  for driver in drivers)
+        self.publish(json.dumps({"connected": {}}), retain=True)
+
+    def stop(self):
+        """
+        Publish the disconnected message and detach from the shared
+        connection, which is closed with its last node server.
+        """
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            if conn.connected:
+                conn.publish(self.topicOutput,
+                             json.dumps({"disconnected": {}}), retain=True)
+            conn.unsubscribe(self.topicInput)
+            if self.parent.retain_state:
+                conn.unsubscribe(self.topicState + '/+')
+
+    def publish(self, msg, retain=False):
+        """ Publish a message to the node server. """
+        if self._conn is not None:
+            self._conn.publish(self.topicOutput, msg, retain)
+
+    def _message(self, msg):
+        """ A message from the node server. """
+        self.parent._recv_out(msg.payload)
+
+    def _state_message(self, msg):
+        """
+        Retained driver state of a node. Values already known to this
+        process are newer, so only unknown nodes are taken.
+        """
+        address = msg.topic.rsplit('/', 1)[1]
+        if not msg.payload:
+            return
+        try:
+            drivers = json.loads(msg.payload)
+        except ValueError:
+            _LOGGER.error('%8s bad retained state for %s', self.parent.name,
+                          address)
+            return
+        with self._state_lock:
+            if address in self._state:
+                return
+            self._state[address] = drivers
+            self._rehydrate.update((address, driver) for driver in drivers)
+            self._state_loaded = monotonic()
+
+    def redundant(self, node_address, driver_control, value, uom):
+        """
+        Indicates if a driver report repeats its retained value from before a
+        restart, so need not be sent to the ISY. Only the first report of
+        each retained value is redundant.
+        """
+        key = (node_address, driver_control)
+        with self._state_lock:
+            if key not in self._rehydrate:
+                return False
+            self._rehydrate.discard(key)
+            known = self._state.get(node_address, {}).get(driver_control)
+            if known != [str(value), str(uom)]:
+                return False
+            self.state_skipped += 1
+            return True
+
+    def report_state(self, node_address, driver_control, value, uom):
+        """ A driver was reported to the ISY: publish the node's state. """
+        with self._state_lock:
+            drivers = self._state.setdefault(node_address, {})
+            drivers[driver_control] = [str(value), str(uom)]
+            self._rehydrate.discard((node_address, driver_control))
+            payload = json.dumps(drivers)
+        if self._conn is not None:
+            self._conn.publish(self.topicState + '/' + node_address, payload,
+                               retain=True)
+
+    def remove_state(self, node_address):
+        """ A node was removed: clear its retained state. """
+        with self._state_lock:
+            drivers = self._state.pop(node_address, {})
+            self._rehydrate.difference_update(
+                (node_address, driver) for driver in drivers)
+        if self._conn is not None:
+            self._conn.publish(self.topicState + '/' + node_address, '',
+                               retain=True)
+
+    @property
+    def stats(self):
+        """ Retained state statistics. """
+        loaded = None
+        if self._state_loaded is not None and self._state_since is not None:
+            loaded = round(self._state_loaded - self._state_since, 6)
+        return {'connected': self.connected,
+                'nodes': len(self._state),
+                'pending': len(self._rehydrate),
+                'skipped': self.state_skipped,
+                'rehydrate_seconds': loaded}
+
+
+class mqttConnection(object):
+    """
+    One MQTT client connection to a broker, shared by all node servers that
+    use the broker. Messages are routed to node servers by topic. Paho runs
+    one network thread per connection and reconnects by itself; connection
+    state is kept in an event. Messages published while the connection is
+    down are queued and sent once the broker has accepted the connection.
+
+    A connection has only one will message: {"disconnected": {}} on
+    MQTT_STATUS_TOPIC, which node servers subscribe to, so the connections
+    to a broker stay at one however many node servers use it.
+
+    :param server: Broker host
+    :param port: Broker port
+    """
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self._routes = {}
+        # guards the routes, the connected state and the queued messages
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._queued = deque(maxlen=MQTT_QUEUE_SIZE)
+        self._mqttc = mqtt.Client('polyglot-{}'.format(os.getpid()), True)
+        self._mqttc.will_set(MQTT_STATUS_TOPIC,
+                             json.dumps({"disconnected": {}}), retain=True)
         self._mqttc.on_connect = self._connect
         self._mqttc.on_message = self._message
-        self._mqttc.on_subscribe = self._subscribe
         self._mqttc.on_disconnect = self._disconnect
-        self._mqttc.on_publish = self._publish
-        self._mqttc.on_log = self._log
-        self._server = self.parent.mqtt_server
-        self._port = self.parent.mqtt_port
-    
+        _LOGGER.info('Connecting to MQTT... %s:%s', server, port)
+        self._mqttc.connect_async(server, port, 10)
+        self._mqttc.loop_start()
+
+    @classmethod
+    def get(cls, server, port):
+        """ The connection to a broker, connecting if needed. """
+        with MQTT_LOCK:
+            conn = MQTT_CONNECTIONS.get((server, port))
+            if conn is None:
+                conn = MQTT_CONNECTIONS[(server, port)] = cls(server, port)
+            return conn
+
+    def subscribe(self, topic, callback):
+        """
+        Route messages on a topic to callback(msg). The topic may end in a
+        single level wildcard.
+        """
+        with MQTT_LOCK:
+            with self._lock:
+                self._routes[topic] = callback
+                # otherwise _connect subscribes to it
+                if self.connected:
+                    self._mqttc.subscribe(topic)
+
+    def unsubscribe(self, topic):
+        """ Stop routing a topic; close the connection if it is idle. """
+        with MQTT_LOCK:
+            with self._lock:
+                self._routes.pop(topic, None)
+                idle = not self._routes
+                if self.connected:
+                    self._mqttc.unsubscribe(topic)
+            if idle and MQTT_CONNECTIONS.get((self.server, self.port)) is self:
+                del MQTT_CONNECTIONS[(self.server, self.port)]
+            else:
+                return
+        _LOGGER.info('Disconnecting from MQTT... %s:%s', self.server,
+                     self.port)
+        if self.connected:
+            self._mqttc.publish(MQTT_STATUS_TOPIC,
+                                json.dumps({"disconnected": {}}), retain=True)
+        self._mqttc.disconnect()
+        self._mqttc.loop_stop()
+
+    @property
+    def connected(self):
+        """ Indicates if the connection to the broker is up. """
+        return self._connected.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait for the connection to the broker to be up. """
+        return self._connected.wait(timeout)
+
+    def publish(self, topic, msg, retain=False):
+        """ Publish a message, or queue it until the broker accepts us. """
+        with self._lock:
+            if not self.connected:
+                self._queued.append((topic, str(msg), retain))
+                return
+            self._mqttc.publish(topic, str(msg), 0, retain)
+
     def _connect(self, mqttc, userdata, flags, rc):
         """
         The callback for when the client receives a CONNACK response from the server.
         Subscribing in on_connect() means that if we lose the connection and
         reconnect then subscriptions will be renewed.
-        
+
         :param mqttc: The client instance for this callback
         :param userdata: The private userdata for the mqtt client. Not used in Polyglot
         :param flags: The flags set on the connection.
         :param rc: Result code of connection, 0 = Success, anything else is a failure
         """
-        if rc == 0:
-            self.connected = True
-            _LOGGER.info("MQTT Connected with result code " + str(rc) + " (Success)")
-            result, mid = self._mqttc.subscribe(self.topicInput)
-            if result == 0:
-                _LOGGER.info("MQTT Subscribing to topic: " + self.topicInput + " - " + " MID: " + str(mid) + " Result: " + str(result))
-            else:
-                _LOGGER.info("MQTT Subscription to " + self.topicInput + " failed. This is unusual. MID: " + str(mid) + " Result: " + str(result))
-                # If subscription fails, try to reconnect.
-                self._mqttc.reconnect()
-        else:
-            _LOGGER.error("MQTT Failed to connect. Result code: " + str(rc))
-        
+        # pylint: disable=unused-argument
+        if rc != 0:
+            _LOGGER.error("MQTT Failed to connect. Result code: %s", rc)
+            return
+        _LOGGER.info("MQTT Connected to %s:%s", self.server, self.port)
+        with self._lock:
+            topics = list(self._routes.keys())
+            if topics:
+                result, mid = mqttc.subscribe([(topic, 0) for topic in topics])
+                if result != 0:
+                    _LOGGER.error(
+                        "MQTT Subscription to %s failed. MID: %s Result: %s",
+                        ', '.join(topics), mid, result)
+            mqttc.publish(MQTT_STATUS_TOPIC, json.dumps({"connected": {}}),
+                          retain=True)
+            while self._queued:
+                topic, msg, retain = self._queued.popleft()
+                mqttc.publish(topic, msg, 0, retain)
+            self._connected.set()
+
     def _message(self, mqttc, userdata, msg):
         """
         The callback for when a PUBLISH message is received from the server.
+        Routes the message to its node server.
 
         :param mqttc: The client instance for this callback
         :param userdata: The private userdata for the mqtt client. Not used in Polyglot
-        :param flags: The flags set on the connection.
         :param msg: Dictionary of MQTT received message. Uses: msg.topic, msg.qos, msg.payload
         """
-        #_LOGGER.info('MQTT Received Message: ' + msg.topic + ": QoS: " + str(msg.qos) + ": " + str(msg.payload))
-        self.parent._recv_out(msg.payload)
-    
+        # pylint: disable=unused-argument
+        callback = self._routes.get(msg.topic) or \
+            self._routes.get(msg.topic.rsplit('/', 1)[0] + '/+')
+        if callback is not None:
+            callback(msg)
+
     def _disconnect(self, mqttc, userdata, rc):
         """
-        The callback for when a DISCONNECT occurs.
-        
+        The callback for when a DISCONNECT occurs. Paho reconnects by itself.
+
         :param mqttc: The client instance for this callback
         :param userdata: The private userdata for the mqtt client. Not used in Polyglot
         :param rc: Result code of connection, 0 = Graceful, anything else is unclean
         """
-        self.connected = False
+        # pylint: disable=unused-argument
+        with self._lock:
+            self._connected.clear()
         if rc != 0:
-            _LOGGER.info("MQTT Unexpected disconnection. Trying reconnect1.")
-            try:
-                self._mqttc.reconnect()
-            except Exception as ex:
-                template = "An exception of type {0} occured. Arguments:\n{1!r}"
-                message = template.format(type(ex).__name__, ex.args)
-                _LOGGER.error("MQTT Connection error: " + message)                
-        if rc == 0:
+            _LOGGER.info("MQTT Unexpected disconnection from %s:%s. Reconnecting.",
+                         self.server, self.port)
+        else:
             _LOGGER.info("MQTT Graceful disconnection.")
-            
-    def _log(self, mqttc, userdata, level, string):
-        """ Use for debugging MQTT Packets, disable for normal use, NOISY. """
-        #_LOGGER.info('MQTT Log - ' + str(level) + ': ' + str(string))
-        pass
-            
-    def _subscribe(self, mqttc, userdata, mid, granted_qos):
-        """ Callback for Subscribe message. Unused currently. """
-        #_LOGGER.info("MQTT Subscribed Succesfully for Message ID: " + str(mid) + " - QoS: " + str(granted_qos))
-        pass
-
-    def _publish(self, mqttc, userdata, mid):
-        """ Callback for publish message. Unused currently. """
-        #_LOGGER.info("MQTT Published message ID: " + str(mid))
-        pass
-        
+
+
+class socketSubsystem(object):
+    """
+    socketSubsystem class instantiated if interface is socket in server.json.
+    Polyglot listens on a Unix domain socket in the node server's sandbox and
+    the node server connects to it. Messages are length-prefixed frames, so
+    any number may be in flight in either direction. The listener outlives
+    individual connections, which lets either side restart independently.
+
+    :param parent: The NodeServer object that owns the socket
+    :type parent: polyglot.nodeserver_manager.NodeServer
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.path = parent.socket_path
+        self.pidfile = self.path + '.pid'
+        self.connected = False
+        self._listener = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
     def start(self):
+        """ Start listening for the node server, if not already. """
+        if self._listener is not None:
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen(1)
+        self._listener = listener
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOGGER.info('%8s listening on socket %s', self.parent.name, self.path)
+
+    def stop(self):
+        """ Close the connection and listener and remove the socket file. """
+        listener, self._listener = self._listener, None
+        self._drop(self._conn)
+        if listener is not None:
+            try:
+                # wakes the accept thread
+                listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            listener.close()
+        for path in (self.path, self.pidfile):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _accept(self):
+        """ Accept node server connections until the listener is closed. """
+        delay = 0
+        while self._listener is not None:
+            try:
+                conn, _ = self._listener.accept()
+            except AttributeError:
+                # closed by stop()
+                break
+            except socket.error as err:
+                if self._listener is None or err.errno == errno.EINTR:
+                    continue
+                # e.g. out of file descriptors: back off rather than spin
+                delay = min(delay * 2 or 0.1, NS_ACCEPT_BACKOFF_MAX)
+                _LOGGER.error('%8s socket accept failed: %s; retrying in '
+                              '%.1f s', self.parent.name, err, delay)
+                time.sleep(delay)
+                continue
+            delay = 0
+            # a new connection replaces any stale one
+            self._drop(self._conn)
+            with self._lock:
+                self._conn = conn
+            AsyncSocketReader(conn, self.parent._recv_out, self._drop).start()
+
+    def _drop(self, conn):
+        """ Forget a connection that has closed or been replaced. """
+        if conn is None:
+            return
+        with self._lock:
+            if self._conn is not conn:
+                return
+            self._conn = None
+            self.connected = False
+            self._ready.clear()
+        self.parent.node_connected = False
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.close()
+        _LOGGER.warning('%8s socket connection closed', self.parent.name)
+
+    def ready(self, frames):
         """
-        The client start method. Starts the thread for the MQTT Client
-        and publishes the connected message.
+        Complete the handshake: send the given frames ahead of anything else
+        and start accepting queued input.
         """
-        _LOGGER.info('Connecting to MQTT... ' + self._server + ':' + self._port)
-        try:
-            self._mqttc.connect(str(self._server), int(self._port), 10)
-            self._mqttc.loop_start()
-            self._mqttc.publish(self.topicOutput,json.dumps({"connected": {}}), retain=True)
-        except Exception as ex:
-            template = "An exception of type {0} occured. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            _LOGGER.error("MQTT Connection error: " + message)
-        
-    def stop(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                for frame in frames:
+                    send_frame(self._conn, frame)
+            except socket.error:
+                return
+            self.connected = True
+            self._ready.set()
+
+    def send(self, line):
+        """ Send a line to the node server. False if not connected. """
+        conn = None
+        with self._lock:
+            if self._ready.is_set():
+                conn = self._conn
+                try:
+                    send_frame(conn, line)
+                    return True
+                except socket.error:
+                    pass
+        self._drop(conn)
+        return False
+
+    def wait(self, timeout):
+        """ Wait for the node server to (re)connect. """
+        return self._ready.wait(timeout)
+
+    def write_pid(self, pid):
+        """
+        Record the connected node server's process id, with the identity of
+        the process (see utils.process_identity).
+        """
+        with open(self.pidfile, 'w') as pidf:
+            pidf.write('{} {}'.format(pid, process_identity(pid) or ''))
+
+    def adoptable_pid(self):
         """
-        The client stop method. If the client is currently connected
-        stop the thread and disconnect. Publish the disconnected 
-        message if clean shutdown.
+        The process id of a node server still running from a previous
+        Polyglot process, if there is one. A process that merely has its pid,
+        after a reboot or once the pid has been reused, is not adopted.
         """
-        if (self.connected):
-            _LOGGER.info('Disconnecting from MQTT... ' + self._server + ':' + self._port)
-            self._mqttc.publish(self.topicOutput,json.dumps({"disconnected": {}}), retain=True)
-            self._mqttc.loop_stop()
-            self._mqttc.disconnect()
-   
+        try:
+            with open(self.pidfile) as pidf:
+                pid, _, identity = pidf.read().strip().partition(' ')
+            pid = int(pid)
+        except (IOError, ValueError):
+            return None
+        if not identity or identity != process_identity(pid):
+            return None
+        return pid
+
+
+class pluginSubsystem(object):
+    """
+    pluginSubsystem class instantiated if interface is plugin in server.json.
+    The node server's executable is run as __main__ on a thread of Polyglot,
+    where PolyglotConnector() gives it an in-process connector
+    (nodeserver_api.InProcessConnector). Messages are passed as
+    dictionaries: the connector's dispatch thread takes messages for the node
+    server from its input queue, and its messages are handled by
+    NodeServer._recv_message on the node server's own threads.
+
+    A plugin's threads cannot be killed. A stopped plugin is detached: its
+    messages are dropped and its threads end once they notice, or are left
+    behind if they hang.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.name = parent.name
+        self._connector = None
+        self._stopped = False
+        self._thread = None
+        self._waiting = None
+
+    @property
+    def alive(self):
+        """ Indicates if the plugin is running and attached. """
+        return not self._stopped and self._thread is not None and \
+            self._thread.is_alive()
+
+    def start(self):
+        """ Run the node server on a new thread. """
+        self._thread = threading.Thread(
+            target=self._run, name='plugin-{}'.format(self.parent.file_name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Detach the node server. """
+        self._stopped = True
+        connector, self._connector = self._connector, None
+        if connector is not None:
+            connector.disconnect()
+        if self._waiting is not None:
+            # wake the dispatch thread
+            self._waiting.put(None)
+
+    def _run(self):
+        """ Run the node server's executable. (Runs in its own thread) """
+        # pylint: disable=broad-except, exec-used
+        from polyglot import nodeserver_api
+        nodeserver_api._PLUGIN.host = self  # pylint: disable=protected-access
+        exe = self.parent.exe
+        if self.parent.path not in sys.path:
+            sys.path.insert(0, self.parent.path)
+        try:
+            with open(exe) as source:
+                code = compile(source.read(), exe, 'exec')
+            exec(code, {'__name__': '__main__', '__file__': exe,
+                        '__package__': None})
+        except SystemExit:
+            pass
+        except Exception:
+            _LOGGER.exception('Node Server %s failed', self.name)
+
+    def attach(self, connector):
+        """ The node server has created its connector. """
+        if self._stopped:
+            raise RuntimeError('Node Server {} was stopped'.format(self.name))
+        self._connector = connector
+
+    def attached(self, connector):
+        """ Indicates if connector is the running node server's. """
+        return connector is self._connector and not self._stopped
+
+    def deliver(self, connector, message):
+        """ A message from the node server. """
+        if not self.attached(connector):
+            return
+        if 'config' in message:
+            # the node server keeps changing its own copy
+            message = copy.deepcopy(message)
+        self.parent._recv_message(message)  # pylint: disable=protected-access
+
+    def receive(self, connector):
+        """ The next message for the node server, None if there is none. """
+        inq = self.parent._inq  # pylint: disable=protected-access
+        if inq is None or not self.attached(connector):
+            time.sleep(1)
+            return None
+        self._waiting = inq
+        try:
+            message = inq.get(True, 5)
+        except Empty:
+            return None
+        inq.task_done()
+        if message is None:
+            return None
+        if 'config' in message:
+            message = copy.deepcopy(message)
+        return message
+
+    @property
+    def stats(self):
+        """ Plugin thread state and input queue depth. """
+        inq = self.parent._inq  # pylint: disable=protected-access
+        return {'thread': self._thread.name if self._thread else None,
+                'alive': self.alive,
+                'queued': inq.qsize() if inq is not None else None}
+
+
+def pid_alive(pid):
+    """ Determine if a process exists """
+    try:
+        os.kill(pid, 0)
+    except MyProcessLookupError:
+        return False
+    return True
+
+
 def random_string(length):
     """ Generate a random string of uppercase, lowercase, and digits """
     library = string.ascii_uppercase + string.ascii_lowercase + string.digits
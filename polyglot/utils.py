@@ -2,8 +2,19 @@
 # pylint: disable=import-error, unused-import, invalid-name, undefined-variable
 # flake8: noqa
 
+import bisect
+from collections import deque
+from contextlib import contextmanager
+import heapq
+import itertools
+import logging
+import os
+import random
+import socket
+import struct
 import sys
 import threading
+import time
 
 # Uniform Queue and Empty locations b/w Python 2 and 3
 try:
@@ -18,6 +29,54 @@ else:
     MyProcessLookupError = ProcessLookupError
 
 
+def _monotonic_clock():
+    """
+    The monotonic clock of Python 3, or CLOCK_MONOTONIC read through ctypes
+    on Python 2 (Linux). The wall clock if neither is available.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _Timespec(ctypes.Structure):
+            # pylint: disable=too-few-public-methods
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        lib = ctypes.CDLL(ctypes.util.find_library('rt') or
+                          ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        spec = _Timespec()
+        clock_monotonic = 1  # CLOCK_MONOTONIC on Linux
+        if clock_gettime(clock_monotonic, ctypes.byref(spec)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+    except (ImportError, AttributeError, OSError, TypeError):
+        return time.time
+
+    def _monotonic():
+        """ Seconds on the monotonic clock. """
+        spec = _Timespec()
+        clock_gettime(clock_monotonic, ctypes.byref(spec))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return _monotonic
+
+
+# Monotonic clock, unaffected by changes of the system time
+monotonic = _monotonic_clock()
+
+# Units of CPU time in /proc/<pid>/stat
+try:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+_LOGGER = logging.getLogger(__name__)
+
+
 class AsyncFileReader(threading.Thread):
     '''
     Helper class to implement asynchronous reading of a file
@@ -42,6 +101,74 @@ class AsyncFileReader(threading.Thread):
             self._handler(line.replace('\n', ''))
 
 
+# Length prefix used to frame messages on node server stream sockets
+FRAME_HEADER = struct.Struct('>I')
+
+
+def send_frame(sock, data):
+    """
+    Send one length-prefixed frame over a stream socket. The caller is
+    responsible for serializing concurrent writers.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    """ Read exactly size bytes from a socket, None if it closes first. """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frames(sock, handler):
+    """
+    Read length-prefixed frames from a socket until it is closed, passing
+    each decoded payload to handler.
+    """
+    while True:
+        try:
+            header = _recv_exact(sock, FRAME_HEADER.size)
+            if header is None:
+                return
+            payload = _recv_exact(sock, FRAME_HEADER.unpack(header)[0])
+        except socket.error:
+            return
+        if payload is None:
+            return
+        if not isinstance(payload, str):
+            payload = payload.decode('utf-8')
+        handler(payload)
+
+
+class AsyncSocketReader(threading.Thread):
+    '''
+    Socket counterpart to AsyncFileReader. Reads frames from a connected
+    socket in a separate thread and passes them to a handler. When the
+    connection closes, on_close is called with the socket.
+    '''
+
+    def __init__(self, sock, handler, on_close=None):
+        assert callable(handler)
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._sock = sock
+        self._handler = handler
+        self._on_close = on_close
+
+    def run(self):
+        '''The body of the thread: read frames until the socket closes.'''
+        recv_frames(self._sock, self._handler)
+        if self._on_close is not None:
+            self._on_close(self._sock)
+
+
 class LockQueue(Queue):
     """ Python queue with a locking utility """
 
@@ -59,3 +186,495 @@ class LockQueue(Queue):
         """ Put item into queue without waiting """
         if not self.locked:
             Queue.put_nowait(self, *args, **kwargs)
+
+
+class Scheduler(object):
+    """
+    Runs callables at requested times on a single thread. Pending calls are
+    kept in a heap ordered by due time, so any number of timers cost one
+    thread. Calls should be short; anything slow belongs on another thread.
+
+    :param name: Name for the scheduler thread
+    """
+
+    def __init__(self, name='scheduler'):
+        self.name = name
+        self._heap = []
+        self._cond = threading.Condition()
+        self._order = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func, *args):
+        """
+        Schedule func(*args) to run after delay seconds. Returns a handle
+        that may be passed to cancel.
+        """
+        entry = [monotonic() + delay, next(self._order), func, args]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                 name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        """ Cancel a scheduled call, if it has not run yet. """
+        if entry is not None:
+            entry[2] = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _run(self):
+        """ Run due calls in order. """
+        # pylint: disable=broad-except
+        while True:
+            with self._cond:
+                while True:
+                    now = monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        entry = heapq.heappop(self._heap)
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+            func, args = entry[2], entry[3]
+            if func is None:
+                continue
+            try:
+                func(*args)
+            except Exception:
+                _LOGGER.exception('%s: scheduled call failed', self.name)
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram of durations, in seconds.
+
+    :param bounds: Sorted upper bounds of the buckets. One more bucket
+                   catches everything above the last bound.
+    """
+
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1.0, 2.0, 5.0, 10.0)
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(bounds or self.BOUNDS)
+        self.clear()
+
+    def clear(self):
+        """ Forget all samples. """
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+        self.last = None
+
+    def add(self, value):
+        """ Record a sample. """
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+
+    def percentile(self, pct):
+        """
+        Approximate percentile: the upper bound of the bucket holding it
+        (the largest sample for the last bucket).
+        """
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.high)
+                return self.high
+        return self.high
+
+    @property
+    def stats(self):
+        """ Summary of the samples. """
+        return {'count': self.count,
+                'avg': self.total / self.count if self.count else None,
+                'low': self.low, 'high': self.high, 'last': self.last,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'bounds': list(self.bounds), 'buckets': list(self.buckets)}
+
+
+class PollScheduler(object):
+    """
+    Runs callables at fixed intervals on the thread that calls run_due.
+    Deadlines are kept on the monotonic clock, so the time the calls take
+    does not shift the schedule, and a call that overruns its interval skips
+    the ticks it missed instead of running them late. The first call of
+    every schedule comes phase (0 to 1) of its interval after it is added,
+    so that processes started together do not all poll at once. The lag of
+    the calls (how late they ran) is kept per group of schedules.
+
+    :param phase: Fraction of an interval before the first call, random if
+                  None
+    """
+
+    def __init__(self, phase=None):
+        self.phase = random.random() if phase is None else phase
+        self._heap = []
+        self._lock = threading.Lock()
+        self._order = itertools.count()
+        # schedule entries by name: [deadline, order, name, interval, func,
+        # group]; func is None once removed
+        self._entries = {}
+        # by group: [schedules, calls, skipped ticks, lag Histogram]
+        self._groups = {}
+
+    def add(self, name, interval, func, group=None):
+        """
+        Call func() every interval seconds, in place of any schedule of the
+        same name. The lag is counted with the other schedules of group
+        (by default, the name).
+        """
+        if interval <= 0:
+            raise ValueError('poll interval must be positive: {}'
+                             .format(interval))
+        group = name if group is None else group
+        with self._lock:
+            self._remove(name)
+            entry = [monotonic() + interval * self.phase, next(self._order),
+                     name, interval, func, group]
+            self._entries[name] = entry
+            heapq.heappush(self._heap, entry)
+            if group not in self._groups:
+                self._groups[group] = [0, 0, 0, Histogram()]
+            self._groups[group][0] += 1
+
+    def remove(self, name):
+        """ Stop calling a schedule. """
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        """ Remove a schedule (with the lock held). """
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            entry[4] = None
+            self._groups[entry[5]][0] -= 1
+
+    def interval(self, name):
+        """ The interval of a schedule, None if there is none. """
+        entry = self._entries.get(name)
+        return entry[3] if entry is not None else None
+
+    def run_due(self):
+        """
+        Run the calls that are due, in deadline order. Returns the seconds
+        until the next deadline, or None if nothing is scheduled.
+        """
+        while True:
+            with self._lock:
+                while self._heap and self._heap[0][4] is None:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    return None
+                entry = self._heap[0]
+                now = monotonic()
+                if entry[0] > now:
+                    return entry[0] - now
+                heapq.heappop(self._heap)
+                group = self._groups[entry[5]]
+                group[1] += 1
+                group[3].add(now - entry[0])
+            try:
+                entry[4]()
+            finally:
+                self._reschedule(entry)
+
+    def _reschedule(self, entry):
+        """ Set the next deadline of a schedule, skipping missed ticks. """
+        with self._lock:
+            if entry[4] is None:
+                return
+            deadline, interval = entry[0] + entry[3], entry[3]
+            now = monotonic()
+            if deadline <= now:
+                missed = int((now - deadline) // interval) + 1
+                self._groups[entry[5]][2] += missed
+                deadline += missed * interval
+            entry[0] = deadline
+            entry[1] = next(self._order)
+            heapq.heappush(self._heap, entry)
+
+    @property
+    def stats(self):
+        """ Calls, skipped ticks and lag of each group of schedules. """
+        with self._lock:
+            return {'phase': self.phase,
+                    'groups': dict(
+                        (group, {'schedules': schedules, 'calls': calls,
+                                 'skipped': skipped, 'lag': lag.stats})
+                        for group, (schedules, calls, skipped, lag)
+                        in self._groups.items())}
+
+
+def read_proc(pid):
+    """
+    Read the CPU time (seconds), resident memory (bytes), thread count and
+    context switches of a process from /proc. None if it cannot be read.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+        with open('/proc/{}/status'.format(pid)) as status_file:
+            status = status_file.read()
+    except (IOError, OSError):
+        return None
+
+    # fields after the command name, which may contain spaces, start at
+    # field 3 (state); utime and stime are fields 14 and 15
+    fields = stat[stat.rindex(')') + 2:].split()
+    values = {}
+    for line in status.splitlines():
+        key, _, value = line.partition(':')
+        if key in ('VmRSS', 'Threads', 'voluntary_ctxt_switches',
+                   'nonvoluntary_ctxt_switches'):
+            values[key] = int(value.split()[0])
+    return {'cpu_time': (int(fields[11]) + int(fields[12])) /
+                        float(CLOCK_TICKS),
+            'rss': values.get('VmRSS', 0) * 1024,
+            'threads': values.get('Threads', 0),
+            'ctx_voluntary': values.get('voluntary_ctxt_switches', 0),
+            'ctx_involuntary': values.get('nonvoluntary_ctxt_switches', 0)}
+
+
+def process_identity(pid):
+    """
+    The boot id and start time (clock ticks after boot) of a process, which
+    tell it apart from a later process given the same pid. None if they
+    cannot be read.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+        with open('/proc/sys/kernel/random/boot_id') as boot_file:
+            boot_id = boot_file.read().strip()
+    except (IOError, OSError):
+        return None
+    # starttime is field 22, the 20th after the command name
+    return '{}:{}'.format(boot_id, stat[stat.rindex(')') + 2:].split()[19])
+
+
+class ProcessSampler(object):
+    """
+    Rolling resource usage of a process, sampled from /proc into a fixed
+    size ring. CPU use and context switches are rates over the time since
+    the previous sample of the same process.
+
+    :param size: Number of samples kept
+    """
+
+    def __init__(self, size=60):
+        self.samples = deque(maxlen=size)
+        self._last = None
+
+    def sample(self, pid):
+        """ Take a sample of the process. None if it is not running. """
+        now = monotonic()
+        data = read_proc(pid)
+        if data is None:
+            self._last = None
+            return None
+
+        sample = {'time': time.time(), 'pid': pid, 'rss': data['rss'],
+                  'threads': data['threads'], 'cpu_percent': None,
+                  'ctx_voluntary': None, 'ctx_involuntary': None}
+        last, self._last = self._last, (now, pid, data)
+        if last is not None and last[1] == pid and now > last[0]:
+            elapsed = now - last[0]
+            sample['cpu_percent'] = round(
+                100.0 * (data['cpu_time'] - last[2]['cpu_time']) / elapsed, 1)
+            for key in ('ctx_voluntary', 'ctx_involuntary'):
+                sample[key] = round((data[key] - last[2][key]) / elapsed, 1)
+        self.samples.append(sample)
+        return sample
+
+    @property
+    def stats(self):
+        """ Latest sample, averages and peaks over the ring, and the ring. """
+        samples = list(self.samples)
+        cpu = [smp['cpu_percent'] for smp in samples
+               if smp['cpu_percent'] is not None]
+        return {'latest': samples[-1] if samples else None,
+                'cpu_percent_avg': round(sum(cpu) / len(cpu), 1) if cpu else None,
+                'cpu_percent_max': max(cpu) if cpu else None,
+                'rss_max': max(smp['rss'] for smp in samples) if samples else None,
+                'samples': samples}
+
+
+class TraceRing(object):
+    """
+    Fixed size ring of trace records for a sample of messages. Recording
+    takes no lock: slots are claimed from a counter, which is atomic under
+    the GIL. When sampling is off, checking for a sample costs one attribute
+    lookup.
+
+    :param fields: Names of the fields of a record, after the time
+    :param size: Number of records kept
+    :param every: Trace one message in this many, 0 for none. Messages are
+                  picked at random, so interleaved kinds of message are
+                  sampled alike.
+    """
+
+    def __init__(self, fields, size=1000, every=0):
+        self.fields = ('time',) + tuple(fields)
+        self.size = size
+        self.every = every
+        self._ring = [None] * size
+        self._slots = itertools.count()
+
+    def sampled(self):
+        """ Whether the current message should be traced. """
+        every = self.every
+        return bool(every) and random.random() * every < 1
+
+    def record(self, *values):
+        """ Record a trace of a message. """
+        slot = next(self._slots)
+        self._ring[slot % self.size] = (slot, time.time()) + values
+
+    def dump(self):
+        """ The records, oldest first, as dictionaries. """
+        records = sorted(record for record in list(self._ring)
+                         if record is not None)
+        return [dict(zip(self.fields, record[1:])) for record in records]
+
+    def clear(self):
+        """ Forget all records. """
+        self._ring = [None] * self.size
+
+
+class Recorder(object):
+    """
+    Records the lines of node server traffic to a file. Each line of the
+    file holds the seconds since the recording started (monotonic clock),
+    the direction and the line, separated by tabs. Directions are "i" (to
+    the node server), "o" (node server output) and "e" (node server error
+    output).
+
+    :param path: File to record to
+    :param name: Name of the node server, for the header line
+    """
+
+    def __init__(self, path, name=''):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+        self._file.write('# polyglot recording: {} {:.6f}\n'
+                         .format(name, time.time()))
+        self._start = monotonic()
+
+    def record(self, direction, line):
+        """ Record a line. """
+        entry = '{:.6f}\t{}\t{}\n'.format(monotonic() - self._start,
+                                          direction, line.rstrip('\n'))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(entry)
+                self.count += 1
+
+    def close(self):
+        """ Finish the recording. """
+        with self._lock:
+            rec_file, self._file = self._file, None
+        if rec_file is not None:
+            rec_file.close()
+
+
+def cpu_time():
+    """ CPU time (user and system) used by this process, in seconds. """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Timeline(object):
+    """
+    Wall clock and CPU time of named phases, and times of events, since a
+    start time. Phases may nest: a phase is named after the phases it is in,
+    separated by slashes. Phases are timed in one thread; events may come
+    from any.
+
+    :param start: optional, monotonic start time (default now)
+    :param level: optional, the level log() logs at (default INFO)
+    """
+
+    def __init__(self, start=None, level=logging.INFO):
+        self.start = monotonic() if start is None else start
+        self.level = level
+        self.phases = []
+        self.events = []
+        self._names = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """ Time the phase run in a with statement. """
+        self._names.append(name)
+        began, cpu = monotonic(), cpu_time()
+        try:
+            yield
+        finally:
+            self.add('/'.join(self._names), began, monotonic() - began,
+                     cpu_time() - cpu)
+            self._names.pop()
+
+    def add(self, name, began, wall, cpu):
+        """ Add a phase timed elsewhere. """
+        with self._lock:
+            self.phases.append({'name': name,
+                                'start': round(began - self.start, 6),
+                                'wall': round(wall, 6), 'cpu': round(cpu, 6)})
+
+    def event(self, name, **values):
+        """ Note the time of an event. """
+        values.update({'name': name,
+                       'at': round(monotonic() - self.start, 6)})
+        with self._lock:
+            self.events.append(values)
+
+    @property
+    def stats(self):
+        """ The phases and events, in order. """
+        with self._lock:
+            return {'phases': sorted(self.phases, key=lambda p: p['start']),
+                    'events': list(self.events)}
+
+    def log(self, logger, level=None):
+        """ Log the phases, at the timeline's level by default. """
+        if level is None:
+            level = self.level
+        lines = ['{:<32} {:>8} {:>8} {:>8}'.format('phase', 'start', 'wall',
+                                                   'cpu')]
+        for phase in self.stats['phases']:
+            lines.append('{name:<32} {start:8.3f} {wall:8.3f} {cpu:8.3f}'
+                         .format(**phase))
+        logger.log(level, 'Startup timeline (seconds):\n%s', '\n'.join(lines))
+
+
+def read_recording(path):
+    """ Yield (seconds, direction, line) for each line of a recording. """
+    with open(path) as rec_file:
+        for entry in rec_file:
+            if entry.startswith('#') or not entry.strip():
+                continue
+            offset, direction, line = entry.rstrip('\n').split('\t', 2)
+            yield float(offset), direction, line
@@ -0,0 +1,431 @@
+"""
+Preforked zygote for Python node servers.
+
+The zygote is a single threaded process that imports the node server SDK
+(and any other modules it is asked to) once, then forks a child for each
+node server it is asked to start. Children share the zygote's memory pages
+copy-on-write and skip interpreter start up and the SDK imports.
+
+Polyglot talks to the zygote over its stdin and stdout, one JSON message per
+line. A child gets its stdin, stdout and stderr through named pipes that
+Polyglot creates, as Python 2 cannot pass file descriptors over a socket.
+The zygote reaps its children and reports their exit codes, so the
+:class:`ZygoteProcess` that Polyglot holds for a child works like a
+``subprocess.Popen``.
+"""
+# pylint: disable=import-error,undefined-variable
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+# Modules always imported by the zygote
+ZYGOTE_PRELOAD = ('polyglot.nodeserver_api',)
+# Seconds to wait for the zygote to start and for a child to open its pipes
+ZYGOTE_START_TIMEOUT = 30
+ZYGOTE_SPAWN_TIMEOUT = 10
+
+
+class Zygote(object):
+    """
+    Polyglot's handle on a zygote process.
+
+    :param python: Python interpreter to run the zygote with
+    :param preload: Modules for the zygote to import, in addition to the SDK
+    :param env: Environment of the zygote
+    """
+
+    def __init__(self, python=sys.executable, preload=(), env=None):
+        self.preload = list(ZYGOTE_PRELOAD) + \
+            [name for name in preload if name not in ZYGOTE_PRELOAD]
+        self.spawned = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._requests = {}
+        self._children = {}
+        self._count = 0
+        self._ready = threading.Event()
+        self._proc = subprocess.Popen(
+            [python, '-m', 'polyglot.zygote', json.dumps(self.preload)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env,
+            close_fds=True)
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+        if not self._ready.wait(ZYGOTE_START_TIMEOUT) or not self.alive:
+            self.stop()
+            raise RuntimeError('Zygote did not start')
+
+    @property
+    def pid(self):
+        """ Process ID of the zygote. """
+        return self._proc.pid
+
+    @property
+    def alive(self):
+        """ Indicates if the zygote is running. """
+        return self._proc.poll() is None
+
+    def spawn(self, exe, cwd, env):
+        """
+        Start a node server executable in a child of the zygote, like
+        ``python exe`` in directory cwd with environment env.
+
+        :returns: A :class:`ZygoteProcess`
+        :raises: RuntimeError if the child could not be started
+        """
+        fifo_dir = tempfile.mkdtemp(prefix='polyglot_zygote_')
+        fifos = [os.path.join(fifo_dir, name)
+                 for name in ('stdin', 'stdout', 'stderr')]
+        fds = []
+        proc = None
+        try:
+            for path in fifos:
+                os.mkfifo(path, 0o600)
+            # output pipes can be opened before the child is there
+            for path in fifos[1:]:
+                fds.append(_open_now(path, os.O_RDONLY))
+
+            with self._lock:
+                self._count += 1
+                request_id = self._count
+                proc = ZygoteProcess(self)
+                self._requests[request_id] = proc
+            self._send({'spawn': {'id': request_id, 'exe': exe, 'cwd': cwd,
+                                  'env': env, 'fifos': fifos}})
+            if not proc.started.wait(ZYGOTE_SPAWN_TIMEOUT) or proc.pid is None:
+                raise RuntimeError(proc.error or 'Zygote did not answer')
+
+            # the child opens its stdin last, after its output pipes
+            stdin = _open_writer(fifos[0], proc, ZYGOTE_SPAWN_TIMEOUT)
+            fds.insert(0, stdin)
+        except (OSError, IOError, RuntimeError) as err:
+            for fdesc in fds:
+                os.close(fdesc)
+            with self._lock:
+                self.failed += 1
+            if proc is not None and proc.pid is not None:
+                proc.kill()
+            raise RuntimeError('Zygote could not start {}: {}'
+                               .format(exe, err))
+        finally:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+
+        proc.stdin = os.fdopen(fds[0], 'w', 1)
+        proc.stdout = os.fdopen(fds[1], 'r', 1)
+        proc.stderr = os.fdopen(fds[2], 'r', 1)
+        with self._lock:
+            self.spawned += 1
+        return proc
+
+    def stop(self):
+        """ Stop the zygote. Its children keep running. """
+        try:
+            self._proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self._proc.poll() is None:
+            try:
+                self._proc.terminate()
+            except OSError:
+                pass
+        self._proc.wait()
+
+    @property
+    def stats(self):
+        """ Zygote process and spawn counts. """
+        with self._lock:
+            return {'pid': self.pid, 'alive': self.alive,
+                    'preload': self.preload, 'spawned': self.spawned,
+                    'failed': self.failed, 'children': len(self._children)}
+
+    def _send(self, msg):
+        """ Write one message to the zygote. """
+        with self._write_lock:
+            try:
+                self._proc.stdin.write(json.dumps(msg) + '\n')
+                self._proc.stdin.flush()
+            except (IOError, OSError, ValueError):
+                raise RuntimeError('Zygote is not running')
+
+    def _read(self):
+        """ Read messages from the zygote. (Runs in its own thread) """
+        for line in iter(self._proc.stdout.readline, ''):
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                _LOGGER.error('Zygote: bad message %r', line)
+                continue
+            command, args = list(msg.items())[0]
+            if command == 'ready':
+                self._ready.set()
+            elif command in ('started', 'failed'):
+                with self._lock:
+                    proc = self._requests.pop(args['id'], None)
+                    if proc is not None and command == 'started':
+                        proc.pid = args['pid']
+                        self._children[proc.pid] = proc
+                if proc is not None:
+                    proc.error = args.get('error')
+                    proc.started.set()
+            elif command == 'exited':
+                with self._lock:
+                    proc = self._children.pop(args['pid'], None)
+                if proc is not None:
+                    proc.returncode = args['code']
+                    proc.exited.set()
+
+        # zygote has exited: its children can only be watched by pid
+        self._proc.wait()
+        self._ready.set()
+        with self._lock:
+            requests = list(self._requests.values())
+            self._requests = {}
+        for proc in requests:
+            proc.error = 'Zygote exited'
+            proc.started.set()
+        _LOGGER.info('Zygote exited (%s)', self._proc.poll())
+
+
+class ZygoteProcess(object):
+    """
+    A node server started by the zygote, with the parts of the
+    ``subprocess.Popen`` interface that Polyglot uses.
+    """
+
+    def __init__(self, zygote):
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self._zygote = zygote
+
+    def poll(self):
+        """ Exit code of the process, None while it is running. """
+        if self.returncode is None and not self._zygote.alive and \
+                not _pid_alive(self.pid):
+            # orphaned when the zygote exited; the exit code is lost
+            self.returncode = -1
+            self.exited.set()
+        return self.returncode
+
+    def wait(self):
+        """ Wait for the process to exit and return its exit code. """
+        while self.poll() is None:
+            self.exited.wait(1)
+        return self.returncode
+
+    def kill(self):
+        """ Kill the process. """
+        if self.pid is not None and self.poll() is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+    def terminate(self):
+        """ Terminate the process. """
+        if self.pid is not None and self.poll() is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+def _pid_alive(pid):
+    """ Determine if a process exists """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def _open_now(path, flags):
+    """ Open a named pipe without waiting for the other end. """
+    fdesc = os.open(path, flags | os.O_NONBLOCK)
+    fcntl.fcntl(fdesc, fcntl.F_SETFL,
+                fcntl.fcntl(fdesc, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return fdesc
+
+
+def _native(value):
+    """ A string from JSON as the native str type. """
+    if sys.version_info[0] == 2 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _open_writer(path, proc, timeout):
+    """
+    Open the write end of a named pipe once proc has started opening its
+    end, without blocking if it never does.
+    """
+    waited = 0.0
+    while True:
+        try:
+            return _open_now(path, os.O_WRONLY)
+        except OSError as err:
+            if err.errno != errno.ENXIO:
+                raise
+        if proc.poll() is not None or waited >= timeout:
+            raise RuntimeError('child did not open its pipes')
+        proc.exited.wait(0.005)
+        waited += 0.005
+
+
+# Zygote process
+
+def main():
+    """ Run the zygote: preload modules, then fork children on request. """
+    for name in json.loads(sys.argv[1]):
+        try:
+            __import__(name)
+        except ImportError as err:
+            sys.stderr.write('Zygote could not preload {}: {}\n'
+                             .format(name, err))
+    wake_r, wake_w = os.pipe()
+    for fdesc in (wake_r, wake_w):
+        fcntl.fcntl(fdesc, fcntl.F_SETFL,
+                    fcntl.fcntl(fdesc, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def sigchld(signum, frame):
+        """ wake the loop to reap children """
+        # pylint: disable=unused-argument
+        try:
+            os.write(wake_w, b'x')
+        except OSError:
+            pass
+
+    signal.signal(signal.SIGCHLD, sigchld)
+    # Ctrl-C is for Polyglot, which stops the zygote
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _write({'ready': {'pid': os.getpid()}})
+
+    buf = b''
+    while True:
+        try:
+            readable = select.select([0, wake_r], [], [])[0]
+        except (select.error, OSError) as err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        if wake_r in readable:
+            try:
+                os.read(wake_r, 4096)
+            except OSError:
+                pass
+            _reap()
+        if 0 in readable:
+            try:
+                data = os.read(0, 65536)
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                msg = json.loads(line.decode('utf-8'))
+                if 'spawn' in msg:
+                    _spawn(msg['spawn'], (wake_r, wake_w))
+    _reap()
+
+
+def _write(msg):
+    """ Write one message to Polyglot. """
+    data = (json.dumps(msg) + '\n').encode('utf-8')
+    while data:
+        try:
+            data = data[os.write(1, data):]
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise
+
+
+def _reap():
+    """ Report children that have exited. """
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            return
+        if not pid:
+            return
+        if os.WIFSIGNALED(status):
+            code = -os.WTERMSIG(status)
+        else:
+            code = os.WEXITSTATUS(status)
+        _write({'exited': {'pid': pid, 'code': code}})
+
+
+def _spawn(request, fds):
+    """ Fork a child for a node server. """
+    try:
+        pid = os.fork()
+    except OSError as err:
+        _write({'failed': {'id': request['id'], 'error': str(err)}})
+        return
+    if pid == 0:
+        _child(request, fds)
+    _write({'started': {'id': request['id'], 'pid': pid}})
+
+
+def _child(request, fds):
+    """ Become the node server. Does not return. """
+    # pylint: disable=broad-except
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for fdesc in fds:
+            os.close(fdesc)
+        stdin_path, stdout_path, stderr_path = request['fifos']
+        stdout = os.open(stdout_path, os.O_WRONLY)
+        stderr = os.open(stderr_path, os.O_WRONLY)
+        # blocks until Polyglot opens the other end, so the node server
+        # never reads end of file from a pipe nobody has written to yet
+        stdin = os.open(stdin_path, os.O_RDONLY)
+        for target, fdesc in enumerate((stdin, stdout, stderr)):
+            os.dup2(fdesc, target)
+            os.close(fdesc)
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update((_native(key), _native(value))
+                          for key, value in request['env'].items())
+        exe = _native(request['exe'])
+        sys.argv = [exe]
+        sys.path[0] = os.path.dirname(exe)
+        if 'random' in sys.modules:
+            # do not share the zygote's random state
+            sys.modules['random'].seed()
+
+        import runpy
+        runpy.run_path(exe, run_name='__main__')
+        code = 0
+    except SystemExit as exc:
+        code = exc.code
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    # leave through the interpreter's own shutdown (non-daemon threads,
+    # atexit handlers, stream flushes), never back into the zygote loop
+    raise SystemExit(code)
+
+
+if __name__ == '__main__':
+    main()